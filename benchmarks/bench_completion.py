@@ -0,0 +1,163 @@
+"""
+Measures throughput and latency of Completion.create against the local mock provider server, without paid calls.
+
+    python benchmarks/bench_completion.py --latency 0.05 --jitter 0.01 --save
+    python benchmarks/bench_completion.py --baseline benchmarks/results/<earlier>.json --threshold 0.1
+
+Sweeps the model x prompt fan-out, the number of worker threads and the payload size. Each case runs
+--requests create calls from --clients concurrent callers and reports completions per second and p50/p99 latency.
+With --baseline, exits with status 1 if any case's throughput dropped, or its p99 grew, by more than --threshold.
+"""
+import argparse
+import itertools
+import json
+import platform
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from mock_server import MockConfig, MockServer  # noqa: E402
+import openlm  # noqa: E402
+from openlm import Completion, RetryPolicy  # noqa: E402
+
+RESULTS_DIR = ROOT / 'benchmarks' / 'results'
+
+MODELS = ['openai.com/text-davinci-003', 'huggingface.co/gpt2', 'cohere.ai/command']
+
+
+def run_case(models: int, prompts: int, workers: int, payload: int, requests: int, clients: int):
+    Completion.configure(max_workers=workers)
+    model = MODELS[:models]
+    prompt = ['x' * payload] * prompts
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def call(_):
+        nonlocal errors
+        started = time.perf_counter()
+        response = Completion.create(model=model, prompt=prompt, max_tokens=max(1, payload // 4))
+        elapsed = time.perf_counter() - started
+        failed = sum('error' in choice for choice in response['choices'])
+        with lock:
+            latencies.append(elapsed)
+            errors += failed
+
+    # Warms up connections and the executor
+    call(None)
+    latencies.clear()
+    errors = 0
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(call, range(requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    choices = requests * models * prompts
+    return {
+        'models': models,
+        'prompts': prompts,
+        'workers': workers,
+        'payload': payload,
+        'requests': requests,
+        'clients': clients,
+        'seconds': elapsed,
+        'requests_per_second': requests / elapsed,
+        'choices_per_second': choices / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))] * 1000,
+        'error_rate': errors / choices,
+    }
+
+
+def case_key(case):
+    return (case['models'], case['prompts'], case['workers'], case['payload'])
+
+
+def compare(results, baseline, threshold: float):
+    """
+    Returns a description of each case that regressed by more than threshold against the baseline.
+    """
+    before = {case_key(case): case for case in baseline['cases']}
+    regressions = []
+    for case in results['cases']:
+        old = before.get(case_key(case))
+        if old is None:
+            continue
+        name = 'models={} prompts={} workers={} payload={}'.format(*case_key(case))
+        if case['choices_per_second'] < old['choices_per_second'] * (1 - threshold):
+            regressions.append(f"{name}: throughput {old['choices_per_second']:.1f} -> {case['choices_per_second']:.1f} choices/s")
+        if case['p99_ms'] > old['p99_ms'] * (1 + threshold):
+            regressions.append(f"{name}: p99 {old['p99_ms']:.1f} -> {case['p99_ms']:.1f}ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--models', type=int, nargs='+', default=[1, 3], help='Numbers of models per create call.')
+    parser.add_argument('--prompts', type=int, nargs='+', default=[1, 8], help='Numbers of prompts per create call.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[8, 32], help='Sizes of the shared worker pool.')
+    parser.add_argument('--payload', type=int, nargs='+', default=[64, 4096], help='Prompt sizes in characters.')
+    parser.add_argument('--requests', type=int, default=50, help='Number of create calls per case.')
+    parser.add_argument('--clients', type=int, default=4, help='Number of concurrent callers.')
+    parser.add_argument('--latency', type=float, default=0.02, help='Mean mock response latency in seconds.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Standard deviation of the mock latency in seconds.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of mock requests answered with a 500.')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='Fraction of mock requests answered with a 429.')
+    parser.add_argument('--save', action='store_true', help=f'Save the results to {RESULTS_DIR.relative_to(ROOT)}/.')
+    parser.add_argument('--output', help='Save the results to this file.')
+    parser.add_argument('--baseline', help='Results file to compare against.')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Allowed relative regression against the baseline.')
+    args = parser.parse_args()
+
+    config = MockConfig(latency=args.latency, jitter=args.jitter,
+                        error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate, retry_after=0.01)
+    with MockServer(config) as server:
+        # The default providers are registered on first use and need a key, but don't replace the mock ones
+        openlm.api_key = 'mock'
+        Completion.register(server.providers())
+        # Failed calls count as errors rather than being hidden behind retries
+        Completion.configure(retry=RetryPolicy(max_retries=0))
+
+        cases = []
+        for models, prompts, workers, payload in itertools.product(args.models, args.prompts, args.workers, args.payload):
+            case = run_case(models, prompts, workers, payload, args.requests, args.clients)
+            cases.append(case)
+            print(f"models={models} prompts={prompts:<3} workers={workers:<3} payload={payload:<6} "
+                  f"{case['choices_per_second']:8.1f} choices/s  p50 {case['p50_ms']:7.1f}ms  p99 {case['p99_ms']:7.1f}ms  "
+                  f"errors {case['error_rate']:.1%}")
+        Completion.shutdown()
+
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'mock': vars(config),
+        'cases': cases,
+    }
+    output = args.output
+    if args.save and output is None:
+        RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+        output = RESULTS_DIR / f"bench_completion-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    if output is not None:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
+        print(f"Saved results to {output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f"FAIL: {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
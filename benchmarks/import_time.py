@@ -0,0 +1,107 @@
+"""
+Measures how long `import openlm` takes in a fresh interpreter, and checks that heavy modules stay unloaded until used.
+
+    python benchmarks/import_time.py --runs 20 --max-ms 150
+
+Exits with status 1 if a module that should load lazily was imported, or if the median import time is over --max-ms.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Modules `import openlm` must not pull in. They load on first use instead.
+LAZY_MODULES = [
+    'requests',
+    'urllib3',
+    'aiohttp',
+    'sqlite3',
+    'numpy',
+    'multiprocessing',
+    'concurrent.futures.process',
+    'openlm.llm.openai',
+    'openlm.llm.huggingface',
+    'openlm.llm.cohere',
+]
+
+SNIPPET = """
+import json, sys, time
+started = time.perf_counter()
+import openlm
+elapsed = time.perf_counter() - started
+print(json.dumps({'seconds': elapsed, 'loaded': [m for m in %r if m in sys.modules]}))
+""" % (LAZY_MODULES,)
+
+
+def measure(runs: int):
+    env = dict(os.environ, PYTHONPATH=str(ROOT) + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    # Bytecode is compiled on the first run, so it doesn't count
+    subprocess.run([sys.executable, '-c', 'import openlm'], env=env, check=True)
+    samples, loaded = [], set()
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', SNIPPET], env=env, check=True, capture_output=True, text=True).stdout
+        result = json.loads(out)
+        samples.append(result['seconds'] * 1000)
+        loaded.update(result['loaded'])
+    return samples, sorted(loaded)
+
+
+def slowest_imports(count: int):
+    """
+    Returns the modules with the highest cumulative import time, from `python -X importtime`.
+    """
+    env = dict(os.environ, PYTHONPATH=str(ROOT) + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    err = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import openlm'], env=env, check=True,
+                         capture_output=True, text=True).stderr
+    rows = []
+    for line in err.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative_us, name = line[len('import time:'):].split('|')
+        # Skips the header line
+        if cumulative_us.strip().isdigit():
+            rows.append((int(cumulative_us), name.rstrip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10, help='Number of fresh interpreters to time.')
+    parser.add_argument('--max-ms', type=float, help='Fail if the median import time is over this many milliseconds.')
+    parser.add_argument('--profile', type=int, default=0, metavar='N', help='Also show the N slowest imports.')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+    args = parser.parse_args()
+
+    samples, loaded = measure(args.runs)
+    result = {
+        'runs': args.runs,
+        'median_ms': statistics.median(samples),
+        'min_ms': min(samples),
+        'max_ms': max(samples),
+        'eagerly_loaded': loaded,
+    }
+    if args.json:
+        print(json.dumps(result, indent=4))
+    else:
+        print(f"import openlm: median {result['median_ms']:.1f}ms, min {result['min_ms']:.1f}ms, max {result['max_ms']:.1f}ms over {args.runs} runs")
+    if args.profile:
+        for cumulative_us, name in slowest_imports(args.profile):
+            print(f"{cumulative_us / 1000:8.1f}ms {name}")
+
+    failed = False
+    if loaded:
+        print(f"FAIL: imported eagerly: {', '.join(loaded)}", file=sys.stderr)
+        failed = True
+    if args.max_ms is not None and result['median_ms'] > args.max_ms:
+        print(f"FAIL: median import time {result['median_ms']:.1f}ms is over the {args.max_ms:.1f}ms budget", file=sys.stderr)
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+"""
+A local stand-in for the OpenAI, HuggingFace inference and Cohere generate and chat APIs, for benchmarking without paid calls.
+
+    python benchmarks/mock_server.py --port 8080 --latency 0.05 --jitter 0.02 --error-rate 0.01 --rate-limit-rate 0.02
+
+Point providers at it with base_url:
+
+    OpenAI(api_key='mock', base_url='http://127.0.0.1:8080/v1/completions')
+    Huggingface(base_url='http://127.0.0.1:8080/models')
+    Cohere(base_url='http://127.0.0.1:8080/v1/generate')
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+
+class MockConfig():
+    """
+    How the mock server behaves.
+
+    :param latency: The mean number of seconds before a response starts.
+    :param jitter: The standard deviation in seconds of the latency.
+    :param error_rate: The fraction of requests answered with a 500.
+    :param rate_limit_rate: The fraction of requests answered with a 429 and a Retry-After header.
+    :param retry_after: The Retry-After value in seconds sent with 429s.
+    :param tokens: The number of tokens generated per completion when the request doesn't set max_tokens.
+    :param token_delay: The number of seconds between two streamed tokens.
+    """
+    def __init__(self, latency: float = 0.05,
+                       jitter: float = 0.0,
+                       error_rate: float = 0.0,
+                       rate_limit_rate: float = 0.0,
+                       retry_after: float = 0.1,
+                       tokens: int = 16,
+                       token_delay: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.tokens = tokens
+        self.token_delay = token_delay
+
+
+class MockServer():
+    """
+    Runs the mock APIs on a background thread. Use as a context manager, or call start() and stop().
+
+    :param config: How the server behaves. Can be changed while it runs.
+    :param host: The interface to listen on.
+    :param port: The port to listen on, 0 for any free port.
+    """
+    def __init__(self, config: Optional[MockConfig] = None, host: str = '127.0.0.1', port: int = 0):
+        self.config = config or MockConfig()
+        self.requests = 0
+        self.connections = set()
+        # The number of turns of each Cohere chat conversation_id seen
+        self.conversations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _handler(self))
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'MockServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, name='openlm-mock', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def providers(self) -> List[Any]:
+        """
+        Returns OpenAI, Huggingface and Cohere providers pointed at this server.
+        """
+        from openlm.llm import Cohere, Huggingface, OpenAI
+
+        return [
+            OpenAI(api_key='mock', base_url=self.url + '/v1/completions'),
+            Huggingface(api_key='mock', base_url=self.url + '/models'),
+            Cohere(api_key='mock', base_url=self.url + '/v1/generate'),
+        ]
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def _handler(server: MockServer):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Headers and body go out in separate writes, which Nagle's algorithm would hold back for a delayed ACK
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            with server._lock:
+                server.requests += 1
+                server.connections.add(self.client_address)
+            config = server.config
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            time.sleep(max(0.0, random.gauss(config.latency, config.jitter)))
+
+            roll = random.random()
+            if roll < config.rate_limit_rate:
+                return self._json(429, {'error': 'Rate limit reached'}, {'Retry-After': str(config.retry_after)})
+            if roll < config.rate_limit_rate + config.error_rate:
+                return self._json(500, {'error': 'Internal server error'})
+
+            if self.path.startswith('/v1/chat/completions'):
+                self._openai_chat(body)
+            elif self.path.startswith('/v1/chat'):
+                self._cohere_chat(body)
+            elif self.path.startswith('/v1/completions'):
+                self._openai(body)
+            elif self.path.startswith('/models/'):
+                self._huggingface(body)
+            elif self.path.startswith('/v1/generate'):
+                self._cohere(body)
+            else:
+                self._json(404, {'error': f'Unknown path {self.path}'})
+
+        def _openai(self, body):
+            prompts = body['prompt'] if isinstance(body['prompt'], list) else [body['prompt']]
+            n = body.get('n') or 1
+            tokens = body.get('max_tokens') or server.config.tokens
+            if body.get('stream'):
+                return self._stream([f"data: {json.dumps({'id': 'cmpl-mock', 'choices': [{'text': t, 'index': 0, 'finish_reason': None}]})}\n\n"
+                                     for t in _words(tokens)] + ['data: [DONE]\n\n'])
+            choices = [{'text': _text(tokens), 'index': i * n + j, 'logprobs': None, 'finish_reason': 'length'}
+                       for i in range(len(prompts)) for j in range(n)]
+            prompt_tokens = sum(_count(p) for p in prompts)
+            self._json(200, {
+                'id': 'cmpl-' + uuid.uuid4().hex,
+                'object': 'text_completion',
+                'choices': choices,
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': tokens * len(choices),
+                          'total_tokens': prompt_tokens + tokens * len(choices)},
+            })
+
+        def _openai_chat(self, body):
+            n = body.get('n') or 1
+            tokens = body.get('max_tokens') or server.config.tokens
+            if body.get('stream'):
+                return self._stream([f"data: {json.dumps({'id': 'chatcmpl-mock', 'choices': [{'delta': {'content': t}, 'index': 0, 'finish_reason': None}]})}\n\n"
+                                     for t in _words(tokens)] + ['data: [DONE]\n\n'])
+            choices = [{'message': {'role': 'assistant', 'content': _text(tokens)}, 'index': i, 'finish_reason': 'length'} for i in range(n)]
+            prompt_tokens = sum(_count(message['content']) for message in body['messages'])
+            self._json(200, {
+                'id': 'chatcmpl-' + uuid.uuid4().hex,
+                'object': 'chat.completion',
+                'choices': choices,
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': tokens * n, 'total_tokens': prompt_tokens + tokens * n},
+            })
+
+        def _cohere_chat(self, body):
+            tokens = body.get('max_tokens') or server.config.tokens
+            if body.get('conversation_id'):
+                with server._lock:
+                    server.conversations[body['conversation_id']] = server.conversations.get(body['conversation_id'], 0) + 1
+            prompt_tokens = _count(body['message']) + sum(_count(m['message']) for m in body.get('chat_history') or [])
+            response = {
+                'response_id': uuid.uuid4().hex,
+                'generation_id': uuid.uuid4().hex,
+                'text': _text(tokens),
+                'finish_reason': 'COMPLETE',
+                'meta': {'billed_units': {'input_tokens': prompt_tokens, 'output_tokens': tokens}},
+            }
+            if body.get('stream'):
+                return self._stream([json.dumps({'event_type': 'stream-start', 'is_finished': False}) + '\n'] +
+                                    [json.dumps({'event_type': 'text-generation', 'text': t, 'is_finished': False}) + '\n' for t in _words(tokens)] +
+                                    [json.dumps({'event_type': 'stream-end', 'is_finished': True, 'finish_reason': 'COMPLETE', 'response': response}) + '\n'],
+                                    content_type='application/stream+json')
+            self._json(200, response)
+
+        def _huggingface(self, body):
+            tokens = (body.get('parameters') or {}).get('max_new_tokens') or server.config.tokens
+            if body.get('stream'):
+                words = _words(tokens)
+                return self._stream([f"data:{json.dumps({'token': {'text': t, 'special': False}, 'generated_text': None})}\n\n" for t in words[:-1]] +
+                                    [f"data:{json.dumps({'token': {'text': words[-1], 'special': False}, 'generated_text': ''.join(words)})}\n\n"])
+            inputs = body['inputs']
+            if isinstance(inputs, list):
+                return self._json(200, [[{'generated_text': _text(tokens)}] for _ in inputs])
+            generation = {'generated_text': _text(tokens)}
+            if (body.get('parameters') or {}).get('details'):
+                generation['details'] = {'finish_reason': 'length', 'generated_tokens': tokens,
+                                         'tokens': [{'text': t, 'logprob': -random.random()} for t in _words(tokens)]}
+            self._json(200, [generation])
+
+        def _cohere(self, body):
+            tokens = body.get('max_tokens') or server.config.tokens
+            if body.get('stream'):
+                return self._stream([json.dumps({'text': t, 'is_finished': False}) + '\n' for t in _words(tokens)] +
+                                    [json.dumps({'is_finished': True, 'finish_reason': 'COMPLETE'}) + '\n'],
+                                    content_type='application/stream+json')
+            generations = body.get('num_generations') or 1
+            self._json(200, {
+                'id': uuid.uuid4().hex,
+                'generations': [_cohere_generation(tokens, body.get('return_likelihoods') == 'GENERATION') for _ in range(generations)],
+            })
+
+        def _json(self, status: int, payload: Any, headers: Optional[Dict[str, str]] = None):
+            data = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _stream(self, events: List[str], content_type: str = 'text/event-stream'):
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for event in events:
+                data = event.encode('utf-8')
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+                self.wfile.flush()
+                if server.config.token_delay:
+                    time.sleep(server.config.token_delay)
+            self.wfile.write(b'0\r\n\r\n')
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def _words(tokens: int) -> List[str]:
+    return [' lorem'] * max(1, tokens)
+
+
+def _text(tokens: int) -> str:
+    return ''.join(_words(tokens))
+
+
+def _cohere_generation(tokens: int, likelihoods: bool) -> Dict[str, Any]:
+    generation = {'id': uuid.uuid4().hex, 'text': _text(tokens), 'finish_reason': 'MAX_TOKENS'}
+    if likelihoods:
+        generation['token_likelihoods'] = [{'token': word, 'likelihood': -random.random()} for word in _words(tokens)]
+        generation['likelihood'] = sum(token['likelihood'] for token in generation['token_likelihoods'])
+    return generation
+
+
+def _count(prompt: str) -> int:
+    return len(prompt) // 4 + 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.05, help='Mean seconds before a response starts.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Standard deviation of the latency in seconds.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with a 500.')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='Fraction of requests answered with a 429.')
+    parser.add_argument('--retry-after', type=float, default=0.1, help='Retry-After seconds sent with 429s.')
+    parser.add_argument('--tokens', type=int, default=16, help='Tokens per completion when max_tokens is not set.')
+    parser.add_argument('--token-delay', type=float, default=0.0, help='Seconds between two streamed tokens.')
+    args = parser.parse_args()
+
+    config = MockConfig(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                        rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after,
+                        tokens=args.tokens, token_delay=args.token_delay)
+    server = MockServer(config, host=args.host, port=args.port).start()
+    print(f'Mock provider APIs listening on {server.url}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
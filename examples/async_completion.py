@@ -0,0 +1,20 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import asyncio
+import openlm
+import json
+
+async def main():
+    # Requires `pip install openlm[async]` for native async HTTP.
+    # Without it, requests run in a worker thread.
+    completion = await openlm.Completion.acreate(
+        model=["ada", "huggingface.co/gpt2", "cohere.ai/command"],
+        prompt=["The quick brown fox", "Who jumped over the lazy dog?"],
+        max_tokens=15
+    )
+    print(json.dumps(completion, indent=4))
+
+asyncio.run(main())
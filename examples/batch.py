@@ -0,0 +1,24 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import json
+from openlm.batch import run_batch
+
+with open("prompts.jsonl", "w") as f:
+    for i in range(100):
+        f.write(json.dumps({"id": i, "prompt": f"Write a haiku about the number {i}."}) + "\n")
+
+# Rows already in results.jsonl are skipped, so running this again after an
+# interruption only completes the remaining rows.
+# The same job from the command line:
+#   openlm-batch prompts.jsonl results.jsonl -m ada -m cohere.ai/command --max-tokens 30
+summary = run_batch(
+    "prompts.jsonl",
+    "results.jsonl",
+    model=["ada", "cohere.ai/command"],
+    max_tokens=30,
+    progress=print,
+)
+print(json.dumps(summary, indent=4))
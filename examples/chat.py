@@ -0,0 +1,28 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import openlm
+
+messages = [
+    {"role": "system", "content": "You are a concise assistant."},
+    {"role": "user", "content": "What is the capital of France?"},
+]
+
+# gpt-3.5-turbo and command use their provider's chat endpoint,
+# ada gets the conversation as a prompt and its reply is cut at the next turn.
+completion = openlm.ChatCompletion.create(
+    model=["gpt-3.5-turbo", "cohere.ai/command", "ada"],
+    messages=messages,
+    max_tokens=30,
+)
+for choice in completion["choices"]:
+    print(f"{choice['model_name']}: {choice['message']['content']!r}")
+
+# Continue the conversation with one of the replies
+messages.append(completion["choices"][1]["message"])
+messages.append({"role": "user", "content": "And of Italy?"})
+for chunk in openlm.ChatCompletion.create(model="cohere.ai/command", messages=messages, max_tokens=30, stream=True):
+    print(chunk["choices"][0]["delta"].get("content", ""), end="", flush=True)
+print()
@@ -0,0 +1,23 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import openlm
+import json
+
+def prompts():
+    # Prompts are read lazily, so this could just as well stream lines from a large file
+    for i in range(1000):
+        yield f"Write a haiku about the number {i}."
+
+# Each choice is written out as soon as it completes, in completion order.
+# model_idx and index tell which model and prompt it belongs to.
+with open("completions.jsonl", "w") as f:
+    for choice in openlm.Completion.create_iter(
+        model=["ada", "cohere.ai/command"],
+        prompt=prompts(),
+        max_tokens=30,
+        max_pending=64
+    ):
+        f.write(json.dumps(choice) + "\n")
@@ -0,0 +1,21 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import openlm
+from openlm.llm import Local
+import json
+
+# A directory with the config.json, model.safetensors, vocab.json and merges.txt of a GPT-2 family model, e.g.
+# huggingface-cli download gpt2 config.json model.safetensors vocab.json merges.txt --local-dir ~/models/gpt2
+openlm.Completion.register(Local(["~/models/gpt2"]))
+
+# Concurrent prompts are generated together in the same forward passes
+completion = openlm.Completion.create(
+    model="local/gpt2",
+    prompt=["The quick brown fox", "Once upon a time"],
+    max_tokens=20,
+)
+
+print(json.dumps(completion, indent=4))
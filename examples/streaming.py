@@ -0,0 +1,17 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import openlm
+
+# Chunks from every model and prompt are merged into one stream as they arrive.
+# Each chunk is tagged with the model index and prompt index it belongs to.
+for chunk in openlm.Completion.create(
+    model=["ada", "cohere.ai/command"],
+    prompt=["The quick brown fox", "Who jumped over the lazy dog?"],
+    max_tokens=15,
+    stream=True,
+):
+    choice = chunk["choices"][0]
+    print(f"[{choice['model_name']} #{choice['index']}] {choice['text']!r}")
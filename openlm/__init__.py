@@ -1,5 +1,14 @@
 from openlm.openlm import Completion
-from openlm.llm.base import BaseModel
+from openlm.chat import ChatCompletion
+from openlm.llm.base import BaseChatModel, BaseModel
+from openlm.cache import BaseCache, MemoryCache, SQLiteCache
+from openlm.semantic_cache import BaseEmbedder, HashingEmbedder, SemanticCache
+from openlm.instrumentation import CallRecord, Metrics
+from openlm.ratelimit import RateLimit
+from openlm.adaptive import AdaptiveLimit
+from openlm.fair import FairScheduler, TenantPolicy
+from openlm.retry import RetryPolicy
+from openlm.tokenizers import BaseTokenizer, ByteTokenizer, register_tokenizer
 
 # For backwards compatibility with OpenAI
 api_key = None
\ No newline at end of file
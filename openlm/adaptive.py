@@ -0,0 +1,189 @@
+import asyncio
+import collections
+import math
+import sys
+import threading
+import time
+from typing import Any, Deque, Dict, List, Optional
+
+from openlm.concurrency import Limiter
+from openlm.llm.base import ProviderError
+
+
+def is_overload(error: BaseException) -> bool:
+    """
+    Whether an error means the provider is over capacity: a 429 or 5xx response, a timeout or a failed connection.
+    Errors caused by the request itself, like a 400, say nothing about capacity.
+    """
+    if isinstance(error, ProviderError):
+        return error.status_code is not None and (error.status_code == 429 or error.status_code >= 500)
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    requests = sys.modules.get('requests')
+    if requests is not None and isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    aiohttp = sys.modules.get('aiohttp')
+    return aiohttp is not None and isinstance(error, aiohttp.ClientConnectionError)
+
+
+class AdaptiveLimit():
+    """
+    Finds how many concurrent requests a provider can take with additive increase and multiplicative decrease, like
+    TCP congestion control. While the limit is in use and latency stays within tolerance of the baseline, the latency
+    without load, the limit grows by `increase` per round trip. Latency above tolerance times the baseline, a 429 or 5xx response,
+    a timeout or a failed connection multiplies it by `decrease`, at most once per round trip.
+
+    Latency is compared per completion token when calls report their usage, so a run of long completions
+    doesn't look like the provider slowing down.
+
+    :param initial: The limit to start from.
+    :param min_limit: The lowest the limit goes.
+    :param max_limit: The highest the limit goes. Completion's max_workers and max_in_flight still apply on top.
+    :param increase: The number of requests the limit grows by per round trip.
+    :param decrease: The factor the limit is multiplied by when backing off.
+    :param tolerance: How many times the baseline latency the smoothed latency can reach before backing off.
+    :param drift: The fraction of the way the baseline rises toward higher latencies per round trip. It drops to a lower
+        latency right away, so it tracks the latency without load rather than following load up.
+    :param smoothing: The weight of each new latency in the smoothed latency, from 0 to 1.
+    :param history: The number of recent decisions kept for inspection.
+    """
+    def __init__(self, initial: int = 4,
+                       min_limit: int = 1,
+                       max_limit: int = 128,
+                       increase: float = 1.0,
+                       decrease: float = 0.7,
+                       tolerance: float = 2.0,
+                       drift: float = 0.01,
+                       smoothing: float = 0.2,
+                       history: int = 100):
+        if not 1 <= min_limit <= initial <= max_limit:
+            raise ValueError(f"Expected 1 <= min_limit <= initial <= max_limit, got {min_limit}, {initial}, {max_limit}")
+        if not 0 < decrease < 1:
+            raise ValueError(f"decrease must be between 0 and 1, got {decrease}")
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.drift = drift
+        self.smoothing = smoothing
+        self.limiter = Limiter(initial)
+        self.baseline_latency: Optional[float] = None
+        self.smoothed_latency: Optional[float] = None
+        # The smoothed duration of whole calls, which is how long a round trip takes
+        self.round_trip: Optional[float] = None
+        self.increases = 0
+        self.decreases = 0
+        # The most recent changes of the limit, oldest first
+        self.decisions: Deque[Dict[str, Any]] = collections.deque(maxlen=history)
+        self._limit = float(initial)
+        self._last_decrease = -math.inf
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self) -> int:
+        return self.limiter.limit
+
+    def __getstate__(self):
+        # A copy in a worker process starts from the current limit and adapts on its own
+        state = self.__dict__.copy()
+        del state['_lock'], state['limiter']
+        state['decisions'] = collections.deque(self.decisions, maxlen=self.decisions.maxlen)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.limiter = Limiter(max(self.min_limit, int(self._limit)))
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, error: Optional[BaseException] = None, tokens: Optional[float] = None):
+        """
+        Adjusts the limit after a request that took seconds, and failed with error if given.
+
+        :param tokens: The number of tokens the request completed. Latency is then seconds per token, and requests
+            that completed none are only counted toward the round trip.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self.round_trip = seconds if self.round_trip is None else self.round_trip + self.smoothing * (seconds - self.round_trip)
+            if error is not None:
+                if is_overload(error):
+                    status_code = getattr(error, 'status_code', None)
+                    self._back_off(now, seconds, f"status {status_code}" if status_code is not None else type(error).__name__)
+                return
+            if tokens is not None:
+                if tokens <= 0:
+                    return
+                seconds /= tokens
+            if self.smoothed_latency is None:
+                self.baseline_latency = self.smoothed_latency = seconds
+            else:
+                # About limit requests complete per round trip
+                self.baseline_latency = min(seconds, self.baseline_latency + self.drift / self._limit * (seconds - self.baseline_latency))
+                self.smoothed_latency += self.smoothing * (seconds - self.smoothed_latency)
+            if self.smoothed_latency > self.tolerance * self.baseline_latency:
+                self._back_off(now, seconds, 'latency')
+            elif self.limiter.in_flight >= self.limiter.limit or self.limiter.waiting:
+                # Only grows while the limit is what holds requests back, so an idle provider's limit doesn't run away.
+                # The limit completes about limit requests per round trip, hence increase / limit per request.
+                self._limit = min(float(self.max_limit), self._limit + self.increase / self._limit)
+                self._apply('increase', 'latency flat', seconds)
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            decisions: List[Dict[str, Any]] = list(self.decisions)
+        return {
+            'limit': self.limit,
+            'in_flight': self.limiter.in_flight,
+            'waiting': self.limiter.waiting,
+            'baseline_latency': self.baseline_latency,
+            'smoothed_latency': self.smoothed_latency,
+            'round_trip': self.round_trip,
+            'increases': self.increases,
+            'decreases': self.decreases,
+            'decisions': decisions,
+        }
+
+    def _back_off(self, now: float, seconds: float, reason: str):
+        # Requests that were already in flight when the limit dropped report the same overload, so they don't count again
+        if now - self._last_decrease < self.round_trip:
+            return
+        self._last_decrease = now
+        self._limit = max(float(self.min_limit), self._limit * self.decrease)
+        self._apply('decrease', reason, seconds)
+
+    def _apply(self, action: str, reason: str, seconds: float):
+        limit = max(self.min_limit, int(self._limit))
+        if limit == self.limiter.limit:
+            return
+        previous = self.limiter.limit
+        self.limiter.set_limit(limit)
+        if action == 'increase':
+            self.increases += 1
+        else:
+            self.decreases += 1
+        self.decisions.append({
+            'time': time.time(),
+            'action': action,
+            'reason': reason,
+            'from': previous,
+            'to': limit,
+            'latency': seconds,
+            'smoothed_latency': self.smoothed_latency,
+            'baseline_latency': self.baseline_latency,
+        })
+
+
+def prometheus(limits: Dict[str, AdaptiveLimit], prefix: str = 'openlm') -> str:
+    """
+    Exports the adaptive limits of every provider namespace in the Prometheus text format.
+    """
+    if not limits:
+        return ''
+    lines = [f"# TYPE {prefix}_adaptive_limit gauge"]
+    lines += [f'{prefix}_adaptive_limit{{namespace="{namespace}"}} {limit.limit}' for namespace, limit in limits.items()]
+    lines.append(f"# TYPE {prefix}_adaptive_in_flight gauge")
+    lines += [f'{prefix}_adaptive_in_flight{{namespace="{namespace}"}} {limit.limiter.in_flight}' for namespace, limit in limits.items()]
+    lines.append(f"# TYPE {prefix}_adaptive_decreases_total counter")
+    lines += [f'{prefix}_adaptive_decreases_total{{namespace="{namespace}"}} {limit.decreases}' for namespace, limit in limits.items()]
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,266 @@
+import argparse
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+from openlm.openlm import Completion
+
+
+class BatchStats():
+    """
+    Counts the rows, errors and tokens of a batch job per provider namespace, to report throughput.
+    """
+    def __init__(self):
+        self.started = time.monotonic()
+        # Rows found in the output file when resuming
+        self.skipped = 0
+        self._providers: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, fqn: str, choice: Dict[str, Any]):
+        namespace = fqn.split('/', 1)[0]
+        with self._lock:
+            counts = self._providers.setdefault(namespace, {'rows': 0, 'errors': 0, 'tokens': 0})
+            counts['rows'] += 1
+            if 'error' in choice:
+                counts['errors'] += 1
+            counts['tokens'] += (choice.get('usage') or {}).get('total_tokens', 0)
+
+    def summary(self) -> Dict[str, Any]:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        with self._lock:
+            providers = {namespace: dict(counts) for namespace, counts in self._providers.items()}
+        for counts in providers.values():
+            counts['rows_per_second'] = counts['rows'] / elapsed
+            counts['tokens_per_second'] = counts['tokens'] / elapsed
+        return {
+            'elapsed': elapsed,
+            'skipped': self.skipped,
+            'rows': sum(counts['rows'] for counts in providers.values()),
+            'errors': sum(counts['errors'] for counts in providers.values()),
+            'providers': providers,
+        }
+
+
+def run_batch(input_path: str, output_path: str, model: Union[str, List[str]],
+              resume: bool = True,
+              retry_errors: bool = False,
+              max_pending: Optional[int] = None,
+              progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+              progress_interval: float = 10.0,
+              **params) -> Dict[str, Any]:
+    """
+    Completes every prompt of a JSONL file on every model and appends the results to a JSONL file as they complete.
+
+    Each input line is an object with a "prompt" and an optional "id", which defaults to the line number.
+    Each output line is the choice for one (id, model) pair, with the row's id in place of the choice id.
+    With n, there are n output lines per pair, told apart by their "sample".
+
+    The output file doubles as the checkpoint: when resuming, rows already written are skipped,
+    so an interrupted job picks up where it stopped without paying for finished rows again.
+
+    :param input_path: The JSONL file to read prompts from.
+    :param output_path: The JSONL file to append results to.
+    :param model: The ID(s) of the model(s) to use.
+    :param resume: Whether to skip rows already in the output file. Otherwise the output file is overwritten.
+    :param retry_errors: Whether to run rows again that were written with an error. The new result is appended after the old one.
+    :param max_pending: The maximum number of upstream calls outstanding per model.
+    :param progress: Called with the current throughput summary every progress_interval seconds.
+    :param progress_interval: The number of seconds between two progress calls.
+    :param params: Completion parameters passed to Completion.create_iter, e.g. max_tokens or temperature.
+    :return: The final throughput summary.
+    """
+    if isinstance(model, str):
+        model = [model]
+    Completion._register_defaults()
+    fqns = [Completion._resolve(m) for m in model]
+
+    stats = BatchStats()
+    n = params.get('n') or 1
+
+    done: Set[Tuple[str, str]] = set()
+    if resume and os.path.exists(output_path):
+        done = _load_checkpoint(output_path, retry_errors, n)
+        stats.skipped = len(done)
+
+    results = queue.Queue()
+    stopped = threading.Event()
+
+    def run(m, fqn):
+        # Maps positions in this model's prompt stream back to row ids and the number of samples still to come,
+        # only for rows in flight
+        ids: Dict[int, List[Any]] = {}
+
+        def prompts():
+            position = 0
+            for row_id, prompt in _read_rows(input_path):
+                if (_key(row_id), fqn) not in done:
+                    ids[position] = [row_id, n]
+                    position += 1
+                    yield prompt
+
+        try:
+            choices = Completion.create_iter(model=m, prompt=prompts(), max_pending=max_pending, **params)
+            try:
+                for choice in choices:
+                    if stopped.is_set():
+                        return
+                    position, sample = divmod(choice['index'], n)
+                    row = ids[position]
+                    row[1] -= 1
+                    if not row[1]:
+                        del ids[position]
+                    results.put((row[0], fqn, choice if n == 1 else {**choice, 'sample': sample}))
+            finally:
+                choices.close()
+        except BaseException as e:
+            results.put(e)
+        finally:
+            results.put(None)
+
+    workers = [threading.Thread(target=run, args=(m, fqn), daemon=True) for m, fqn in zip(model, fqns)]
+    for worker in workers:
+        worker.start()
+
+    last_report = time.monotonic()
+    with open(output_path, 'a' if resume else 'w', encoding='utf-8') as f:
+        try:
+            running = len(workers)
+            while running:
+                try:
+                    result = results.get(timeout=progress_interval if progress is not None else None)
+                except queue.Empty:
+                    result = ()
+                if result is None:
+                    running -= 1
+                elif isinstance(result, BaseException):
+                    raise result
+                elif result:
+                    row_id, fqn, choice = result
+                    f.write(json.dumps(_output_row(row_id, choice)) + '\n')
+                    f.flush()
+                    stats.record(fqn, choice)
+                if progress is not None and time.monotonic() - last_report >= progress_interval:
+                    progress(stats.summary())
+                    last_report = time.monotonic()
+        finally:
+            stopped.set()
+    return stats.summary()
+
+
+def _read_rows(path: str) -> Iterator[Tuple[Any, str]]:
+    with open(path, encoding='utf-8') as f:
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            if 'prompt' not in row:
+                raise ValueError(f"{path}:{line_no}: row has no prompt")
+            yield row.get('id', line_no), row['prompt']
+
+
+def _load_checkpoint(path: str, retry_errors: bool, n: int = 1) -> Set[Tuple[str, str]]:
+    """
+    Reads the (id, model) pairs already written to an output file with all n of their samples. A line cut off by a crash
+    is truncated, so appending starts on a clean line, and the lines of pairs with only some of their samples written are
+    dropped, since those pairs are run again.
+    """
+    # Whether the latest line of each sample of each pair is an error
+    samples: Dict[Tuple[str, str], Dict[int, bool]] = {}
+    valid = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                row = json.loads(line)
+            except ValueError:
+                break
+            valid += len(line)
+            samples.setdefault((_key(row['id']), row['model_name']), {})[row.get('sample', 0)] = 'error' in row
+    partial = {pair for pair, written in samples.items() if len(written) < n}
+    if partial:
+        _drop_rows(path, valid, partial)
+    elif valid < os.path.getsize(path):
+        with open(path, 'r+b') as f:
+            f.truncate(valid)
+    return {pair for pair, written in samples.items() if pair not in partial and not (retry_errors and any(written.values()))}
+
+
+def _drop_rows(path: str, size: int, pairs: Set[Tuple[str, str]]):
+    """
+    Rewrites the first size bytes of an output file without the lines of pairs.
+    """
+    tmp_path = path + '.tmp'
+    with open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+        read = 0
+        for line in src:
+            read += len(line)
+            if read > size:
+                break
+            row = json.loads(line)
+            if (_key(row['id']), row['model_name']) not in pairs:
+                dst.write(line)
+    os.replace(tmp_path, path)
+
+
+def _key(row_id: Any) -> str:
+    # Keeps ids like 1 and "1" apart
+    return json.dumps(row_id)
+
+
+def _output_row(row_id: Any, choice: Dict[str, Any]) -> Dict[str, Any]:
+    row = {'id': row_id}
+    row.update((k, v) for k, v in choice.items() if k not in ('id', 'index', 'model_idx'))
+    return row
+
+
+def _print_progress(summary: Dict[str, Any]):
+    print(f"{summary['rows']} rows ({summary['errors']} errors, {summary['skipped']} skipped) in {summary['elapsed']:.0f}s",
+          file=sys.stderr)
+    for namespace, counts in sorted(summary['providers'].items()):
+        print(f"  {namespace}: {counts['rows_per_second']:.2f} rows/s, {counts['tokens_per_second']:.1f} tokens/s", file=sys.stderr)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog='openlm-batch', description='Complete the prompts of a JSONL file on one or more models.')
+    parser.add_argument('input', help='JSONL file with one {"id": ..., "prompt": ...} object per line')
+    parser.add_argument('output', help='JSONL file to append results to. Rows already in it are skipped.')
+    parser.add_argument('-m', '--model', action='append', required=True, help='Model to use. Can be repeated.')
+    parser.add_argument('--max-tokens', type=int)
+    parser.add_argument('--temperature', type=float)
+    parser.add_argument('--top-p', type=float)
+    parser.add_argument('--stop', action='append', help='Stop sequence. Can be repeated.')
+    parser.add_argument('-n', type=int, help='Number of completions per prompt.')
+    parser.add_argument('--best-of', type=int, help='Number of completions to draw per prompt, keeping the best n.')
+    parser.add_argument('--max-pending', type=int, help='Maximum number of upstream calls outstanding per model.')
+    parser.add_argument('--no-resume', dest='resume', action='store_false', help='Overwrite the output file instead of resuming.')
+    parser.add_argument('--retry-errors', action='store_true', help='Run rows again that were written with an error.')
+    parser.add_argument('--progress-interval', type=float, default=10.0, help='Seconds between two throughput reports.')
+    parser.add_argument('--processes', type=int, help='Number of worker processes to shard prompts across.')
+    args = parser.parse_args(argv)
+
+    if args.processes:
+        Completion.configure(processes=args.processes)
+
+    summary = run_batch(args.input, args.output, args.model,
+                        resume=args.resume,
+                        retry_errors=args.retry_errors,
+                        max_pending=args.max_pending,
+                        progress=_print_progress,
+                        progress_interval=args.progress_interval,
+                        max_tokens=args.max_tokens,
+                        temperature=args.temperature,
+                        top_p=args.top_p,
+                        stop=args.stop,
+                        n=args.n,
+                        best_of=args.best_of)
+    _print_progress(summary)
+
+
+if __name__ == '__main__':
+    main()
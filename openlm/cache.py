@@ -0,0 +1,191 @@
+import abc
+import collections
+import copy
+import hashlib
+import json
+import threading
+import time
+from typing import Any, Dict, Optional
+
+
+def cache_key(fqn: str, prompt: str, params: Dict[str, Any]) -> str:
+    """
+    Builds a stable key for a completion from the fully qualified model name, the prompt and
+    every parameter that affects generation.
+    """
+    params = {k: v for k, v in params.items() if v is not None and k not in ('user', 'stream')}
+    canonical = json.dumps([fqn, prompt, params], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def is_deterministic(params: Dict[str, Any]) -> bool:
+    """
+    Only greedy sampling is guaranteed to give the same completion for the same request.
+    """
+    return params.get('temperature') == 0
+
+
+class BaseCache(metaclass=abc.ABCMeta):
+    """
+    A cache of provider responses. Subclasses implement the storage, this class keeps hit/miss stats.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self._get(key)
+        with self._stats_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value: Dict[str, Any]):
+        self._set(key, value)
+
+    def __getstate__(self):
+        # Locks and connections can't be pickled, so a copy in a worker process makes its own
+        state = self.__dict__.copy()
+        for name in ('_stats_lock', '_lock', '_conn'):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._stats_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'size': len(self),
+        }
+
+    @abc.abstractmethod
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _set(self, key: str, value: Dict[str, Any]):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def clear(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+
+class MemoryCache(BaseCache):
+    """
+    An in-memory cache that evicts the least recently used entry once maxsize is reached.
+
+    :param maxsize: The maximum number of entries to keep.
+    :param ttl: The number of seconds an entry stays valid, or None to keep entries until evicted.
+    """
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        super().__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "collections.OrderedDict[str, tuple]" = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return copy.deepcopy(value)
+
+    def _set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (expires, copy.deepcopy(value))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCache(BaseCache):
+    """
+    An on-disk cache backed by sqlite, so responses survive restarts and can be shared between processes.
+
+    :param path: The path of the sqlite database file.
+    :param maxsize: The maximum number of entries to keep, evicting the least recently used first.
+    :param ttl: The number of seconds an entry stays valid, or None to keep entries until evicted.
+    """
+    def __init__(self, path: str = 'openlm_cache.sqlite', maxsize: Optional[int] = None, ttl: Optional[float] = None):
+        super().__init__()
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connect()
+
+    def _connect(self):
+        import sqlite3
+
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS completions '
+                           '(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed)')
+
+    def _get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT value, created FROM completions WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            value, created = row
+            if self.ttl is not None and created + self.ttl < now:
+                self._conn.execute('DELETE FROM completions WHERE key = ?', (key,))
+                return None
+            self._conn.execute('UPDATE completions SET accessed = ? WHERE key = ?', (now, key))
+        return json.loads(value)
+
+    def _set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO completions (key, value, created, accessed) VALUES (?, ?, ?, ?)',
+                               (key, json.dumps(value), now, now))
+            if self.maxsize is not None:
+                self._conn.execute('DELETE FROM completions WHERE key IN '
+                                   '(SELECT key FROM completions ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.maxsize,))
+
+    def __setstate__(self, state):
+        # Processes share the entries through the database file
+        super().__setstate__(state)
+        self._connect()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM completions')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM completions').fetchone()[0]
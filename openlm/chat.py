@@ -0,0 +1,498 @@
+import asyncio
+import concurrent.futures
+import json
+import queue
+import threading
+import time
+import uuid
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple, Union
+
+from openlm.fair import INTERACTIVE, scheduled
+from openlm.llm.base import CHAT_ROLES
+from openlm.llm.http import reset_deadline, set_deadline
+from openlm.openlm import Completion
+from openlm.ratelimit import estimate_tokens
+from openlm.tokenizers import get_tokenizer
+
+# Parameters of the completion endpoint that chat doesn't take
+_COMPLETION_ONLY = dict(suffix=None, stream=None, logprobs=None, echo=None, best_of=None)
+
+
+class ChatCompletion():
+    """
+    OpenAI-compatible chat completion API.
+
+    Messages are sent in each provider's native chat format where it has a chat endpoint, and formatted as a prompt
+    with the provider's format_chat for models that only complete text. Providers, the executor, concurrency limits,
+    rate limits, retries, the response cache and metrics are the ones of Completion.
+    """
+    @classmethod
+    def create(cls, model: Union[str, List[str]], messages: List[Dict[str, str]],
+                                max_tokens: Optional[int] = None,
+                                temperature: Optional[float] = None,
+                                top_p: Optional[float] = None,
+                                n: Optional[int] = None,
+                                stream: Optional[bool] = None,
+                                stop: Optional[Union[str, List[str]]] = None,
+                                presence_penalty: Optional[float] = None,
+                                frequency_penalty: Optional[float] = None,
+                                logit_bias: Optional[Dict[str, float]] = None,
+                                user: Optional[str] = None,
+                                api_keys: Optional[Dict[str, str]] = None,
+                                request_timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Continues the conversation with every model in parallel. Returns one choice per model and sample,
+        each with the assistant's 'message', or an iterator of 'chat.completion.chunk' events when stream is set.
+
+        :param model: The model or list of models to chat with.
+        :param messages: The conversation so far, dictionaries with a 'role' of system, user or assistant and a 'content'.
+        :param request_timeout: The number of seconds to wait for all replies. Replies still running are returned as timed out.
+        """
+        Completion._register_defaults(api_keys)
+        if isinstance(model, str):
+            model = [model]
+        params = dict(max_tokens=max_tokens, temperature=temperature, top_p=top_p, n=n, stop=stop,
+                      presence_penalty=presence_penalty, frequency_penalty=frequency_penalty, logit_bias=logit_bias, user=user)
+        cls._check(model, messages, params)
+        deadline = time.monotonic() + request_timeout if request_timeout else None
+
+        if stream:
+            return cls._stream(model, messages, params, deadline)
+
+        executor = Completion._get_executor()
+        futures = []
+        with scheduled(params['user'], INTERACTIVE):
+            for model_idx, m in enumerate(model):
+                native = cls._resolve(m)[1]
+                for sample, call in cls._sample_calls(m, params):
+                    future = executor.submit(cls._generate if native else cls._complete, m, messages, call, deadline, sample)
+                    futures.append((future, model_idx, m, call['n'] or 1))
+
+        concurrent.futures.wait([future for future, _, _, _ in futures], timeout=Completion._remaining(deadline))
+
+        choices = []
+        for future, model_idx, m, count in futures:
+            if future.done():
+                choices.extend(future.result())
+            else:
+                future.cancel()
+                choices.extend(cls._timeout_choice(m) for _ in range(count))
+        return cls._build_response(Completion._tag_choices(choices, 1, params['n'] or 1))
+
+    @classmethod
+    async def acreate(cls, model: Union[str, List[str]], messages: List[Dict[str, str]],
+                                max_tokens: Optional[int] = None,
+                                temperature: Optional[float] = None,
+                                top_p: Optional[float] = None,
+                                n: Optional[int] = None,
+                                stream: Optional[bool] = None,
+                                stop: Optional[Union[str, List[str]]] = None,
+                                presence_penalty: Optional[float] = None,
+                                frequency_penalty: Optional[float] = None,
+                                logit_bias: Optional[Dict[str, float]] = None,
+                                user: Optional[str] = None,
+                                api_keys: Optional[Dict[str, str]] = None,
+                                request_timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Async version of create. With stream, returns an async iterator of chunks.
+        """
+        Completion._register_defaults(api_keys)
+        if isinstance(model, str):
+            model = [model]
+        params = dict(max_tokens=max_tokens, temperature=temperature, top_p=top_p, n=n, stop=stop,
+                      presence_penalty=presence_penalty, frequency_penalty=frequency_penalty, logit_bias=logit_bias, user=user)
+        cls._check(model, messages, params)
+        deadline = time.monotonic() + request_timeout if request_timeout else None
+
+        if stream:
+            return cls._astream(model, messages, params, deadline)
+
+        tasks = []
+        with scheduled(params['user'], INTERACTIVE):
+            for model_idx, m in enumerate(model):
+                native = cls._resolve(m)[1]
+                for sample, call in cls._sample_calls(m, params):
+                    task = asyncio.ensure_future((cls._agenerate if native else cls._acomplete)(m, messages, call, deadline, sample))
+                    tasks.append((task, model_idx, m, call['n'] or 1))
+
+        try:
+            await asyncio.wait([task for task, _, _, _ in tasks], timeout=Completion._remaining(deadline))
+        finally:
+            for task, _, _, _ in tasks:
+                task.cancel()
+
+        choices = []
+        for task, model_idx, m, count in tasks:
+            if task.done() and not task.cancelled():
+                choices.extend(task.result())
+            else:
+                choices.extend(cls._timeout_choice(m) for _ in range(count))
+        return cls._build_response(Completion._tag_choices(choices, 1, params['n'] or 1))
+
+    @classmethod
+    def list_models(cls) -> Dict[str, List[str]]:
+        """
+        Returns the aliases of every model with a native chat endpoint, by fully qualified name.
+        Every completion model can be chatted with too.
+        """
+        models: Dict[str, List[str]] = {}
+        for alias, fqn in Completion.chat_aliases.items():
+            models.setdefault(fqn, []).append(alias)
+        return models
+
+    @classmethod
+    def _check(cls, model: List[str], messages: List[Dict[str, str]], params: Dict[str, Any]):
+        if not messages:
+            raise ValueError("messages must not be empty")
+        for message in messages:
+            if not isinstance(message, dict) or 'role' not in message or 'content' not in message:
+                raise ValueError(f"Each message needs a role and a content, got {message!r}")
+        if params['n'] is not None and params['n'] < 1:
+            raise ValueError("n must be at least 1")
+        # Fail fast on unknown models before any request is started
+        for m in model:
+            cls._resolve(m)
+
+    @classmethod
+    def _resolve(cls, model: str) -> Tuple[str, bool]:
+        """
+        Returns the fully qualified name of a model and whether it has a native chat endpoint.
+        """
+        fqn = Completion.chat_aliases.get(model)
+        if fqn is not None:
+            return fqn, True
+        if model in Completion._chat_ambiguous:
+            raise ValueError(f"Model {model} is ambiguous, it could be any of {', '.join(Completion._chat_ambiguous[model])}. Use the fully qualified name instead.")
+        return Completion._resolve(model), False
+
+    @classmethod
+    def _sample_calls(cls, model: str, params: Dict[str, Any]) -> List[Tuple[int, Dict[str, Any]]]:
+        """
+        Splits the n samples of a model into upstream calls, as (first sample, params) pairs.
+        Models chatted with through their completion endpoint get the completion parameters.
+        """
+        fqn, native = cls._resolve(model)
+        if not native:
+            return Completion._sample_calls(fqn, {**params, **_COMPLETION_ONLY})
+        n = params['n'] or 1
+        if n == 1:
+            return [(0, params)]
+        size = max(1, Completion.chat_models[fqn].max_chat_samples)
+        return [(start, {**params, 'n': min(size, n - start)}) for start in range(0, n, size)]
+
+    @classmethod
+    def _transcript(cls, messages: List[Dict[str, str]]) -> str:
+        # What token estimates and usage counting see of a conversation sent natively
+        return '\n'.join(message['content'] for message in messages)
+
+    @classmethod
+    def _key(cls, fqn: str, messages: List[Dict[str, str]], params: Dict[str, Any], sample: int) -> str:
+        # Marked as chat, so a conversation never shares a cache entry with a completion of the same text
+        return Completion._sample_key(fqn, json.dumps(messages, sort_keys=True), {**params, 'chat': True}, sample)
+
+    @classmethod
+    def _generate(cls, model: str, messages: List[Dict[str, str]], params: Dict[str, Any],
+                  deadline: Optional[float] = None, sample: int = 0) -> List[Dict[str, Any]]:
+        fqn = cls._resolve(model)[0]
+        provider = Completion.chat_models[fqn]
+        namespace = provider.namespace()
+        prompt = cls._transcript(messages)
+        key = cls._key(fqn, messages, params, sample)
+        ret = Completion._cache_get(key, params)
+        if ret is None:
+            def generate():
+                try:
+                    ret = Completion._call(fqn, estimate_tokens(prompt, params, get_tokenizer(fqn).count),
+                        lambda: Completion._with_usage(fqn, prompt,
+                            provider.create_chat_completion(model=fqn[len(namespace)+1:], messages=messages, **params)),
+                        namespace=namespace)
+                except Exception as e:
+                    ret = {
+                        'error': f"Error: {e}"
+                    }
+                Completion._cache_set(key, params, ret)
+                return ret
+
+            token = set_deadline(deadline)
+            try:
+                ret = Completion._flights.do(key, generate) if Completion._should_coalesce(params) else generate()
+            finally:
+                reset_deadline(token)
+        return [cls._chat_choice(choice) for choice in Completion._as_list(Completion._build_choices(fqn, ret, params['n']))]
+
+    @classmethod
+    async def _agenerate(cls, model: str, messages: List[Dict[str, str]], params: Dict[str, Any],
+                         deadline: Optional[float] = None, sample: int = 0) -> List[Dict[str, Any]]:
+        """
+        Async version of _generate.
+        """
+        fqn = cls._resolve(model)[0]
+        provider = Completion.chat_models[fqn]
+        namespace = provider.namespace()
+        prompt = cls._transcript(messages)
+        key = cls._key(fqn, messages, params, sample)
+        ret = Completion._cache_get(key, params)
+        if ret is None:
+            async def call():
+                return Completion._with_usage(fqn, prompt,
+                    await provider.acreate_chat_completion(model=fqn[len(namespace)+1:], messages=messages, **params))
+
+            async def generate():
+                try:
+                    ret = await Completion._acall(fqn, estimate_tokens(prompt, params, get_tokenizer(fqn).count), call,
+                                                  namespace=namespace)
+                except Exception as e:
+                    ret = {
+                        'error': f"Error: {e}"
+                    }
+                Completion._cache_set(key, params, ret)
+                return ret
+
+            token = set_deadline(deadline)
+            try:
+                ret = await Completion._flights.ado(key, generate) if Completion._should_coalesce(params) else await generate()
+            finally:
+                reset_deadline(token)
+        return [cls._chat_choice(choice) for choice in Completion._as_list(Completion._build_choices(fqn, ret, params['n']))]
+
+    @classmethod
+    def _as_completion(cls, model: str, messages: List[Dict[str, str]], params: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+        """
+        Returns the prompt and completion parameters that chat with a model through its completion endpoint.
+        The completion stops where the model starts writing the user's next turn.
+        """
+        fqn = cls._resolve(model)[0]
+        provider = Completion.models[fqn]
+        prompt = provider.format_chat(fqn[len(provider.namespace())+1:], messages)
+        stop = params['stop']
+        stop = [stop] if isinstance(stop, str) else list(stop or [])
+        # OpenAI takes at most 4 stop sequences. The reply is cut at the next turn either way.
+        return prompt, {**params, 'stop': (stop + [f"\n{CHAT_ROLES['user']}:"])[:4]}
+
+    @classmethod
+    def _complete(cls, model: str, messages: List[Dict[str, str]], params: Dict[str, Any],
+                  deadline: Optional[float] = None, sample: int = 0) -> List[Dict[str, Any]]:
+        prompt, params = cls._as_completion(model, messages, params)
+        choices = Completion._generate_completion(model, prompt, **params, deadline=deadline, sample=sample)
+        return [cls._chat_choice(choice, formatted=True) for choice in Completion._as_list(choices)]
+
+    @classmethod
+    async def _acomplete(cls, model: str, messages: List[Dict[str, str]], params: Dict[str, Any],
+                         deadline: Optional[float] = None, sample: int = 0) -> List[Dict[str, Any]]:
+        prompt, params = cls._as_completion(model, messages, params)
+        choices = await Completion._agenerate_completion(model, prompt, **params, deadline=deadline, sample=sample)
+        return [cls._chat_choice(choice, formatted=True) for choice in Completion._as_list(choices)]
+
+    @classmethod
+    def _chat_choice(cls, choice: Dict[str, Any], formatted: bool = False) -> Dict[str, Any]:
+        """
+        Turns a completion choice into a chat choice, with the text as the assistant's message.
+        Replies to formatted prompts are cut where the model starts another turn.
+        """
+        choice = dict(choice)
+        text = choice.pop('text', None)
+        if text is not None:
+            if formatted:
+                text = _TurnCutter().feed(text, final=True)[0].strip()
+            choice['message'] = {'role': 'assistant', 'content': text}
+        return choice
+
+    @classmethod
+    def _timeout_choice(cls, model: str) -> Dict[str, Any]:
+        return Completion._build_choice(cls._resolve(model)[0], {'error': "Error: Request timed out"})
+
+    @classmethod
+    def _build_response(cls, choices: List[Dict[str, Any]]) -> Dict[str, Any]:
+        return {**Completion._build_response(choices), 'object': 'chat.completion'}
+
+    @classmethod
+    def _stream(cls, model: List[str], messages: List[Dict[str, str]], params: Dict[str, Any],
+                deadline: Optional[float] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Streams every (model, sample) in parallel and yields their chunks in the order they arrive.
+        Streams still running at the deadline end with a timeout error chunk.
+        """
+        response_id, created = str(uuid.uuid4()), int(time.time())
+        chunks = queue.Queue()
+        closed = threading.Event()
+
+        def run(model_idx, index, m):
+            token = set_deadline(deadline)
+            try:
+                first = True
+                for fqn, chunk in cls._generate_stream(m, messages, params):
+                    if closed.is_set():
+                        return
+                    chunks.put(cls._build_chunk(response_id, created, fqn, model_idx, index, chunk, first))
+                    first = False
+            finally:
+                reset_deadline(token)
+                chunks.put((model_idx, index))
+
+        n = params['n'] or 1
+        params = {**params, 'n': None}
+        executor = Completion._get_executor()
+        pending = {}
+        with scheduled(params['user'], INTERACTIVE):
+            for model_idx, m in enumerate(model):
+                for index in range(n):
+                    executor.submit(run, model_idx, index, m)
+                    pending[model_idx, index] = m
+        try:
+            while pending:
+                try:
+                    chunk = chunks.get(timeout=Completion._remaining(deadline))
+                except queue.Empty:
+                    for (model_idx, index), m in pending.items():
+                        yield cls._timeout_chunk(response_id, created, m, model_idx, index)
+                    return
+                if isinstance(chunk, tuple):
+                    del pending[chunk]
+                else:
+                    yield chunk
+        finally:
+            closed.set()
+
+    @classmethod
+    async def _astream(cls, model: List[str], messages: List[Dict[str, str]], params: Dict[str, Any],
+                       deadline: Optional[float] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Async version of _stream.
+        """
+        response_id, created = str(uuid.uuid4()), int(time.time())
+        chunks = asyncio.Queue()
+
+        async def run(model_idx, index, m):
+            set_deadline(deadline)
+            try:
+                first = True
+                async for fqn, chunk in cls._agenerate_stream(m, messages, params):
+                    await chunks.put(cls._build_chunk(response_id, created, fqn, model_idx, index, chunk, first))
+                    first = False
+            finally:
+                chunks.put_nowait((model_idx, index))
+
+        n = params['n'] or 1
+        params = {**params, 'n': None}
+        tasks = []
+        pending = {}
+        with scheduled(params['user'], INTERACTIVE):
+            for model_idx, m in enumerate(model):
+                for index in range(n):
+                    tasks.append(asyncio.ensure_future(run(model_idx, index, m)))
+                    pending[model_idx, index] = m
+        try:
+            while pending:
+                try:
+                    chunk = await asyncio.wait_for(chunks.get(), timeout=Completion._remaining(deadline))
+                except asyncio.TimeoutError:
+                    for (model_idx, index), m in pending.items():
+                        yield cls._timeout_chunk(response_id, created, m, model_idx, index)
+                    return
+                if isinstance(chunk, tuple):
+                    del pending[chunk]
+                else:
+                    yield chunk
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @classmethod
+    def _generate_stream(cls, model: str, messages: List[Dict[str, str]], params: Dict[str, Any]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        fqn, native = cls._resolve(model)
+        if native:
+            provider = Completion.chat_models[fqn]
+            namespace = provider.namespace()
+            yield from Completion._stream_call(fqn, namespace, cls._transcript(messages), params,
+                lambda: provider.stream_chat_completion(model=fqn[len(namespace)+1:], messages=messages, **params))
+            return
+        prompt, call = cls._as_completion(model, messages, {**params, **_COMPLETION_ONLY})
+        cutter = _TurnCutter()
+        for fqn, chunk in Completion._generate_stream(model, prompt, call):
+            text, done = cutter.feed(chunk.get('text', ''), final=chunk.get('finish_reason') is not None)
+            if done:
+                yield fqn, {**chunk, 'text': text, 'finish_reason': chunk.get('finish_reason') or 'stop'}
+                return
+            yield fqn, {**chunk, 'text': text}
+
+    @classmethod
+    async def _agenerate_stream(cls, model: str, messages: List[Dict[str, str]], params: Dict[str, Any]) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+        fqn, native = cls._resolve(model)
+        if native:
+            provider = Completion.chat_models[fqn]
+            namespace = provider.namespace()
+            async for chunk in Completion._astream_call(fqn, namespace, cls._transcript(messages), params,
+                    lambda: provider.astream_chat_completion(model=fqn[len(namespace)+1:], messages=messages, **params)):
+                yield chunk
+            return
+        prompt, call = cls._as_completion(model, messages, {**params, **_COMPLETION_ONLY})
+        cutter = _TurnCutter()
+        stream = Completion._agenerate_stream(model, prompt, call)
+        try:
+            async for fqn, chunk in stream:
+                text, done = cutter.feed(chunk.get('text', ''), final=chunk.get('finish_reason') is not None)
+                if done:
+                    yield fqn, {**chunk, 'text': text, 'finish_reason': chunk.get('finish_reason') or 'stop'}
+                    return
+                yield fqn, {**chunk, 'text': text}
+        finally:
+            await stream.aclose()
+
+    @classmethod
+    def _build_chunk(cls, response_id: str, created: int, fqn: str, model_idx: int, index: int,
+                     chunk: Dict[str, Any], first: bool = False) -> Dict[str, Any]:
+        delta = {'content': chunk.get('text', '')}
+        if first:
+            delta = {'role': 'assistant', **delta}
+        choice = {
+            'delta': delta,
+            'index': index,
+            'model_idx': model_idx,
+            'model_name': fqn,
+            'finish_reason': chunk.get('finish_reason'),
+        }
+        for key in ('error', 'usage', 'extra'):
+            if key in chunk:
+                choice[key] = chunk[key]
+        return {
+            "id": response_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": fqn,
+            "choices": [choice],
+        }
+
+    @classmethod
+    def _timeout_chunk(cls, response_id: str, created: int, model: str, model_idx: int, index: int) -> Dict[str, Any]:
+        return cls._build_chunk(response_id, created, cls._resolve(model)[0], model_idx, index,
+                                {'error': "Error: Request timed out", 'finish_reason': 'error'})
+
+
+class _TurnCutter():
+    """
+    Cuts a reply to a formatted prompt where the model starts writing another turn, e.g. "\\nUser:".
+    Streamed text that could be the start of a turn label is held back until it's clear it isn't one.
+    """
+    def __init__(self):
+        self.markers = [f"\n{label}:" for label in CHAT_ROLES.values()]
+        self.text = ''
+        self.emitted = 0
+
+    def feed(self, text: str, final: bool = False) -> Tuple[str, bool]:
+        """
+        Adds text and returns the part of the reply that can be emitted, and whether the reply ended.
+        Nothing is held back from the final text of a stream.
+        """
+        self.text += text
+        cuts = [i for i in (self.text.find(marker) for marker in self.markers) if i >= 0]
+        if cuts:
+            end, done = min(cuts), True
+        else:
+            end, done = len(self.text), final
+            for marker in self.markers if not final else []:
+                for size in range(len(marker) - 1, 0, -1):
+                    if self.text.endswith(marker[:size]):
+                        end = min(end, len(self.text) - size)
+                        break
+        emitted, self.emitted = self.text[self.emitted:max(end, self.emitted)], max(end, self.emitted)
+        return emitted, done
@@ -0,0 +1,138 @@
+import asyncio
+import heapq
+import itertools
+import threading
+from typing import Callable, List, Optional, Tuple
+
+
+class Limiter():
+    """
+    Caps the number of concurrent requests. Can be shared between threads and event loops,
+    so the threaded and async completion paths count against the same limit.
+
+    Waiters get freed slots in the order of the key they acquire with, and in arrival order for equal keys,
+    so requests a scheduler has ordered keep that order here.
+    """
+    def __init__(self, limit: int):
+        if limit < 1:
+            raise ValueError(f"limit must be at least 1, got {limit}")
+        self.limit = limit
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        # A heap of the key, arrival number and callback that hands a freed slot to a waiting thread or task.
+        # The callback returns False if the waiter can no longer take the slot.
+        self._waiters: List[Tuple[Tuple, int, Callable[[], bool]]] = []
+        self._arrivals = itertools.count()
+
+    def acquire(self, timeout: Optional[float] = None, key: Tuple = ()) -> bool:
+        with self._lock:
+            if self._try_acquire():
+                return True
+            event = threading.Event()
+
+            def wake() -> bool:
+                event.set()
+                return True
+
+            waiter = (key, next(self._arrivals), wake)
+            heapq.heappush(self._waiters, waiter)
+        if event.wait(timeout):
+            return True
+        with self._lock:
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                # The slot was handed over while timing out
+                return True
+            heapq.heapify(self._waiters)
+            return False
+
+    async def aacquire(self, key: Tuple = ()):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._try_acquire():
+                return
+            future = loop.create_future()
+
+            def wake() -> bool:
+                try:
+                    loop.call_soon_threadsafe(self._wake, future)
+                except RuntimeError:
+                    # The loop was closed, so nothing is left to take the slot
+                    return False
+                return True
+
+            waiter = (key, next(self._arrivals), wake)
+            heapq.heappush(self._waiters, waiter)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                try:
+                    self._waiters.remove(waiter)
+                    heapq.heapify(self._waiters)
+                    handed_over = False
+                except ValueError:
+                    handed_over = True
+            # A slot handed over but not yet taken is released by _wake once it sees the cancelled future
+            if handed_over and future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while True:
+            with self._lock:
+                if self._waiters and self.in_flight <= self.limit:
+                    # Hand the slot over directly so in_flight stays the same
+                    waiter = heapq.heappop(self._waiters)[2]
+                else:
+                    self.in_flight -= 1
+                    return
+            if waiter():
+                return
+
+    def set_limit(self, limit: int):
+        """
+        Changes the limit. Raising it wakes up waiters right away, lowering it takes effect as requests finish.
+        """
+        if limit < 1:
+            raise ValueError(f"limit must be at least 1, got {limit}")
+        wake = []
+        with self._lock:
+            self.limit = limit
+            while self._waiters and self.in_flight < self.limit:
+                self.in_flight += 1
+                wake.append(heapq.heappop(self._waiters)[2])
+        for waiter in wake:
+            if not waiter():
+                self.release()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _try_acquire(self) -> bool:
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return True
+        return False
+
+    def _wake(self, future: asyncio.Future):
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    async def __aenter__(self):
+        await self.aacquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
@@ -0,0 +1,458 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import itertools
+import math
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+from openlm.instrumentation import _escape
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+# Priority classes, highest first. Requests of a class only start while no request of a higher class is waiting.
+PRIORITIES = (INTERACTIVE, BATCH)
+# The tenant of requests without a user
+DEFAULT_TENANT = 'default'
+
+# The tenant and priority of requests started from the current context
+_schedule: contextvars.ContextVar[Optional[Tuple[Optional[str], str]]] = contextvars.ContextVar('openlm_schedule', default=None)
+# Why the scheduler turned away the task running in the current context, if it did
+_rejection: contextvars.ContextVar[Optional["Rejected"]] = contextvars.ContextVar('openlm_rejection', default=None)
+# The scheduler and slot of the task running in the current context, if the scheduler started it
+_granted: contextvars.ContextVar[Optional[Tuple["FairScheduler", "_Waiter"]]] = contextvars.ContextVar('openlm_granted', default=None)
+
+
+class Rejected(RuntimeError):
+    """
+    A request the scheduler turned away, because its tenant had too many requests waiting
+    or it waited longer than the queue-time SLO of its priority.
+    """
+
+
+class TenantPolicy():
+    """
+    How the requests of a tenant are scheduled.
+
+    :param weight: The tenant's share of the capacity, relative to the other tenants of its priority with requests waiting.
+    :param priority: The priority of all of the tenant's requests, 'interactive' or 'batch'. By default create, acreate and
+        ChatCompletion requests are interactive and create_iter and acreate_iter requests are batch.
+    :param max_running: The maximum number of the tenant's requests running at once, even while capacity is free.
+    :param max_queued: The maximum number of the tenant's requests waiting. Requests beyond that are rejected.
+    """
+    def __init__(self, weight: float = 1.0,
+                       priority: Optional[str] = None,
+                       max_running: Optional[int] = None,
+                       max_queued: Optional[int] = None):
+        if weight <= 0:
+            raise ValueError(f"weight must be positive, got {weight}")
+        if priority is not None and priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority {priority}, expected one of {', '.join(PRIORITIES)}")
+        self.weight = weight
+        self.priority = priority
+        self.max_running = max_running
+        self.max_queued = max_queued
+
+
+@contextlib.contextmanager
+def scheduled(tenant: Optional[str], priority: str) -> Iterator[None]:
+    """
+    Attributes the requests started from the current context to tenant, with priority unless the tenant's policy sets one.
+    """
+    token = _schedule.set((tenant, priority))
+    try:
+        yield
+    finally:
+        _schedule.reset(token)
+
+
+def check_rejected():
+    """
+    Raises the reason the scheduler turned away the task running in the current context, if it did.
+    """
+    rejection = _rejection.get()
+    if rejection is not None:
+        raise rejection
+
+
+def current_slot() -> Optional[Tuple["FairScheduler", "_Waiter"]]:
+    """
+    Returns the scheduler and slot of the task running in the current context, if a scheduler started it with submit.
+    """
+    return _granted.get()
+
+
+class FairScheduler():
+    """
+    Decides which waiting request gets the next free slot, so one tenant's bulk job can't starve everyone else.
+    Interactive requests go before batch ones, and within a priority, tenants with requests waiting share the slots
+    in proportion to their weight with weighted fair queuing. Tenants are told apart by the requests' user.
+
+    Requests that wait longer than the SLO of their priority are rejected rather than started late, as are requests
+    beyond a tenant's max_queued. Rejected requests get an error choice. SLOs are checked whenever a slot frees up.
+
+    Slots of the limiters a request waits for after the scheduler, like provider_concurrency, are handed out in the
+    scheduler's order too. A request's wait lasts until it holds all of them, for both the wait stats and the SLO.
+
+    :param tenants: Policies by tenant.
+    :param default: The policy of tenants without one.
+    :param slo: The maximum number of seconds a request can wait for a slot, by priority, e.g. {'interactive': 5}.
+    :param limit: The number of slots. Defaults to Completion's max_in_flight, or max_workers, once it schedules a request.
+    :param window: The number of recent waits per tenant kept for the wait percentiles.
+    """
+    def __init__(self, tenants: Optional[Dict[str, TenantPolicy]] = None,
+                       default: Optional[TenantPolicy] = None,
+                       slo: Optional[Dict[str, float]] = None,
+                       limit: Optional[int] = None,
+                       window: int = 1000):
+        for priority in slo or {}:
+            if priority not in PRIORITIES:
+                raise ValueError(f"Unknown priority {priority}, expected one of {', '.join(PRIORITIES)}")
+        self.tenants = dict(tenants or {})
+        self.default = default if default is not None else TenantPolicy()
+        self.slo = dict(slo or {})
+        self.limit = limit
+        self.window = window
+        self.running = 0
+        # Waiting requests by priority and tenant, in arrival order
+        self._queues: Dict[str, Dict[str, Deque[_Waiter]]] = {priority: {} for priority in PRIORITIES}
+        # The virtual time of each priority, and the virtual finish time of each tenant's last request
+        self._virtual = {priority: 0.0 for priority in PRIORITIES}
+        self._finish: Dict[Tuple[str, str], float] = {}
+        self._stats: Dict[str, _TenantStats] = {}
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+
+    def policy(self, tenant: str) -> TenantPolicy:
+        return self.tenants.get(tenant, self.default)
+
+    def submit(self, executor: concurrent.futures.Executor, fn: Callable[..., Any], *args, **kwargs) -> concurrent.futures.Future:
+        """
+        Runs fn on executor once the scheduler gives it a slot, for the tenant and priority of the current context.
+        A rejected fn still runs, without a slot, and check_rejected raises the reason from within it.
+        """
+        future: concurrent.futures.Future = concurrent.futures.Future()
+
+        def run(rejection):
+            if not future.set_running_or_notify_cancel():
+                if rejection is None:
+                    self.release(waiter)
+                return
+            token = _rejection.set(rejection)
+            granted = _granted.set((self, waiter) if rejection is None else None)
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                _granted.reset(granted)
+                _rejection.reset(token)
+                if rejection is None:
+                    self.release(waiter)
+
+        def grant() -> bool:
+            executor.submit(run, None)
+            return True
+
+        waiter = self._waiter(grant, lambda rejection: executor.submit(run, rejection), future.cancelled)
+        self._enqueue(waiter)
+        return future
+
+    async def aacquire(self) -> "_Waiter":
+        """
+        Waits for a slot for the tenant and priority of the current context. Raises Rejected if the request is turned away.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake(result):
+            if not future.done():
+                future.set_result(result)
+
+        def grant() -> bool:
+            try:
+                loop.call_soon_threadsafe(wake, None)
+            except RuntimeError:
+                # The loop was closed, so nothing is left to take the slot
+                return False
+            return True
+
+        def reject(rejection: Rejected):
+            with contextlib.suppress(RuntimeError):
+                loop.call_soon_threadsafe(wake, rejection)
+
+        waiter = self._waiter(grant, reject, future.cancelled)
+        self._enqueue(waiter)
+        try:
+            rejection = await future
+        except asyncio.CancelledError:
+            # The slot may have been handed over while cancelling, otherwise the request leaves the queue right away
+            if not self._drop(waiter) and waiter.granted:
+                self.release(waiter)
+            raise
+        if rejection is not None:
+            raise rejection
+        return waiter
+
+    @contextlib.asynccontextmanager
+    async def aslot(self):
+        waiter = await self.aacquire()
+        self.start(waiter)
+        try:
+            yield
+        finally:
+            self.release(waiter)
+
+    def release(self, waiter: "_Waiter"):
+        with self._lock:
+            self.running -= 1
+            stats = self._stats[waiter.tenant]
+            stats.running -= 1
+            if not waiter.started:
+                # Requests that never said when they started waited until they got their slot
+                waiter.started = True
+                stats.record_wait(waiter.granted_at - waiter.enqueued)
+        self._dispatch()
+
+    def start(self, waiter: "_Waiter"):
+        """
+        Records that the request holding waiter's slot started, once it also got the slots of the limiters after the scheduler.
+        """
+        with self._lock:
+            if not waiter.started:
+                waiter.started = True
+                self._stats[waiter.tenant].record_wait(time.monotonic() - waiter.enqueued)
+
+    def slo_remaining(self, waiter: "_Waiter") -> Optional[float]:
+        """
+        Returns the number of seconds the request holding waiter's slot can still wait to start, or None if there is no limit.
+        """
+        slo = self.slo.get(waiter.priority)
+        if slo is None or waiter.started:
+            return None
+        return slo - (time.monotonic() - waiter.enqueued)
+
+    def expire(self, waiter: "_Waiter") -> Rejected:
+        """
+        Counts the request holding waiter's slot as rejected for missing its SLO while waiting on a later limiter,
+        and returns the error to raise. The caller still releases the slot.
+        """
+        waited = time.monotonic() - waiter.enqueued
+        with self._lock:
+            waiter.started = True
+            self._stats[waiter.tenant].rejected_slo += 1
+        return Rejected(f"Waited {waited:.1f}s for a slot, longer than the {self.slo[waiter.priority]}s SLO of {waiter.priority} requests")
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Returns the queue depth, running and finished requests, rejections and recent waits of every tenant.
+        """
+        with self._lock:
+            return {tenant: stats.summary() for tenant, stats in self._stats.items()}
+
+    def prometheus(self, prefix: str = 'openlm') -> str:
+        stats = self.stats()
+        if not stats:
+            return ''
+        lines = [f"# TYPE {prefix}_scheduler_queued gauge"]
+        lines += [f'{prefix}_scheduler_queued{{tenant="{_escape(tenant)}"}} {s["queued"]}' for tenant, s in stats.items()]
+        lines.append(f"# TYPE {prefix}_scheduler_running gauge")
+        lines += [f'{prefix}_scheduler_running{{tenant="{_escape(tenant)}"}} {s["running"]}' for tenant, s in stats.items()]
+        lines.append(f"# TYPE {prefix}_scheduler_requests_total counter")
+        for tenant, s in stats.items():
+            for outcome in ('started', 'rejected_quota', 'rejected_slo'):
+                lines.append(f'{prefix}_scheduler_requests_total{{tenant="{_escape(tenant)}",outcome="{outcome}"}} {s[outcome]}')
+        lines.append(f"# TYPE {prefix}_scheduler_wait_seconds summary")
+        for tenant, s in stats.items():
+            lines.append(f'{prefix}_scheduler_wait_seconds_sum{{tenant="{_escape(tenant)}"}} {s["total_wait"]}')
+            lines.append(f'{prefix}_scheduler_wait_seconds_count{{tenant="{_escape(tenant)}"}} {s["started"]}')
+        return '\n'.join(lines) + '\n'
+
+    def split(self, parts: int) -> "FairScheduler":
+        """
+        Returns a scheduler with a `parts`-th of the slots and of each tenant's max_running and max_queued,
+        for each of `parts` processes sharing them.
+        """
+        def divide(limit):
+            return math.ceil(limit / parts) if limit else limit
+
+        def policy(p):
+            return TenantPolicy(p.weight, p.priority, divide(p.max_running), divide(p.max_queued))
+
+        return FairScheduler({tenant: policy(p) for tenant, p in self.tenants.items()}, policy(self.default), self.slo,
+                             divide(self.limit), self.window)
+
+    def __getstate__(self):
+        # A copy in a worker process schedules that worker's requests, starting with empty queues
+        return {name: getattr(self, name) for name in ('tenants', 'default', 'slo', 'limit', 'window')}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _waiter(self, grant: Callable[[], bool], reject: Callable[["Rejected"], Any], cancelled: Callable[[], bool]) -> "_Waiter":
+        tenant, priority = _schedule.get() or (None, INTERACTIVE)
+        tenant = tenant or DEFAULT_TENANT
+        policy = self.policy(tenant)
+        return _Waiter(tenant, policy.priority or priority, policy, grant, reject, cancelled)
+
+    def _enqueue(self, waiter: "_Waiter"):
+        with self._lock:
+            stats = self._stats.setdefault(waiter.tenant, _TenantStats(self.window))
+            if waiter.policy.max_queued is not None and stats.queued >= waiter.policy.max_queued:
+                stats.rejected_quota += 1
+                rejection = Rejected(f"Tenant {waiter.tenant} has {stats.queued} requests waiting, the most it can have")
+            else:
+                rejection = None
+                key = (waiter.priority, waiter.tenant)
+                # A tenant coming back after being idle starts from the current virtual time rather than with credit
+                waiter.tag = max(self._virtual[waiter.priority], self._finish.get(key, 0.0)) + 1.0 / waiter.policy.weight
+                waiter.order = next(self._order)
+                self._finish[key] = waiter.tag
+                self._queues[waiter.priority].setdefault(waiter.tenant, collections.deque()).append(waiter)
+                stats.queued += 1
+        if rejection is not None:
+            waiter.reject(rejection)
+        self._dispatch()
+
+    def _drop(self, waiter: "_Waiter") -> bool:
+        """
+        Takes waiter out of its queue, returning whether it was still waiting.
+        """
+        with self._lock:
+            queue = self._queues[waiter.priority].get(waiter.tenant)
+            if queue is None or waiter not in queue:
+                return False
+            queue.remove(waiter)
+            if not queue:
+                del self._queues[waiter.priority][waiter.tenant]
+            self._stats[waiter.tenant].queued -= 1
+            return True
+
+    def _dispatch(self):
+        granted: List[_Waiter] = []
+        rejected: List[Tuple[_Waiter, Rejected]] = []
+        with self._lock:
+            while self.limit is None or self.running < self.limit:
+                waiter = self._next(time.monotonic(), rejected)
+                if waiter is None:
+                    break
+                waiter.granted = True
+                waiter.granted_at = time.monotonic()
+                self.running += 1
+                self._stats[waiter.tenant].running += 1
+                self._virtual[waiter.priority] = waiter.tag
+                granted.append(waiter)
+        for waiter, rejection in rejected:
+            waiter.reject(rejection)
+        lost = False
+        for waiter in granted:
+            if not waiter.grant():
+                # Nothing will release the slot, so it is given back without counting as a start
+                lost = True
+                with self._lock:
+                    waiter.started = True
+                    self.running -= 1
+                    self._stats[waiter.tenant].running -= 1
+        if lost:
+            self._dispatch()
+
+    def _next(self, now: float, rejected: List[Tuple["_Waiter", Rejected]]) -> Optional["_Waiter"]:
+        """
+        Pops the waiter to start next: the one with the lowest virtual finish time among the heads of the highest priority
+        with requests waiting, skipping tenants at their max_running. Heads that were cancelled or are past their SLO are dropped.
+        """
+        for priority in PRIORITIES:
+            queues = self._queues[priority]
+            slo = self.slo.get(priority)
+            best = None
+            for tenant in list(queues):
+                queue = queues[tenant]
+                stats = self._stats[tenant]
+                while queue and (queue[0].cancelled() or (slo is not None and now - queue[0].enqueued > slo)):
+                    waiter = queue.popleft()
+                    stats.queued -= 1
+                    if not waiter.cancelled():
+                        stats.rejected_slo += 1
+                        rejected.append((waiter, Rejected(f"Waited {now - waiter.enqueued:.1f}s for a slot, "
+                                                          f"longer than the {slo}s SLO of {priority} requests")))
+                if not queue:
+                    del queues[tenant]
+                    continue
+                head = queue[0]
+                if head.policy.max_running is not None and stats.running >= head.policy.max_running:
+                    continue
+                if best is None or (head.tag, head.order) < (best.tag, best.order):
+                    best = head
+            if best is not None:
+                queues[best.tenant].popleft()
+                if not queues[best.tenant]:
+                    del queues[best.tenant]
+                self._stats[best.tenant].queued -= 1
+                return best
+            if queues:
+                # Only tenants at their max_running are waiting, which doesn't hold back lower priorities
+                continue
+        return None
+
+
+class _Waiter():
+    def __init__(self, tenant: str, priority: str, policy: TenantPolicy,
+                 grant: Callable[[], bool], reject: Callable[[Rejected], Any], cancelled: Callable[[], bool]):
+        self.tenant = tenant
+        self.priority = priority
+        self.policy = policy
+        self.grant = grant
+        self.reject = reject
+        self.cancelled = cancelled
+        self.enqueued = time.monotonic()
+        self.tag = 0.0
+        self.order = 0
+        self.granted = False
+        self.granted_at = 0.0
+        self.started = False
+
+    @property
+    def key(self) -> Tuple[int, float, int]:
+        # The scheduler's order, for the limiters after it
+        return (PRIORITIES.index(self.priority), self.tag, self.order)
+
+
+class _TenantStats():
+    def __init__(self, window: int):
+        self.queued = 0
+        self.running = 0
+        self.started = 0
+        self.rejected_quota = 0
+        self.rejected_slo = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._waits: Deque[float] = collections.deque(maxlen=window)
+
+    def record_wait(self, seconds: float):
+        self.started += 1
+        self.total_wait += seconds
+        self.max_wait = max(self.max_wait, seconds)
+        self._waits.append(seconds)
+
+    def summary(self) -> Dict[str, Any]:
+        waits = sorted(self._waits)
+
+        def percentile(q):
+            return waits[min(len(waits) - 1, int(q * len(waits)))] if waits else None
+
+        return {
+            'queued': self.queued,
+            'running': self.running,
+            'started': self.started,
+            'rejected_quota': self.rejected_quota,
+            'rejected_slo': self.rejected_slo,
+            'total_wait': self.total_wait,
+            'mean_wait': self.total_wait / self.started if self.started else None,
+            'max_wait': self.max_wait,
+            'p50_wait': percentile(0.5),
+            'p95_wait': percentile(0.95),
+            'p99_wait': percentile(0.99),
+        }
@@ -0,0 +1,247 @@
+import bisect
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class CallRecord():
+    """
+    What happened during one upstream call for a model, across all of its attempts.
+    Passed to every hook in Completion.hooks once the call is done.
+
+    Times are in seconds. connect and ttfb are from the last attempt and are None when the HTTP client doesn't report them.
+    For streams, ttfb is the time to the first chunk.
+    """
+    def __init__(self, fqn: str, prompts: int = 1, stream: bool = False):
+        self.fqn = fqn
+        self.namespace = fqn.split('/', 1)[0]
+        # The number of prompts completed by the call, more than 1 for batches
+        self.prompts = prompts
+        self.stream = stream
+        self.started = time.monotonic()
+        # Time spent waiting for the rate limit and a concurrency slot
+        self.queue_wait = 0.0
+        # Time spent backing off between attempts
+        self.backoff = 0.0
+        self.connect: Optional[float] = None
+        self.ttfb: Optional[float] = None
+        self.latency: Optional[float] = None
+        self.request_bytes: Optional[int] = None
+        self.response_bytes: Optional[int] = None
+        self.status_code: Optional[int] = None
+        self.retries = 0
+        self.usage: Optional[Dict[str, int]] = None
+        self.error: Optional[BaseException] = None
+
+    def on_connect(self, seconds: float):
+        self.connect = seconds
+
+    def on_response(self, status_code: int, ttfb: Optional[float] = None,
+                    request_bytes: Optional[int] = None, response_bytes: Optional[int] = None):
+        self.status_code = status_code
+        if ttfb is not None:
+            self.ttfb = ttfb
+        if request_bytes is not None:
+            self.request_bytes = request_bytes
+        if response_bytes is not None:
+            self.response_bytes = response_bytes
+
+    def finish(self, usage: Optional[Dict[str, int]] = None, error: Optional[BaseException] = None):
+        self.latency = time.monotonic() - self.started
+        self.usage = usage
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'model_name': self.fqn,
+            'prompts': self.prompts,
+            'stream': self.stream,
+            'queue_wait': self.queue_wait,
+            'backoff': self.backoff,
+            'connect': self.connect,
+            'ttfb': self.ttfb,
+            'latency': self.latency,
+            'request_bytes': self.request_bytes,
+            'response_bytes': self.response_bytes,
+            'status_code': self.status_code,
+            'retries': self.retries,
+            'usage': self.usage,
+            'error': f"{type(self.error).__name__}: {self.error}" if self.error is not None else None,
+        }
+
+
+class Histogram():
+    """
+    A cumulative histogram in the Prometheus sense: each bucket counts the observations up to its bound.
+    """
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        total, out = 0, []
+        for bound, count in zip([*map(repr, self.buckets), '+Inf'], self.counts):
+            total += count
+            out.append((bound, total))
+        return out
+
+
+class Metrics():
+    """
+    Aggregates call records into per-model histograms and counters, and renders them in the Prometheus text format.
+    """
+    histograms = ('latency', 'queue_wait', 'connect', 'ttfb')
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._histograms: Dict[Tuple[str, str], Histogram] = {}
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+
+    def __reduce__(self):
+        # A copy, e.g. in a worker process, starts empty
+        return (Metrics, (self.buckets,))
+
+    def record(self, record: CallRecord):
+        with self._lock:
+            for name in self.histograms:
+                value = getattr(record, name)
+                if value is not None:
+                    key = (name, record.fqn)
+                    if key not in self._histograms:
+                        self._histograms[key] = Histogram(self.buckets)
+                    self._histograms[key].observe(value)
+            labels = (('model', record.fqn),)
+            self._inc('requests_total', labels + (('outcome', 'ok' if record.ok else 'error'),))
+            self._inc('choices_total', labels, record.prompts)
+            self._inc('retries_total', labels, record.retries)
+            if record.error is not None:
+                status = str(getattr(record.error, 'status_code', None) or record.status_code or '')
+                self._inc('errors_total', labels + (('type', type(record.error).__name__), ('status', status)))
+            if record.request_bytes is not None:
+                self._inc('request_bytes_total', labels, record.request_bytes)
+            if record.response_bytes is not None:
+                self._inc('response_bytes_total', labels, record.response_bytes)
+            for kind in ('prompt_tokens', 'completion_tokens'):
+                if record.usage and kind in record.usage:
+                    self._inc('tokens_total', labels + (('kind', kind.split('_')[0]),), record.usage[kind])
+
+    def _inc(self, name: str, labels: Tuple[Tuple[str, str], ...], amount: float = 1):
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + amount
+
+    def error_rates(self) -> Dict[str, float]:
+        """
+        Returns the fraction of calls that failed, per fully qualified model name.
+        """
+        totals: Dict[str, List[float]] = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                if name == 'requests_total':
+                    label = dict(labels)
+                    counts = totals.setdefault(label['model'], [0, 0])
+                    counts[label['outcome'] == 'error'] += value
+        return {fqn: errors / (ok + errors) for fqn, (ok, errors) in totals.items()}
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Returns the counters and, per model, the count, sum and buckets of each histogram.
+        """
+        with self._lock:
+            return {
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in self._counters.items()],
+                'histograms': [{'name': name, 'model': fqn, 'count': h.count, 'sum': h.sum, 'buckets': h.cumulative()}
+                               for (name, fqn), h in self._histograms.items()],
+            }
+
+    def prometheus(self, prefix: str = 'openlm') -> str:
+        """
+        Renders the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            for name in self.histograms:
+                metric = f"{prefix}_{name}_seconds"
+                series = [(fqn, h) for (n, fqn), h in sorted(self._histograms.items()) if n == name]
+                if not series:
+                    continue
+                lines.append(f"# TYPE {metric} histogram")
+                for fqn, h in series:
+                    for bound, count in h.cumulative():
+                        lines.append(f'{metric}_bucket{{model="{_escape(fqn)}",le="{bound}"}} {count}')
+                    lines.append(f'{metric}_sum{{model="{_escape(fqn)}"}} {h.sum}')
+                    lines.append(f'{metric}_count{{model="{_escape(fqn)}"}} {h.count}')
+            typed = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                metric = f"{prefix}_{name}"
+                if metric not in typed:
+                    lines.append(f"# TYPE {metric} counter")
+                    typed.add(metric)
+                rendered = ','.join(f'{k}="{_escape(v)}"' for k, v in labels)
+                lines.append(f"{metric}{{{rendered}}} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+def emit(record: CallRecord, metrics: Optional[Metrics], hooks: List[Callable[[CallRecord], None]]):
+    """
+    Records a finished call in the metrics and passes it to every hook.
+    """
+    if metrics is not None:
+        metrics.record(record)
+    for hook in hooks:
+        try:
+            hook(record)
+        except Exception:
+            # A broken hook must not fail the completion it observes
+            pass
+
+
+def serve_metrics(metrics: Metrics, port: int = 9464, host: str = '0.0.0.0'):
+    """
+    Serves the metrics for Prometheus to scrape on http://host:port/metrics from a background thread.
+    Returns the server, which can be stopped with shutdown().
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name='openlm-metrics', daemon=True).start()
+    return server
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
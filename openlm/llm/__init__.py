@@ -1,4 +1,24 @@
+import importlib
+
 from .base import BaseModel
-from .openai import OpenAI
-from .huggingface import Huggingface
-from .cohere import Cohere
+
+# Provider modules are imported on first access, so `import openlm` stays fast
+_providers = {
+    'OpenAI': 'openai',
+    'Huggingface': 'huggingface',
+    'Cohere': 'cohere',
+    'Local': 'local',
+}
+
+__all__ = ['BaseModel', *_providers]
+
+
+def __getattr__(name):
+    if name in _providers:
+        module = importlib.import_module(f'{__name__}.{_providers[name]}')
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_providers))
@@ -1,8 +1,48 @@
 import abc
-from typing import Any, Dict, List, Optional, Union
+import asyncio
+import contextvars
+import functools
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Union
 
 
+class ProviderError(ValueError):
+    """
+    An error returned by a provider's API.
+
+    :param message: The error message returned by the provider.
+    :param status_code: The HTTP status code of the response, if any.
+    :param retry_after: The number of seconds the provider asked to wait before retrying, if any.
+    """
+    def __init__(self, message: Any, status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        # Keeps the (status_code, text) arguments providers used to raise ValueError with
+        args = (status_code, message) if status_code is not None else (message,)
+        super().__init__(*args)
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+def split_usage(usage: Dict[str, int], parts: int) -> List[Dict[str, int]]:
+    """
+    Splits the usage of a batched request evenly between its prompts, keeping the totals exact.
+    """
+    split = [{} for _ in range(parts)]
+    for key, value in usage.items():
+        share, remainder = divmod(value, parts)
+        for i in range(parts):
+            split[i][key] = share + (1 if i < remainder else 0)
+    return split
+
 class BaseCompletion(metaclass=abc.ABCMeta):
+    # The maximum number of prompts create_completions_batch sends in one upstream call.
+    # Providers that can't complete several prompts at once keep the default of 1.
+    max_batch_size = 1
+    # The maximum number of samples per prompt create_completion draws in one upstream call when n is set.
+    # Providers that can't sample several completions at once keep the default of 1, and get one call per sample.
+    max_samples = 1
+    # Whether the provider picks the best of best_of samples itself. Otherwise best_of samples are drawn
+    # and the n with the highest score are kept.
+    supports_best_of = False
+
     @abc.abstractmethod
     def create_completion(self, model: Union[str, List[str]], prompt: Union[str, List[str]],
                                 suffix: Optional[str] = None,
@@ -19,8 +59,151 @@ class BaseCompletion(metaclass=abc.ABCMeta):
                                 best_of: Optional[int] = None,
                                 logit_bias: Optional[Dict[str, float]] = None,
                                 user: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Returns a dictionary with the completion 'text' and optionally 'usage' and 'extra'.
+        When n asks for several samples, they are returned as a list of 'samples', each with a 'text' and optionally
+        a 'score', the mean log probability of its tokens used to pick the best of best_of, and 'logprobs' and 'finish_reason'.
+        """
         raise NotImplementedError
 
+    async def acreate_completion(self, model: Union[str, List[str]], prompt: Union[str, List[str]],
+                                suffix: Optional[str] = None,
+                                max_tokens: Optional[int] = None,
+                                temperature: Optional[float] = None,
+                                top_p: Optional[float] = None,
+                                n: Optional[int] = None,
+                                stream: Optional[bool] = None,
+                                logprobs: Optional[int] = None,
+                                echo: Optional[bool] = None,
+                                stop: Optional[Union[str, List[str]]] = None,
+                                presence_penalty: Optional[float] = None,
+                                frequency_penalty: Optional[float] = None,
+                                best_of: Optional[int] = None,
+                                logit_bias: Optional[Dict[str, float]] = None,
+                                user: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Async version of create_completion. Providers without a native async client
+        fall back to running create_completion in a worker thread.
+        """
+        return await _in_thread(functools.partial(self.create_completion,
+            model=model,
+            prompt=prompt,
+            suffix=suffix,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            n=n,
+            stream=stream,
+            logprobs=logprobs,
+            echo=echo,
+            stop=stop,
+            presence_penalty=presence_penalty,
+            frequency_penalty=frequency_penalty,
+            best_of=best_of,
+            logit_bias=logit_bias,
+            user=user))
+
+    def create_completions_batch(self, model: str, prompts: List[str], **kwargs) -> List[Dict[str, Any]]:
+        """
+        Completes several prompts with the same parameters. Takes the same keyword arguments as
+        create_completion and returns one result per prompt, in order.
+        Providers with a batch endpoint override this and set max_batch_size.
+        """
+        return [self.create_completion(model=model, prompt=prompt, **kwargs) for prompt in prompts]
+
+    async def acreate_completions_batch(self, model: str, prompts: List[str], **kwargs) -> List[Dict[str, Any]]:
+        """
+        Async version of create_completions_batch.
+        Providers without an async endpoint run create_completions_batch in a worker thread, so their batches stay whole.
+        """
+        if type(self).acreate_completion is BaseModel.acreate_completion:
+            return await _in_thread(functools.partial(self.create_completions_batch, model=model, prompts=prompts, **kwargs))
+        return list(await asyncio.gather(*[self.acreate_completion(model=model, prompt=prompt, **kwargs) for prompt in prompts]))
+
+    def stream_completion(self, model: str, prompt: str, **kwargs) -> Iterator[Dict[str, Any]]:
+        """
+        Streams a completion as it is generated. Takes the same keyword arguments as create_completion
+        and yields dictionaries with a 'text' delta and, on the last chunk, a 'finish_reason'.
+        Providers without a streaming endpoint yield the whole completion as a single chunk.
+        """
+        kwargs.pop('stream', None)
+        ret = self.create_completion(model=model, prompt=prompt, **kwargs)
+        yield {**ret, 'finish_reason': ret.get('finish_reason')}
+
+    async def astream_completion(self, model: str, prompt: str, **kwargs) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Async version of stream_completion.
+        """
+        kwargs.pop('stream', None)
+        ret = await self.acreate_completion(model=model, prompt=prompt, **kwargs)
+        yield {**ret, 'finish_reason': ret.get('finish_reason')}
+
+    def format_chat(self, model: str, messages: List[Dict[str, str]]) -> str:
+        """
+        Formats chat messages as a prompt, for chatting with a model that has no chat endpoint.
+        The prompt ends with the assistant's label, so the completion is its reply.
+        Providers override this to use a model's own chat template.
+        """
+        lines = [f"{CHAT_ROLES.get(message['role'], message['role'].title())}: {message['content']}" for message in messages]
+        return '\n'.join(lines + [f"{CHAT_ROLES['assistant']}:"])
+
+
+# The labels of each role in prompts formatted by BaseCompletion.format_chat
+CHAT_ROLES = {'system': 'System', 'user': 'User', 'assistant': 'Assistant'}
+
+
+class BaseChatModel(metaclass=abc.ABCMeta):
+    """
+    A provider with a native chat endpoint, implemented alongside BaseModel. Models not in list_chat_models
+    are chatted with through their completion endpoint, with the messages formatted by format_chat.
+    """
+    # The maximum number of samples create_chat_completion draws in one upstream call when n is set
+    max_chat_samples = 1
+
+    @abc.abstractmethod
+    def list_chat_models(self) -> List[str]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def create_chat_completion(self, model: str, messages: List[Dict[str, str]],
+                                max_tokens: Optional[int] = None,
+                                temperature: Optional[float] = None,
+                                top_p: Optional[float] = None,
+                                n: Optional[int] = None,
+                                stop: Optional[Union[str, List[str]]] = None,
+                                presence_penalty: Optional[float] = None,
+                                frequency_penalty: Optional[float] = None,
+                                logit_bias: Optional[Dict[str, float]] = None,
+                                user: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Returns the assistant's reply in the same shape as create_completion: a dictionary with the reply 'text'
+        and optionally 'usage', 'extra', 'finish_reason' and, when n asks for several, 'samples'.
+        Messages are dictionaries with a 'role' of system, user or assistant and a 'content'.
+        """
+        raise NotImplementedError
+
+    async def acreate_chat_completion(self, model: str, messages: List[Dict[str, str]], **kwargs) -> Dict[str, Any]:
+        """
+        Async version of create_chat_completion. Providers without a native async client
+        fall back to running create_chat_completion in a worker thread.
+        """
+        return await _in_thread(functools.partial(self.create_chat_completion, model=model, messages=messages, **kwargs))
+
+    def stream_chat_completion(self, model: str, messages: List[Dict[str, str]], **kwargs) -> Iterator[Dict[str, Any]]:
+        """
+        Streams the reply as it is generated, yielding dictionaries with a 'text' delta and, on the last chunk, a 'finish_reason'.
+        Providers without a streaming endpoint yield the whole reply as a single chunk.
+        """
+        ret = self.create_chat_completion(model=model, messages=messages, **kwargs)
+        yield {**ret, 'finish_reason': ret.get('finish_reason')}
+
+    async def astream_chat_completion(self, model: str, messages: List[Dict[str, str]], **kwargs) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Async version of stream_chat_completion.
+        """
+        ret = await self.acreate_chat_completion(model=model, messages=messages, **kwargs)
+        yield {**ret, 'finish_reason': ret.get('finish_reason')}
+
 
 class BaseModel(BaseCompletion, metaclass=abc.ABCMeta):
     @abc.abstractmethod
@@ -29,4 +212,41 @@ class BaseModel(BaseCompletion, metaclass=abc.ABCMeta):
     
     @abc.abstractmethod
     def namespace(self) -> str:
-        raise NotImplementedError   
\ No newline at end of file
+        raise NotImplementedError   
+
+    def configure_pool(self, session=None, pool_size: Optional[int] = None):
+        """
+        Replaces the HTTP connection pool used by this provider.
+        Providers that do not keep a `session` attribute are left untouched.
+        """
+        if not hasattr(self, 'session'):
+            return
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if session is None:
+            from openlm.llm.http import default_session
+            session = default_session(pool_size=pool_size)
+        self.session = session
+
+    def __getstate__(self):
+        # Connection pools can't cross processes, so a copy in a worker process gets the default pool of its own
+        state = self.__dict__.copy()
+        state.pop('session', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'pool_size' in state:
+            from openlm.llm.http import default_session
+            self.session = default_session(pool_size=self.pool_size)
+
+
+
+async def _in_thread(fn: Callable[[], Any]) -> Any:
+    """
+    Runs a blocking call on Completion's shared executor, so max_workers bounds it and Completion.shutdown stops its threads.
+    The context is copied so the request deadline and instrumentation carry over to the worker thread.
+    """
+    from openlm.openlm import Completion
+
+    return await asyncio.get_running_loop().run_in_executor(Completion._get_thread_pool(), contextvars.copy_context().run, fn)
@@ -1,10 +1,15 @@
 
 
-from openlm.llm.base import BaseModel
+from openlm.llm.base import BaseChatModel, BaseModel, ProviderError
+from openlm.llm.http import (DEFAULT_CONNECT_TIMEOUT, DEFAULT_POOL_SIZE, DEFAULT_READ_TIMEOUT, async_available, async_session,
+                             client_timeout, default_session, raise_for_status, request_timeout)
+import collections
+import hashlib
 import os
-from typing import Any, Dict, List, Optional, Union
+import threading
+import uuid
+from typing import Any, AsyncIterator, Dict, Iterator, List, Mapping, Optional, Tuple, Union
 import json
-import requests
 
 cohere_models = [
     'command',
@@ -13,19 +18,78 @@ cohere_models = [
     'command-light-nightly',
 ]
 
-class Cohere(BaseModel):
+# The roles of chat_history entries by message role
+cohere_chat_roles = {'user': 'USER', 'assistant': 'CHATBOT', 'system': 'SYSTEM'}
+
+# Cohere's finish reasons as the OpenAI ones the other providers report
+cohere_finish_reasons = {
+    'COMPLETE': 'stop',
+    'STOP_SEQUENCE': 'stop',
+    'MAX_TOKENS': 'length',
+    'ERROR': 'error',
+    'ERROR_TOXIC': 'content_filter',
+}
+
+
+def _finish_reason(reason: Optional[str]) -> Optional[str]:
+    return cohere_finish_reasons.get(reason, reason.lower()) if reason is not None else None
+
+
+def _score(generation: Dict[str, Any]) -> Optional[float]:
+    """
+    The mean log likelihood of a generation's tokens, like the other providers' scores. Cohere's likelihood is their sum.
+    """
+    tokens = [token['likelihood'] for token in generation.get('token_likelihoods') or [] if token.get('likelihood') is not None]
+    if tokens:
+        return sum(tokens) / len(tokens)
+    return generation.get('likelihood')
+
+class Cohere(BaseModel, BaseChatModel):
+    # The most generations the generate endpoint returns per call
+    max_samples = 5
+
     def __init__(self,
-                 api_key = os.environ.get("COHERE_API_KEY"),
+                 api_key = None,
                  model_list = cohere_models,
                  namespace = 'cohere.ai',
-                 base_url = 'https://api.cohere.ai/v1/generate'):
-        self.api_key = api_key
+                 base_url = 'https://api.cohere.ai/v1/generate',
+                 session = None,
+                 pool_size = DEFAULT_POOL_SIZE,
+                 connect_timeout = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout = DEFAULT_READ_TIMEOUT,
+                 chat_model_list = cohere_models,
+                 chat_url = None,
+                 max_conversations = 1024):
+        self.api_key = api_key if api_key is not None else os.environ.get("COHERE_API_KEY")
         self.model_list = model_list
         self._namespace = namespace
         self.base_url = base_url
+        self.chat_model_list = chat_model_list
+        self.chat_url = chat_url if chat_url is not None else base_url.replace('/generate', '/chat')
+        # Conversations Cohere keeps server side, by the hash of their messages up to the last reply.
+        # The next turn of a known conversation sends only the new message with its conversation_id.
+        self.max_conversations = max_conversations
+        self._conversations: "collections.OrderedDict[str, str]" = collections.OrderedDict()
+        self._conversations_lock = threading.Lock()
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.session = session if session is not None else default_session(pool_size=pool_size)
 
     def list_models(self):
         return self.model_list
+
+    def list_chat_models(self):
+        return self.chat_model_list
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        del state['_conversations_lock']
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._conversations_lock = threading.Lock()
     
     def namespace(self):
         return self._namespace
@@ -45,24 +109,260 @@ class Cohere(BaseModel):
                                 best_of: Optional[int] = None,
                                 logit_bias: Optional[Dict[str, float]] = None,
                                 user: Optional[str] = None) -> Dict[str, Any]:
-        
+        url, headers, data = self._build_request(model, prompt,
+            suffix=suffix,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            n=n,
+            stream=stream,
+            logprobs=logprobs,
+            echo=echo,
+            stop=stop,
+            presence_penalty=presence_penalty,
+            frequency_penalty=frequency_penalty,
+            best_of=best_of,
+            logit_bias=logit_bias,
+            user=user)
+        resp = self.session.post(url, headers=headers, data=data, timeout=request_timeout(self.connect_timeout, self.read_timeout))
+        return self._handle_response(resp.status_code, resp.text, resp.headers)
+
+    async def acreate_completion(self, model: Union[str, List[str]], prompt: Union[str, List[str]],
+                                suffix: Optional[str] = None,
+                                max_tokens: Optional[int] = None,
+                                temperature: Optional[float] = None,
+                                top_p: Optional[float] = None,
+                                n: Optional[int] = None,
+                                stream: Optional[bool] = None,
+                                logprobs: Optional[int] = None,
+                                echo: Optional[bool] = None,
+                                stop: Optional[Union[str, List[str]]] = None,
+                                presence_penalty: Optional[float] = None,
+                                frequency_penalty: Optional[float] = None,
+                                best_of: Optional[int] = None,
+                                logit_bias: Optional[Dict[str, float]] = None,
+                                user: Optional[str] = None) -> Dict[str, Any]:
+        params = dict(
+            suffix=suffix,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            n=n,
+            stream=stream,
+            logprobs=logprobs,
+            echo=echo,
+            stop=stop,
+            presence_penalty=presence_penalty,
+            frequency_penalty=frequency_penalty,
+            best_of=best_of,
+            logit_bias=logit_bias,
+            user=user)
+        if not async_available():
+            return await super().acreate_completion(model, prompt, **params)
+        url, headers, data = self._build_request(model, prompt, **params)
+        async with async_session(self.pool_size).post(url, headers=headers, data=data, timeout=client_timeout(self.connect_timeout, self.read_timeout)) as resp:
+            return self._handle_response(resp.status, await resp.text(), resp.headers)
+
+    def stream_completion(self, model: str, prompt: str, **kwargs) -> Iterator[Dict[str, Any]]:
+        kwargs['stream'] = True
+        url, headers, data = self._build_request(model, prompt, **kwargs)
+        with self.session.post(url, headers=headers, data=data, stream=True, timeout=request_timeout(self.connect_timeout, self.read_timeout)) as resp:
+            if resp.status_code != 200:
+                self._handle_response(resp.status_code, resp.text, resp.headers)
+            for line in resp.iter_lines():
+                chunk = self._parse_stream_line(line)
+                if chunk is not None:
+                    yield chunk
+
+    async def astream_completion(self, model: str, prompt: str, **kwargs) -> AsyncIterator[Dict[str, Any]]:
+        if not async_available():
+            async for chunk in super().astream_completion(model, prompt, **kwargs):
+                yield chunk
+            return
+        kwargs['stream'] = True
+        url, headers, data = self._build_request(model, prompt, **kwargs)
+        async with async_session(self.pool_size).post(url, headers=headers, data=data, timeout=client_timeout(self.connect_timeout, self.read_timeout)) as resp:
+            if resp.status != 200:
+                self._handle_response(resp.status, await resp.text(), resp.headers)
+            async for line in resp.content:
+                chunk = self._parse_stream_line(line.rstrip(b'\r\n'))
+                if chunk is not None:
+                    yield chunk
+
+    def create_chat_completion(self, model: str, messages: List[Dict[str, str]], **kwargs) -> Dict[str, Any]:
+        url, headers, data, conversation_id = self._build_chat_request(model, messages, **kwargs)
+        resp = self.session.post(url, headers=headers, data=data, timeout=request_timeout(self.connect_timeout, self.read_timeout))
+        return self._handle_chat_response(resp.status_code, resp.text, resp.headers, model, messages, conversation_id)
+
+    async def acreate_chat_completion(self, model: str, messages: List[Dict[str, str]], **kwargs) -> Dict[str, Any]:
+        if not async_available():
+            return await super().acreate_chat_completion(model, messages, **kwargs)
+        url, headers, data, conversation_id = self._build_chat_request(model, messages, **kwargs)
+        async with async_session(self.pool_size).post(url, headers=headers, data=data, timeout=client_timeout(self.connect_timeout, self.read_timeout)) as resp:
+            return self._handle_chat_response(resp.status, await resp.text(), resp.headers, model, messages, conversation_id)
+
+    def stream_chat_completion(self, model: str, messages: List[Dict[str, str]], **kwargs) -> Iterator[Dict[str, Any]]:
+        url, headers, data, conversation_id = self._build_chat_request(model, messages, stream=True, **kwargs)
+        with self.session.post(url, headers=headers, data=data, stream=True, timeout=request_timeout(self.connect_timeout, self.read_timeout)) as resp:
+            if resp.status_code != 200:
+                self._handle_chat_response(resp.status_code, resp.text, resp.headers, model, messages, conversation_id)
+            for line in resp.iter_lines():
+                chunk = self._parse_chat_stream_line(line, model, messages, conversation_id)
+                if chunk is not None:
+                    yield chunk
+
+    async def astream_chat_completion(self, model: str, messages: List[Dict[str, str]], **kwargs) -> AsyncIterator[Dict[str, Any]]:
+        if not async_available():
+            async for chunk in super().astream_chat_completion(model, messages, **kwargs):
+                yield chunk
+            return
+        url, headers, data, conversation_id = self._build_chat_request(model, messages, stream=True, **kwargs)
+        async with async_session(self.pool_size).post(url, headers=headers, data=data, timeout=client_timeout(self.connect_timeout, self.read_timeout)) as resp:
+            if resp.status != 200:
+                self._handle_chat_response(resp.status, await resp.text(), resp.headers, model, messages, conversation_id)
+            async for line in resp.content:
+                chunk = self._parse_chat_stream_line(line.rstrip(b'\r\n'), model, messages, conversation_id)
+                if chunk is not None:
+                    yield chunk
+
+    def _build_chat_request(self, model: str, messages: List[Dict[str, str]], **params) -> Tuple[str, Dict[str, str], str, Optional[str]]:
+        """
+        Returns the request of a chat turn and the conversation_id it continues or starts, if any.
+        A conversation whose earlier turns Cohere already has is continued with only the new message.
+        """
+        headers = {'Content-Type': 'application/json',
+                'Authorization': f'Bearer {self.api_key}'}
+        system = [message['content'] for message in messages if message['role'] == 'system']
+        turns = [message for message in messages if message['role'] != 'system']
+        history = turns[:-1]
+        conversation_id = None
+        if not history:
+            conversation_id = str(uuid.uuid4())
+        else:
+            with self._conversations_lock:
+                # Taken out so two calls never continue the same conversation in different directions
+                conversation_id = self._conversations.pop(self._conversation_key(model, messages[:-1]), None)
+        payload = {
+            'message': turns[-1]['content'] if turns else '',
+            'model': model,
+            'preamble': '\n'.join(system) or None,
+            'conversation_id': conversation_id,
+            # Cohere doesn't take chat_history with a conversation_id
+            'chat_history': None if conversation_id else [{'role': cohere_chat_roles.get(message['role'], 'USER'), 'message': message['content']} for message in history],
+            'max_tokens': params.get('max_tokens'),
+            'temperature': params.get('temperature'),
+            'p': params.get('top_p'),
+            'frequency_penalty': params.get('frequency_penalty'),
+            'presence_penalty': params.get('presence_penalty'),
+            'stop_sequences': [params['stop']] if isinstance(params.get('stop'), str) else params.get('stop'),
+            'stream': params.get('stream'),
+        }
+        return self.chat_url, headers, json.dumps({k: v for k, v in payload.items() if v is not None}), conversation_id
+
+    def _conversation_key(self, model: str, messages: List[Dict[str, str]]) -> str:
+        turns = [[message['role'], message['content']] for message in messages]
+        return hashlib.sha256(json.dumps([model, turns]).encode('utf-8')).hexdigest()
+
+    def _remember(self, model: str, messages: List[Dict[str, str]], reply: str, conversation_id: Optional[str]):
+        """
+        Remembers that Cohere holds the conversation up to reply, so its next turn can continue it.
+        """
+        if conversation_id is None or self.max_conversations <= 0:
+            return
+        key = self._conversation_key(model, messages + [{'role': 'assistant', 'content': reply}])
+        with self._conversations_lock:
+            self._conversations[key] = conversation_id
+            self._conversations.move_to_end(key)
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+
+    def _handle_chat_response(self, status_code: int, text: str, headers: Optional[Mapping[str, str]],
+                              model: str, messages: List[Dict[str, str]], conversation_id: Optional[str]) -> Dict[str, Any]:
+        raise_for_status(status_code, text, headers)
+        resp = json.loads(text)
+        if 'message' in resp and 'text' not in resp:
+            raise ProviderError(resp['message'], status_code=status_code)
+        self._remember(model, messages, resp['text'], conversation_id)
+        return self._convert_chat_response(resp)
+
+    def _parse_chat_stream_line(self, line: bytes, model: str, messages: List[Dict[str, str]],
+                                conversation_id: Optional[str]) -> Optional[Dict[str, Any]]:
+        if not line.strip():
+            return None
+        event = json.loads(line)
+        if event.get('event_type') == 'text-generation':
+            return {
+                'text': event.get('text', ''),
+                'finish_reason': None,
+            }
+        if event.get('event_type') == 'stream-end':
+            chunk = {
+                'text': '',
+                'finish_reason': _finish_reason(event.get('finish_reason')),
+            }
+            if 'response' in event:
+                self._remember(model, messages, event['response'].get('text', ''), conversation_id)
+                chunk.update({k: v for k, v in self._convert_chat_response(event['response']).items() if k != 'text'})
+            return chunk
+        return None
+
+    def _convert_chat_response(self, resp: Dict[str, Any]) -> Dict[str, Any]:
+        result = {
+            'text': resp.get('text', ''),
+            'extra': {
+                'request_id': resp.get('response_id'),
+                'generation_id': resp.get('generation_id'),
+            },
+        }
+        if resp.get('finish_reason') is not None:
+            result['finish_reason'] = _finish_reason(resp['finish_reason'])
+        billed = resp.get('meta', {}).get('billed_units')
+        if billed:
+            prompt_tokens, completion_tokens = int(billed.get('input_tokens', 0)), int(billed.get('output_tokens', 0))
+            result['usage'] = {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+            }
+        return result
+
+    def _build_request(self, model: str, prompt: Union[str, List[str]], **params):
         headers = {'Content-Type': 'application/json',
                 'Authorization': f'Bearer {self.api_key}'}
         payload = {
             'prompt': prompt,
             'model': model,
-            'max_tokens': max_tokens,
-            'temperature': temperature,
-            'p': top_p,
-            'frequency_penalty': frequency_penalty,
-            'presence_penalty': presence_penalty,
-            'stop_sequences': stop,
+            'max_tokens': params.get('max_tokens'),
+            'temperature': params.get('temperature'),
+            'p': params.get('top_p'),
+            'frequency_penalty': params.get('frequency_penalty'),
+            'presence_penalty': params.get('presence_penalty'),
+            'stop_sequences': params.get('stop'),
+            'stream': params.get('stream'),
+        }
+        if (params.get('n') or 1) > 1:
+            payload['num_generations'] = params['n']
+            # The likelihoods score the generations for best_of
+            payload['return_likelihoods'] = 'GENERATION'
+        return self.base_url, headers, json.dumps({k: v for k, v in payload.items() if v is not None})
+
+    def _handle_response(self, status_code: int, text: str, headers: Optional[Mapping[str, str]] = None) -> Dict[str, Any]:
+        raise_for_status(status_code, text, headers)
+        return self._convert_response(json.loads(text))
+
+    def _parse_stream_line(self, line: bytes) -> Optional[Dict[str, Any]]:
+        if not line.strip():
+            return None
+        event = json.loads(line)
+        if event.get('is_finished'):
+            return {
+                'text': '',
+                'finish_reason': _finish_reason(event.get('finish_reason')),
+            }
+        return {
+            'text': event.get('text', ''),
+            'finish_reason': None,
         }
-        payload_str = json.dumps({k: v for k, v in payload.items() if v is not None})
-        resp = requests.post(self.base_url, headers=headers, data=payload_str)
-        if resp.status_code != 200:
-            raise ValueError(resp.status_code, resp.text)
-        return self._convert_response(resp.json())
 
     def _convert_request(req):
         return {
@@ -73,10 +373,22 @@ class Cohere(BaseModel):
         }
     
     def _convert_response(self, resp):
-        return {
+        result = {
             'text': resp['generations'][0]['text'],
             'extra': {
                 'request_id': resp['id'],
                 'generation_id': resp['generations'][0]['id'],
             }
         }
+        if resp['generations'][0].get('finish_reason') is not None:
+            result['finish_reason'] = _finish_reason(resp['generations'][0]['finish_reason'])
+        if len(resp['generations']) > 1:
+            result['samples'] = [{
+                'text': generation['text'],
+                'score': _score(generation),
+                'finish_reason': _finish_reason(generation.get('finish_reason')),
+                'extra': {
+                    'generation_id': generation['id'],
+                },
+            } for generation in resp['generations']]
+        return result
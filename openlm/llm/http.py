@@ -0,0 +1,307 @@
+import asyncio
+import contextvars
+import email.utils
+import importlib.util
+import json
+import threading
+import time
+import weakref
+from typing import TYPE_CHECKING, Any, Dict, Mapping, Optional, Tuple
+
+from openlm.llm.base import ProviderError
+
+# requests and aiohttp take longer to import than the rest of openlm, so they are imported on first use
+if TYPE_CHECKING:
+    import aiohttp
+    import requests
+
+# Matches the default number of workers used by Completion.create
+DEFAULT_POOL_SIZE = 32
+# Number of distinct hosts to keep connection pools for
+DEFAULT_POOL_CONNECTIONS = 10
+# Seconds to wait for a connection, and between two reads of a response
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_READ_TIMEOUT = 600.0
+
+_default_sessions: Dict[Tuple[int, int, bool], "requests.Session"] = {}
+_default_sessions_lock = threading.Lock()
+# aiohttp sessions are bound to an event loop, so they are kept per loop
+_async_sessions = weakref.WeakKeyDictionary()
+# The time.monotonic() deadline of the completion request being served, if any
+_deadline: contextvars.ContextVar = contextvars.ContextVar('openlm_deadline', default=None)
+_aiohttp_available: Optional[bool] = None
+_adapter_class = None
+# Receives connect times and response details of the requests made from the current context, if any
+_observer: contextvars.ContextVar = contextvars.ContextVar('openlm_observer', default=None)
+
+
+def create_session(pool_size: int = DEFAULT_POOL_SIZE,
+                   pool_connections: int = DEFAULT_POOL_CONNECTIONS,
+                   pool_block: bool = True) -> "requests.Session":
+    """
+    Creates a requests.Session that keeps connections alive between completions.
+
+    :param pool_size: The maximum number of connections kept open per host.
+    :param pool_connections: The number of hosts to keep connection pools for.
+    :param pool_block: Whether to wait for a free connection instead of opening one past pool_size.
+    """
+    import requests
+
+    session = requests.Session()
+    adapter = _observed_adapter()(pool_connections=pool_connections, pool_maxsize=pool_size, pool_block=pool_block)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.hooks['response'].append(_observe_response)
+    return session
+
+
+def default_session(pool_size: Optional[int] = None,
+                    pool_connections: Optional[int] = None,
+                    pool_block: bool = True) -> "requests.Session":
+    """
+    Returns a process-wide session shared by every provider created with the same pool settings.
+    """
+    key = (pool_size or DEFAULT_POOL_SIZE, pool_connections or DEFAULT_POOL_CONNECTIONS, pool_block)
+    with _default_sessions_lock:
+        if key not in _default_sessions:
+            _default_sessions[key] = create_session(*key)
+        return _default_sessions[key]
+
+
+def async_available() -> bool:
+    """
+    Whether native async HTTP is available (requires `pip install openlm[async]`).
+    """
+    global _aiohttp_available
+    if _aiohttp_available is None:
+        _aiohttp_available = importlib.util.find_spec('aiohttp') is not None
+    return _aiohttp_available
+
+
+def async_session(pool_size: Optional[int] = None) -> "aiohttp.ClientSession":
+    """
+    Returns an aiohttp session for the running event loop, shared by every provider with the same pool size.
+    """
+    if not async_available():
+        raise ImportError("aiohttp is required for async completions. Install it with `pip install openlm[async]`")
+    import aiohttp
+
+    loop = asyncio.get_running_loop()
+    pool_size = pool_size or DEFAULT_POOL_SIZE
+    sessions = _async_sessions.setdefault(loop, {})
+    session = sessions.get(pool_size)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=pool_size * DEFAULT_POOL_CONNECTIONS, limit_per_host=pool_size)
+        session = aiohttp.ClientSession(connector=connector, trace_configs=[_trace_config()])
+        sessions[pool_size] = session
+    return session
+
+
+async def close_async_sessions():
+    """
+    Closes the aiohttp sessions opened on the running event loop.
+    """
+    sessions = _async_sessions.pop(asyncio.get_running_loop(), {})
+    for session in sessions.values():
+        await session.close()
+
+
+def set_observer(observer) -> contextvars.Token:
+    """
+    Sets the object notified about the requests made from the current context. It needs an on_connect(seconds) and
+    an on_response(status_code, ttfb, request_bytes, response_bytes) method.
+    """
+    return _observer.set(observer)
+
+
+def reset_observer(token: contextvars.Token):
+    _observer.reset(token)
+
+
+def _observe_response(response, *args, **kwargs):
+    # requests calls response hooks once the headers are in, before the body is read
+    observer = _observer.get()
+    if observer is not None:
+        body = response.request.body
+        length = response.headers.get('Content-Length')
+        observer.on_response(response.status_code,
+                             ttfb=response.elapsed.total_seconds(),
+                             request_bytes=len(body) if body is not None else 0,
+                             response_bytes=int(length) if length and length.isdigit() else None)
+    return response
+
+
+def _observed_adapter():
+    """
+    Returns an HTTPAdapter class that reports how long opening a connection took, as the aiohttp trace does.
+    Reused connections report 0. Built on first use, since requests is imported lazily.
+    """
+    global _adapter_class
+    if _adapter_class is not None:
+        return _adapter_class
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    def observed(connection_class):
+        class ObservedConnection(connection_class):
+            def connect(self):
+                started = time.monotonic()
+                super().connect()
+                observer = _observer.get()
+                if observer is not None:
+                    observer.on_connect(time.monotonic() - started)
+        return ObservedConnection
+
+    class ObservedHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = observed(HTTPConnection)
+
+    class ObservedHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = observed(HTTPSConnection)
+
+    class ObservedAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            super().init_poolmanager(*args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {'http': ObservedHTTPConnectionPool, 'https': ObservedHTTPSConnectionPool}
+
+        def send(self, request, *args, **kwargs):
+            observer = _observer.get()
+            if observer is not None:
+                # Overwritten by the connection if it has to open one
+                observer.on_connect(0.0)
+            return super().send(request, *args, **kwargs)
+
+    _adapter_class = ObservedAdapter
+    return _adapter_class
+
+
+def _trace_config() -> "aiohttp.TraceConfig":
+    import aiohttp
+
+    async def on_request_start(session, context, params):
+        context.started = time.monotonic()
+        context.request_bytes = 0
+
+    async def on_request_chunk_sent(session, context, params):
+        context.request_bytes += len(params.chunk)
+
+    async def on_connection_create_start(session, context, params):
+        context.connecting = time.monotonic()
+
+    async def on_connection_create_end(session, context, params):
+        observer = _observer.get()
+        if observer is not None:
+            observer.on_connect(time.monotonic() - context.connecting)
+
+    async def on_connection_reuseconn(session, context, params):
+        observer = _observer.get()
+        if observer is not None:
+            observer.on_connect(0.0)
+
+    async def on_request_end(session, context, params):
+        observer = _observer.get()
+        if observer is not None:
+            observer.on_response(params.response.status,
+                                 ttfb=time.monotonic() - context.started,
+                                 request_bytes=context.request_bytes,
+                                 response_bytes=params.response.content_length)
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(on_request_start)
+    trace.on_request_chunk_sent.append(on_request_chunk_sent)
+    trace.on_connection_create_start.append(on_connection_create_start)
+    trace.on_connection_create_end.append(on_connection_create_end)
+    trace.on_connection_reuseconn.append(on_connection_reuseconn)
+    trace.on_request_end.append(on_request_end)
+    return trace
+
+
+def sse_data(line: bytes) -> Optional[str]:
+    """
+    Returns the payload of a server-sent event `data:` line, or None for any other line.
+    """
+    if not line.startswith(b'data:'):
+        return None
+    return line[len(b'data:'):].strip().decode('utf-8')
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parses a Retry-After header given either in seconds or as an HTTP date.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def raise_for_status(status_code: int, text: str, headers: Optional[Mapping[str, str]] = None):
+    """
+    Raises a ProviderError for any non-200 response, keeping the status code and how long to wait before retrying.
+    """
+    if status_code == 200:
+        return
+    retry_after = parse_retry_after(headers.get('Retry-After')) if headers is not None else None
+    message: Any = text
+    try:
+        body = json.loads(text)
+    except ValueError:
+        body = None
+    if isinstance(body, dict) and 'error' in body:
+        message = body['error']
+        # Huggingface reports how long a cold model takes to load
+        if retry_after is None and 'estimated_time' in body:
+            retry_after = float(body['estimated_time'])
+    raise ProviderError(message, status_code=status_code, retry_after=retry_after)
+
+
+def set_deadline(deadline: Optional[float]) -> contextvars.Token:
+    """
+    Sets the time.monotonic() deadline for provider requests made from the current context.
+    """
+    return _deadline.set(deadline)
+
+
+def reset_deadline(token: contextvars.Token):
+    _deadline.reset(token)
+
+
+def remaining_time() -> Optional[float]:
+    """
+    Returns the number of seconds left before the current deadline, or None if there is no deadline.
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def request_timeout(connect_timeout: Optional[float], read_timeout: Optional[float]) -> Tuple[Optional[float], Optional[float]]:
+    """
+    Returns the (connect, read) timeouts for a requests call, shortened to fit the current deadline.
+    """
+    remaining = remaining_time()
+    if remaining is None:
+        return connect_timeout, read_timeout
+    if remaining <= 0:
+        raise TimeoutError("Deadline exceeded before the request was sent")
+    return (min(connect_timeout, remaining) if connect_timeout is not None else remaining,
+            min(read_timeout, remaining) if read_timeout is not None else remaining)
+
+
+def client_timeout(connect_timeout: Optional[float], read_timeout: Optional[float]) -> "aiohttp.ClientTimeout":
+    """
+    Returns the aiohttp timeouts for a request, with the total bounded by the current deadline.
+    """
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        raise TimeoutError("Deadline exceeded before the request was sent")
+    import aiohttp
+
+    return aiohttp.ClientTimeout(total=remaining, sock_connect=connect_timeout, sock_read=read_timeout)
@@ -1,10 +1,11 @@
 
 
-from openlm.llm.base import BaseModel
+from openlm.llm.base import BaseModel, ProviderError
+from openlm.llm.http import (DEFAULT_CONNECT_TIMEOUT, DEFAULT_POOL_SIZE, DEFAULT_READ_TIMEOUT, async_available, async_session,
+                             client_timeout, default_session, raise_for_status, request_timeout, sse_data)
 import os
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, AsyncIterator, Dict, Iterator, List, Mapping, Optional, Union
 import json
-import requests
 
 hf_models = [
     'gpt2',
@@ -65,14 +66,24 @@ hf_models = [
 
 class Huggingface(BaseModel):
     def __init__(self,
-                 api_key = os.environ.get("HF_API_TOKEN"),
+                 api_key = None,
                  model_list = hf_models,
                  namespace = 'huggingface.co',
-                 base_url = 'https://api-inference.huggingface.co/models'):
-        self.api_key = api_key
+                 base_url = 'https://api-inference.huggingface.co/models',
+                 session = None,
+                 pool_size = DEFAULT_POOL_SIZE,
+                 max_batch_size = 16,
+                 connect_timeout = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout = DEFAULT_READ_TIMEOUT):
+        self.api_key = api_key if api_key is not None else os.environ.get("HF_API_TOKEN")
         self.model_list = model_list
         self._namespace = namespace
         self.base_url = base_url
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_batch_size = max_batch_size
+        self.session = session if session is not None else default_session(pool_size=pool_size)
 
     def list_models(self):
         return self.model_list
@@ -95,20 +106,149 @@ class Huggingface(BaseModel):
                                 best_of: Optional[int] = None,
                                 logit_bias: Optional[Dict[str, float]] = None,
                                 user: Optional[str] = None) -> Dict[str, Any]:
-        
+        url, headers, data = self._build_request(model, prompt,
+            suffix=suffix,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            n=n,
+            stream=stream,
+            logprobs=logprobs,
+            echo=echo,
+            stop=stop,
+            presence_penalty=presence_penalty,
+            frequency_penalty=frequency_penalty,
+            best_of=best_of,
+            logit_bias=logit_bias,
+            user=user)
+        resp = self.session.post(url, headers=headers, data=data, timeout=request_timeout(self.connect_timeout, self.read_timeout))
+        return self._handle_response(resp.status_code, resp.text, resp.headers)
+
+    async def acreate_completion(self, model: Union[str, List[str]], prompt: Union[str, List[str]],
+                                suffix: Optional[str] = None,
+                                max_tokens: Optional[int] = None,
+                                temperature: Optional[float] = None,
+                                top_p: Optional[float] = None,
+                                n: Optional[int] = None,
+                                stream: Optional[bool] = None,
+                                logprobs: Optional[int] = None,
+                                echo: Optional[bool] = None,
+                                stop: Optional[Union[str, List[str]]] = None,
+                                presence_penalty: Optional[float] = None,
+                                frequency_penalty: Optional[float] = None,
+                                best_of: Optional[int] = None,
+                                logit_bias: Optional[Dict[str, float]] = None,
+                                user: Optional[str] = None) -> Dict[str, Any]:
+        params = dict(
+            suffix=suffix,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            n=n,
+            stream=stream,
+            logprobs=logprobs,
+            echo=echo,
+            stop=stop,
+            presence_penalty=presence_penalty,
+            frequency_penalty=frequency_penalty,
+            best_of=best_of,
+            logit_bias=logit_bias,
+            user=user)
+        if not async_available():
+            return await super().acreate_completion(model, prompt, **params)
+        url, headers, data = self._build_request(model, prompt, **params)
+        async with async_session(self.pool_size).post(url, headers=headers, data=data, timeout=client_timeout(self.connect_timeout, self.read_timeout)) as resp:
+            return self._handle_response(resp.status, await resp.text(), resp.headers)
+
+    def create_completions_batch(self, model: str, prompts: List[str], **kwargs) -> List[Dict[str, Any]]:
+        url, headers, data = self._build_request(model, prompts, **kwargs)
+        resp = self.session.post(url, headers=headers, data=data, timeout=request_timeout(self.connect_timeout, self.read_timeout))
+        return self._handle_batch_response(resp.status_code, resp.text, resp.headers, prompts, kwargs.get('n'))
+
+    async def acreate_completions_batch(self, model: str, prompts: List[str], **kwargs) -> List[Dict[str, Any]]:
+        if not async_available():
+            return await super().acreate_completions_batch(model, prompts, **kwargs)
+        url, headers, data = self._build_request(model, prompts, **kwargs)
+        async with async_session(self.pool_size).post(url, headers=headers, data=data, timeout=client_timeout(self.connect_timeout, self.read_timeout)) as resp:
+            return self._handle_batch_response(resp.status, await resp.text(), resp.headers, prompts, kwargs.get('n'))
+
+    def stream_completion(self, model: str, prompt: str, **kwargs) -> Iterator[Dict[str, Any]]:
+        kwargs['stream'] = True
+        url, headers, data = self._build_request(model, prompt, **kwargs)
+        with self.session.post(url, headers=headers, data=data, stream=True, timeout=request_timeout(self.connect_timeout, self.read_timeout)) as resp:
+            if resp.status_code != 200:
+                self._handle_response(resp.status_code, resp.text, resp.headers)
+            for line in resp.iter_lines():
+                chunk = self._parse_stream_line(line)
+                if chunk is not None:
+                    yield chunk
+
+    async def astream_completion(self, model: str, prompt: str, **kwargs) -> AsyncIterator[Dict[str, Any]]:
+        if not async_available():
+            async for chunk in super().astream_completion(model, prompt, **kwargs):
+                yield chunk
+            return
+        kwargs['stream'] = True
+        url, headers, data = self._build_request(model, prompt, **kwargs)
+        async with async_session(self.pool_size).post(url, headers=headers, data=data, timeout=client_timeout(self.connect_timeout, self.read_timeout)) as resp:
+            if resp.status != 200:
+                self._handle_response(resp.status, await resp.text(), resp.headers)
+            async for line in resp.content:
+                chunk = self._parse_stream_line(line.rstrip(b'\r\n'))
+                if chunk is not None:
+                    yield chunk
+
+    def _build_request(self, model: str, prompt: Union[str, List[str]], **params):
         headers = {'Content-Type': 'application/json',
                 'Authorization': f'Bearer {self.api_key}'}
+        top_p, temperature = params.get('top_p'), params.get('temperature')
+        # The API only reads generation settings from parameters. It rejects a temperature of 0 and a top_p of 1,
+        # which are what greedy decoding and no nucleus sampling are without them.
+        parameters = {
+            'top_p': top_p if top_p is not None and top_p < 1 else None,
+            'temperature': temperature or None,
+            'max_new_tokens': params.get('max_tokens'),
+        }
         payload = {
             'inputs': prompt,
-            'top_p': top_p,
-            'temperature': temperature,
-            'max_new_tokens': max_tokens,
+            'stream': params.get('stream'),
+        }
+        if params.get('n'):
+            # n is set on each of the calls drawing several samples. The inference API would answer
+            # repeated calls from its cache, and the token details score the samples for best_of.
+            payload['options'] = {'use_cache': False}
+            parameters['do_sample'] = temperature != 0
+            parameters['details'] = True
+        parameters = {k: v for k, v in parameters.items() if v is not None}
+        if parameters:
+            payload['parameters'] = parameters
+        return self.base_url + '/' + model, headers, json.dumps({k: v for k, v in payload.items() if v is not None})
+
+    def _handle_response(self, status_code: int, text: str, headers: Optional[Mapping[str, str]] = None) -> Dict[str, Any]:
+        raise_for_status(status_code, text, headers)
+        return self._convert_response(json.loads(text))
+
+    def _handle_batch_response(self, status_code: int, text: str, headers: Optional[Mapping[str, str]], prompts: List[str], n: Optional[int]) -> List[Dict[str, Any]]:
+        raise_for_status(status_code, text, headers)
+        # Each input gets either a single generation or a list of generations
+        return [self._convert_response(resp if isinstance(resp, list) else [resp]) for resp in json.loads(text)]
+
+    def _parse_stream_line(self, line: bytes) -> Optional[Dict[str, Any]]:
+        data = sse_data(line)
+        if data is None:
+            return None
+        event = json.loads(data)
+        if 'error' in event:
+            raise ProviderError(event['error'])
+        token = event.get('token') or {}
+        details = event.get('details') or {}
+        finish_reason = details.get('finish_reason')
+        if finish_reason is None and event.get('generated_text') is not None:
+            finish_reason = 'stop'
+        return {
+            'text': '' if token.get('special') else token.get('text', ''),
+            'finish_reason': finish_reason,
         }
-        payload_str = json.dumps({k: v for k, v in payload.items() if v is not None})
-        resp = requests.post(self.base_url + '/' + model, headers=headers, data=payload_str)
-        if resp.status_code != 200:
-            raise ValueError(resp.status_code, resp.text)
-        return self._convert_response(resp.json())
 
     def _convert_request(req):
         return {
@@ -119,6 +259,14 @@ class Huggingface(BaseModel):
         }
     
     def _convert_response(self, resp):
-        return {
+        result = {
             'text': resp[0]['generated_text'],
         }
+        # Token details come back next to the generated text when the request's parameters ask for them
+        details = resp[0].get('details') or {}
+        logprobs = [token['logprob'] for token in details.get('tokens') or [] if token.get('logprob') is not None]
+        if logprobs:
+            result['score'] = sum(logprobs) / len(logprobs)
+        if details.get('finish_reason') is not None:
+            result['finish_reason'] = 'length' if details['finish_reason'] == 'length' else 'stop'
+        return result
@@ -0,0 +1,680 @@
+import json
+import math
+import os
+import queue
+import re
+import struct
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+from openlm.llm.base import BaseModel
+from openlm.llm.http import remaining_time
+from openlm.tokenizers import CONTEXT_WINDOWS, BaseTokenizer, register_tokenizer
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# The pre-tokenization pattern of GPT-2. The standard library has no \p{L} classes, so letters and numbers are
+# approximated unless the regex module is installed.
+try:
+    import regex
+    _PATTERN = regex.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""")
+except ImportError:
+    _PATTERN = re.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?[^\W\d_]+| ?\d+| ?(?:[^\s\w]|_)+|\s+(?!\S)|\s+""")
+
+_DTYPES = {'F32': '<f4', 'F16': '<f2', 'BF16': '<u2', 'F64': '<f8'}
+
+
+def _bytes_to_unicode() -> Dict[int, str]:
+    # GPT-2 maps every byte to a printable character, so merges never see whitespace or control bytes
+    printable = list(range(ord('!'), ord('~') + 1)) + list(range(ord('¡'), ord('¬') + 1)) + list(range(ord('®'), ord('ÿ') + 1))
+    chars = printable[:]
+    extra = 0
+    for b in range(256):
+        if b not in printable:
+            printable.append(b)
+            chars.append(256 + extra)
+            extra += 1
+    return dict(zip(printable, map(chr, chars)))
+
+
+class GPT2Tokenizer(BaseTokenizer):
+    """
+    The byte-level BPE tokenizer of GPT-2 models, loaded from the vocab.json and merges.txt of a model directory.
+    """
+    def __init__(self, path: str):
+        with open(os.path.join(path, 'vocab.json'), encoding='utf-8') as f:
+            self.encoder: Dict[str, int] = json.load(f)
+        self.decoder = {i: token for token, i in self.encoder.items()}
+        with open(os.path.join(path, 'merges.txt'), encoding='utf-8') as f:
+            merges = [tuple(line.split()) for line in f.read().split('\n') if line and not line.startswith('#version')]
+        self.ranks = {pair: i for i, pair in enumerate(merges)}
+        self.byte_encoder = _bytes_to_unicode()
+        self.byte_decoder = {c: b for b, c in self.byte_encoder.items()}
+        self.eos_token_id = self.encoder.get('<|endoftext|>')
+        self._cache: Dict[str, List[str]] = {}
+
+    def _bpe(self, word: str) -> List[str]:
+        parts = self._cache.get(word)
+        if parts is not None:
+            return parts
+        parts = list(word)
+        while len(parts) > 1:
+            pairs = [(self.ranks.get(pair, math.inf), i) for i, pair in enumerate(zip(parts, parts[1:]))]
+            rank, i = min(pairs)
+            if rank == math.inf:
+                break
+            first, second = parts[i], parts[i + 1]
+            merged = []
+            j = 0
+            while j < len(parts):
+                if j < len(parts) - 1 and parts[j] == first and parts[j + 1] == second:
+                    merged.append(first + second)
+                    j += 2
+                else:
+                    merged.append(parts[j])
+                    j += 1
+            parts = merged
+        if len(self._cache) >= 100000:
+            self._cache.clear()
+        self._cache[word] = parts
+        return parts
+
+    def encode(self, text: str) -> List[int]:
+        ids = []
+        for piece in _PATTERN.findall(text):
+            word = ''.join(self.byte_encoder[b] for b in piece.encode('utf-8'))
+            ids.extend(self.encoder[token] for token in self._bpe(word))
+        return ids
+
+    def decode_bytes(self, ids: List[int]) -> bytes:
+        return bytes(self.byte_decoder[c] for i in ids for c in self.decoder[i])
+
+    def decode(self, ids: List[int]) -> str:
+        return self.decode_bytes(ids).decode('utf-8', errors='replace')
+
+    def count(self, text: str) -> int:
+        return len(self.encode(text))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        ids = self.encode(text)
+        if len(ids) <= max_tokens:
+            return text
+        return self.decode(ids[len(ids) - max_tokens:]) if max_tokens > 0 else ''
+
+
+def load_safetensors(path: str) -> Dict[str, "np.ndarray"]:
+    """
+    Maps the tensors of a .safetensors file into memory without reading them. Pages are loaded on first use
+    and shared between processes that load the same file. Half precision tensors are converted to float32 in memory.
+    """
+    with open(path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    data = np.memmap(path, dtype=np.uint8, mode='r', offset=8 + header_size)
+    tensors = {}
+    for name, info in header.items():
+        if name == '__metadata__':
+            continue
+        if info['dtype'] not in _DTYPES:
+            raise ValueError(f"Unsupported tensor type {info['dtype']} for {name} in {path}")
+        start, end = info['data_offsets']
+        tensor = data[start:end].view(_DTYPES[info['dtype']]).reshape(info['shape'])
+        if info['dtype'] == 'BF16':
+            tensor = (tensor.astype(np.uint32) << 16).view(np.float32)
+        elif tensor.dtype != np.float32:
+            tensor = tensor.astype(np.float32)
+        tensors[name] = tensor
+    return tensors
+
+
+class _KVCache():
+    """
+    The attention keys and values of one sequence, preallocated for its prompt and completion.
+    """
+    def __init__(self, n_layer: int, n_head: int, capacity: int, head_dim: int):
+        self.k = np.empty((n_layer, n_head, capacity, head_dim), dtype=np.float32)
+        self.v = np.empty((n_layer, n_head, capacity, head_dim), dtype=np.float32)
+        self.length = 0
+
+    @property
+    def capacity(self) -> int:
+        return self.k.shape[2]
+
+    def copy(self) -> "_KVCache":
+        cache = _KVCache(*self.k.shape[:2], self.capacity, self.k.shape[3])
+        cache.k[:, :, :self.length] = self.k[:, :, :self.length]
+        cache.v[:, :, :self.length] = self.v[:, :, :self.length]
+        cache.length = self.length
+        return cache
+
+
+class _PrefixCache():
+    """
+    Keeps the keys and values of recently seen prompts in blocks of block_size tokens, keyed by the block and
+    everything before it, so prompts sharing a prefix only run the model over the tokens after it.
+    The least recently used blocks are evicted beyond max_blocks.
+    """
+    def __init__(self, max_blocks: int, block_size: int = 16):
+        self.max_blocks = max_blocks
+        self.block_size = block_size
+        self.blocks: "OrderedDict[Tuple, Tuple[np.ndarray, np.ndarray]]" = OrderedDict()
+        self.hit_tokens = 0
+        self.miss_tokens = 0
+
+    def _keys(self, ids: List[int]) -> Iterator[Tuple[int, Tuple]]:
+        key = None
+        for i in range(len(ids) // self.block_size):
+            key = (hash(key), tuple(ids[i * self.block_size:(i + 1) * self.block_size]))
+            yield i, key
+
+    def load(self, ids: List[int], cache: _KVCache) -> int:
+        """
+        Copies the cached blocks of the longest cached prefix of ids into cache and returns its length in tokens.
+        The last token is never loaded, since running it gives the logits of the first completion token.
+        """
+        size = self.block_size
+        length = 0
+        for i, key in self._keys(ids[:len(ids) - 1]):
+            block = self.blocks.get(key)
+            if block is None:
+                break
+            self.blocks.move_to_end(key)
+            cache.k[:, :, i * size:(i + 1) * size] = block[0]
+            cache.v[:, :, i * size:(i + 1) * size] = block[1]
+            length = (i + 1) * size
+        cache.length = length
+        self.hit_tokens += length
+        self.miss_tokens += len(ids) - length
+        return length
+
+    def store(self, ids: List[int], cache: _KVCache):
+        size = self.block_size
+        for i, key in self._keys(ids[:cache.length]):
+            if key in self.blocks:
+                self.blocks.move_to_end(key)
+                continue
+            self.blocks[key] = (cache.k[:, :, i * size:(i + 1) * size].copy(), cache.v[:, :, i * size:(i + 1) * size].copy())
+        while len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+
+
+class GPT2():
+    """
+    A GPT-2 style decoder running on NumPy, with weights memory-mapped from a Hugging Face model directory
+    holding config.json and model.safetensors.
+    """
+    def __init__(self, path: str):
+        with open(os.path.join(path, 'config.json'), encoding='utf-8') as f:
+            config = json.load(f)
+        self.n_layer = config['n_layer']
+        self.n_head = config['n_head']
+        self.n_embd = config['n_embd']
+        self.n_positions = config.get('n_positions') or config.get('n_ctx')
+        self.eps = config.get('layer_norm_epsilon', 1e-5)
+        self.head_dim = self.n_embd // self.n_head
+        tensors = load_safetensors(os.path.join(path, 'model.safetensors'))
+        self.weights = {name[len('transformer.'):] if name.startswith('transformer.') else name: tensor
+                        for name, tensor in tensors.items()}
+
+    def new_cache(self, capacity: int) -> _KVCache:
+        return _KVCache(self.n_layer, self.n_head, capacity, self.head_dim)
+
+    def forward(self, inputs: List[Tuple[List[int], _KVCache]]) -> "np.ndarray":
+        """
+        Runs the model over the new tokens of several sequences at once, appending their keys and values to each
+        sequence's cache. The projections and MLPs of all tokens share one matrix multiplication per layer.
+        Returns the logits after the last new token of each sequence.
+        """
+        w = self.weights
+        ids = np.concatenate([np.asarray(tokens, dtype=np.int64) for tokens, _ in inputs])
+        positions = np.concatenate([np.arange(cache.length, cache.length + len(tokens)) for tokens, cache in inputs])
+        spans = []
+        offset = 0
+        for tokens, cache in inputs:
+            spans.append((offset, offset + len(tokens), cache))
+            offset += len(tokens)
+        x = w['wte.weight'][ids] + w['wpe.weight'][positions]
+        scale = 1.0 / math.sqrt(self.head_dim)
+        for layer in range(self.n_layer):
+            prefix = f'h.{layer}.'
+            h = self._layer_norm(x, w[prefix + 'ln_1.weight'], w[prefix + 'ln_1.bias'])
+            qkv = h @ w[prefix + 'attn.c_attn.weight'] + w[prefix + 'attn.c_attn.bias']
+            q, k, v = (part.reshape(-1, self.n_head, self.head_dim).transpose(1, 0, 2) for part in np.split(qkv, 3, axis=1))
+            attn = np.empty_like(h)
+            # Sequences have different lengths, so attention runs per sequence
+            for start, end, cache in spans:
+                past, new = cache.length, end - start
+                cache.k[layer, :, past:past + new] = k[:, start:end]
+                cache.v[layer, :, past:past + new] = v[:, start:end]
+                keys = cache.k[layer, :, :past + new]
+                scores = (q[:, start:end] @ keys.transpose(0, 2, 1)) * scale
+                if new > 1:
+                    causal = np.arange(past + new)[None, :] > (past + np.arange(new))[:, None]
+                    scores = np.where(causal, -np.inf, scores)
+                scores = np.exp(scores - scores.max(axis=-1, keepdims=True))
+                scores /= scores.sum(axis=-1, keepdims=True)
+                attn[start:end] = (scores @ cache.v[layer, :, :past + new]).transpose(1, 0, 2).reshape(new, self.n_embd)
+            x = x + attn @ w[prefix + 'attn.c_proj.weight'] + w[prefix + 'attn.c_proj.bias']
+            h = self._layer_norm(x, w[prefix + 'ln_2.weight'], w[prefix + 'ln_2.bias'])
+            h = self._gelu(h @ w[prefix + 'mlp.c_fc.weight'] + w[prefix + 'mlp.c_fc.bias'])
+            x = x + h @ w[prefix + 'mlp.c_proj.weight'] + w[prefix + 'mlp.c_proj.bias']
+        for start, end, cache in spans:
+            cache.length += end - start
+        last = self._layer_norm(x[[end - 1 for _, end, _ in spans]], w['ln_f.weight'], w['ln_f.bias'])
+        return last @ w['wte.weight'].T
+
+    def _layer_norm(self, x: "np.ndarray", weight: "np.ndarray", bias: "np.ndarray") -> "np.ndarray":
+        mean = x.mean(axis=-1, keepdims=True)
+        var = x.var(axis=-1, keepdims=True)
+        return (x - mean) / np.sqrt(var + self.eps) * weight + bias
+
+    def _gelu(self, x: "np.ndarray") -> "np.ndarray":
+        return 0.5 * x * (1.0 + np.tanh(math.sqrt(2.0 / math.pi) * (x + 0.044715 * x ** 3)))
+
+
+class _Request():
+    def __init__(self, prompt_ids: List[int], params: Dict[str, Any], n: int, stream: bool = False):
+        self.prompt_ids = prompt_ids
+        self.n = n
+        self.stream = stream
+        # 16 and 1 are OpenAI's defaults for max_tokens and temperature
+        self.max_tokens = params.get('max_tokens') or 16
+        self.temperature = 1.0 if params.get('temperature') is None else params['temperature']
+        self.top_p = params.get('top_p')
+        self.logprobs = params.get('logprobs')
+        stop = params.get('stop')
+        self.stop = [stop] if isinstance(stop, str) else [s for s in stop or [] if s]
+        self.presence_penalty = params.get('presence_penalty') or 0.0
+        self.frequency_penalty = params.get('frequency_penalty') or 0.0
+        self.logit_bias = {int(token): bias for token, bias in (params.get('logit_bias') or {}).items()}
+        self.sequences: List[_Sequence] = []
+        self.finished = 0
+        self.error: Optional[BaseException] = None
+        # Streamed text deltas, then None once every sequence finished or the request failed
+        self.events: "queue.Queue[Optional[str]]" = queue.Queue()
+        # Set by the caller when it stops waiting, so the engine drops the request
+        self.cancelled = threading.Event()
+
+
+class _Sequence():
+    def __init__(self, request: _Request, cache: _KVCache):
+        self.request = request
+        self.cache = cache
+        self.tokens: List[int] = []
+        self.counts: Dict[int, int] = {}
+        self.logprob_sum = 0.0
+        self.token_logprobs: List[float] = []
+        self.top_logprobs: List[Dict[str, float]] = []
+        self.data = b''
+        self.text = ''
+        self.emitted = 0
+        self.finish_reason: Optional[str] = None
+
+
+class _Engine():
+    """
+    Generates the completions of one model on a background thread with continuous batching. Every step runs one
+    forward pass over the next token of every running sequence together with the prompts of newly arrived requests,
+    so concurrent create_completion calls share the matrix multiplications instead of taking turns.
+    Requests join and leave the batch between steps.
+    """
+    def __init__(self, model: GPT2, tokenizer: GPT2Tokenizer, max_batch_size: int, prefix_cache: _PrefixCache, seed: Optional[int] = None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        self.steps = 0
+        self.sequence_steps = 0
+        self._rng = np.random.default_rng(seed)
+        self._queue: "queue.Queue[_Request]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, request: _Request):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='openlm-local', daemon=True)
+                self._thread.start()
+        self._queue.put(request)
+
+    def stats(self) -> Dict[str, Any]:
+        cache = self.prefix_cache
+        return {
+            'steps': self.steps,
+            'mean_batch_size': self.sequence_steps / self.steps if self.steps else 0.0,
+            'prefix_cache_blocks': len(cache.blocks),
+            'prefix_cache_hit_rate': cache.hit_tokens / (cache.hit_tokens + cache.miss_tokens) if cache.hit_tokens + cache.miss_tokens else 0.0,
+        }
+
+    def _run(self):
+        active: List[_Sequence] = []
+        # The next request, held back until its n sequences fit in the batch
+        waiting: Optional[_Request] = None
+        while True:
+            admitted = []
+            if not active and waiting is None:
+                waiting = self._queue.get()
+            slots = self.max_batch_size - len(active)
+            while True:
+                if waiting is None:
+                    try:
+                        waiting = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                if waiting.n > slots:
+                    break
+                admitted.append(waiting)
+                slots -= waiting.n
+                waiting = None
+            try:
+                active = self._step(active, admitted)
+            except Exception as e:
+                for request in {id(seq.request): seq.request for seq in active}.values():
+                    self._fail(request, e)
+                for request in admitted:
+                    self._fail(request, e)
+                active = []
+
+    def _step(self, active: List[_Sequence], admitted: List[_Request]) -> List[_Sequence]:
+        active = [seq for seq in active if not seq.request.cancelled.is_set()]
+        inputs = [([seq.tokens[-1]], seq.cache) for seq in active]
+        prefills = []
+        for request in admitted:
+            if request.cancelled.is_set():
+                continue
+            cache = self.model.new_cache(min(self.model.n_positions, len(request.prompt_ids) + request.max_tokens))
+            start = self.prefix_cache.load(request.prompt_ids, cache)
+            inputs.append((request.prompt_ids[start:], cache))
+            prefills.append((request, cache))
+        if not inputs:
+            return []
+        logits = self.model.forward(inputs)
+        self.steps += 1
+        self.sequence_steps += len(inputs)
+        for seq, row in zip(active, logits):
+            self._advance(seq, row)
+        for (request, cache), row in zip(prefills, logits[len(active):]):
+            self.prefix_cache.store(request.prompt_ids, cache)
+            # The n samples of a prompt share its prefill and fork the cache
+            request.sequences = [_Sequence(request, cache if i == 0 else cache.copy()) for i in range(request.n)]
+            for seq in request.sequences:
+                self._advance(seq, row)
+                active.append(seq)
+        return [seq for seq in active if seq.finish_reason is None]
+
+    def _advance(self, seq: _Sequence, logits: "np.ndarray"):
+        request = seq.request
+        token, logprobs = self._sample(seq, logits)
+        if token == self.tokenizer.eos_token_id:
+            return self._finish(seq, 'stop')
+        seq.tokens.append(token)
+        seq.counts[token] = seq.counts.get(token, 0) + 1
+        seq.logprob_sum += float(logprobs[token])
+        if request.logprobs is not None:
+            seq.token_logprobs.append(float(logprobs[token]))
+            k = min(request.logprobs, len(logprobs) - 1)
+            top = np.argpartition(-logprobs, k)[:k] if k > 0 else []
+            seq.top_logprobs.append({self.tokenizer.decode([int(i)]): float(logprobs[i]) for i in top})
+        seq.data += self.tokenizer.decode_bytes([token])
+        # A character split across tokens shows up once its last byte is generated
+        seq.text = seq.data.decode('utf-8', errors='ignore')
+        stops = [i for i in (seq.text.find(stop) for stop in request.stop) if i >= 0]
+        if stops:
+            seq.text = seq.text[:min(stops)]
+            return self._finish(seq, 'stop')
+        if len(seq.tokens) >= request.max_tokens or seq.cache.length >= seq.cache.capacity:
+            return self._finish(seq, 'length')
+        if request.stream:
+            # Text that could be the start of a stop sequence is held back
+            end = len(seq.text) - max((len(stop) for stop in request.stop), default=1) + 1
+            if end > seq.emitted:
+                request.events.put(seq.text[seq.emitted:end])
+                seq.emitted = end
+
+    def _sample(self, seq: _Sequence, logits: "np.ndarray") -> Tuple[int, "np.ndarray"]:
+        request = seq.request
+        logits = logits.astype(np.float64)
+        for token, bias in request.logit_bias.items():
+            logits[token] += bias
+        if seq.counts and (request.presence_penalty or request.frequency_penalty):
+            tokens = np.fromiter(seq.counts.keys(), dtype=np.int64)
+            counts = np.fromiter(seq.counts.values(), dtype=np.float64)
+            logits[tokens] -= request.frequency_penalty * counts + request.presence_penalty
+        logprobs = logits - logits.max()
+        logprobs -= np.log(np.exp(logprobs).sum())
+        if request.temperature == 0:
+            return int(np.argmax(logprobs)), logprobs
+        probs = np.exp((logprobs - logprobs.max()) / request.temperature)
+        candidates = None
+        if request.top_p is not None and request.top_p < 1:
+            candidates = np.argsort(-probs)
+            cumulative = np.cumsum(probs[candidates])
+            candidates = candidates[:int(np.searchsorted(cumulative, request.top_p * cumulative[-1])) + 1]
+            probs = probs[candidates]
+        cumulative = np.cumsum(probs)
+        i = min(int(np.searchsorted(cumulative, self._rng.random() * cumulative[-1], side='right')), len(probs) - 1)
+        return int(candidates[i] if candidates is not None else i), logprobs
+
+    def _finish(self, seq: _Sequence, reason: str):
+        request = seq.request
+        seq.finish_reason = reason
+        if request.stream and len(seq.text) > seq.emitted:
+            request.events.put(seq.text[seq.emitted:])
+            seq.emitted = len(seq.text)
+        request.finished += 1
+        if request.finished == request.n:
+            request.events.put(None)
+
+    def _fail(self, request: _Request, error: BaseException):
+        if request.finished < request.n:
+            request.error = error
+            request.finished = request.n
+            request.events.put(None)
+
+
+class Local(BaseModel):
+    """
+    Runs GPT-2 family models, e.g. gpt2 or distilgpt2, from local Hugging Face model directories on the CPU.
+    Each directory needs config.json, model.safetensors, vocab.json and merges.txt. Needs `pip install openlm[local]`.
+
+    Weights are memory-mapped rather than read, so loading is instant and processes serving the same model share
+    its pages. Each model runs on its own background thread that batches the tokens of concurrent calls into one
+    forward pass, and reuses the attention keys and values of prompts sharing a prefix with recent ones.
+
+    :param models: Model names mapped to their directories, or a list of directories named after their model.
+    :param namespace: The namespace of the models.
+    :param max_batch_size: The maximum number of sequences generated together.
+    :param prefix_cache_tokens: The number of prompt tokens per model whose keys and values are kept for reuse, 0 to disable.
+    :param block_size: The granularity in tokens at which prompt prefixes are shared.
+    :param seed: The seed of the sampler, for reproducible completions.
+    """
+    max_samples = 16
+
+    def __init__(self, models: Union[Dict[str, str], List[str]],
+                       namespace: str = 'local',
+                       max_batch_size: int = 16,
+                       prefix_cache_tokens: int = 4096,
+                       block_size: int = 16,
+                       seed: Optional[int] = None):
+        if np is None:
+            raise ImportError("numpy is required for local models. Install it with `pip install openlm[local]`")
+        if not isinstance(models, dict):
+            models = {os.path.basename(os.path.normpath(path)): path for path in models}
+        self.paths = {name: os.path.expanduser(path) for name, path in models.items()}
+        self._namespace = namespace
+        # Prompts of a batch are submitted together and join the same forward passes
+        self.max_batch_size = max_batch_size
+        # Completion splits larger n into several calls, since a request's samples must fit in one batch
+        self.max_samples = min(self.max_samples, max_batch_size)
+        self.prefix_cache_tokens = prefix_cache_tokens
+        self.block_size = block_size
+        self.seed = seed
+        self._engines: Dict[str, _Engine] = {}
+        self._lock = threading.Lock()
+        self._register_models()
+
+    def __getstate__(self):
+        # A copy in a worker process loads its own engines, sharing the memory-mapped weights
+        state = self.__dict__.copy()
+        del state['_engines'], state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._engines = {}
+        self._lock = threading.Lock()
+        self._register_models()
+
+    def _register_models(self):
+        for name, path in self.paths.items():
+            fqn = f'{self._namespace}/{name}'
+            with open(os.path.join(path, 'config.json'), encoding='utf-8') as f:
+                config = json.load(f)
+            CONTEXT_WINDOWS[fqn] = config.get('n_positions') or config.get('n_ctx')
+            # Usage and overlength checks count with the model's own tokenizer
+            register_tokenizer(fqn, lambda name: self._engine(name).tokenizer)
+
+    def list_models(self):
+        return list(self.paths)
+
+    def namespace(self):
+        return self._namespace
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Returns the number of forward passes, the mean number of sequences per pass and the prefix cache hit rate
+        of every loaded model.
+        """
+        return {name: engine.stats() for name, engine in self._engines.items()}
+
+    def create_completion(self, model: Union[str, List[str]], prompt: Union[str, List[str]],
+                                suffix: Optional[str] = None,
+                                max_tokens: Optional[int] = None,
+                                temperature: Optional[float] = None,
+                                top_p: Optional[float] = None,
+                                n: Optional[int] = None,
+                                stream: Optional[bool] = None,
+                                logprobs: Optional[int] = None,
+                                echo: Optional[bool] = None,
+                                stop: Optional[Union[str, List[str]]] = None,
+                                presence_penalty: Optional[float] = None,
+                                frequency_penalty: Optional[float] = None,
+                                best_of: Optional[int] = None,
+                                logit_bias: Optional[Dict[str, float]] = None,
+                                user: Optional[str] = None) -> Dict[str, Any]:
+        return self.create_completions_batch(model, [prompt],
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            n=n,
+            logprobs=logprobs,
+            echo=echo,
+            stop=stop,
+            presence_penalty=presence_penalty,
+            frequency_penalty=frequency_penalty,
+            logit_bias=logit_bias)[0]
+
+    def create_completions_batch(self, model: str, prompts: List[str], **kwargs) -> List[Dict[str, Any]]:
+        engine = self._engine(model)
+        requests = [self._request(engine, prompt, kwargs, kwargs.get('n') or 1) for prompt in prompts]
+        for request in requests:
+            engine.submit(request)
+        try:
+            for request in requests:
+                for _ in self._events(request):
+                    pass
+        finally:
+            for request in requests:
+                request.cancelled.set()
+        return [self._convert_response(engine, request, prompt, kwargs.get('echo')) for request, prompt in zip(requests, prompts)]
+
+    def stream_completion(self, model: str, prompt: str, **kwargs) -> Iterator[Dict[str, Any]]:
+        engine = self._engine(model)
+        request = self._request(engine, prompt, kwargs, 1, stream=True)
+        engine.submit(request)
+        try:
+            if kwargs.get('echo'):
+                yield {'text': prompt, 'finish_reason': None}
+            for text in self._events(request):
+                yield {'text': text, 'finish_reason': None}
+        finally:
+            # Stops generating if the caller stops iterating early
+            request.cancelled.set()
+        seq = request.sequences[0]
+        yield {'text': '', 'finish_reason': seq.finish_reason, 'usage': self._usage(request)}
+
+    def _engine(self, model: str) -> _Engine:
+        engine = self._engines.get(model)
+        if engine is not None:
+            return engine
+        with self._lock:
+            if model not in self._engines:
+                if model not in self.paths:
+                    raise ValueError(f"Unknown local model {model}")
+                path = self.paths[model]
+                self._engines[model] = _Engine(GPT2(path), GPT2Tokenizer(path), self.max_batch_size,
+                                               _PrefixCache(self.prefix_cache_tokens // self.block_size, self.block_size), self.seed)
+            return self._engines[model]
+
+    def _request(self, engine: _Engine, prompt: str, params: Dict[str, Any], n: int, stream: bool = False) -> _Request:
+        # GPT-2 starts unconditional text after its end of text token
+        prompt_ids = engine.tokenizer.encode(prompt) or [engine.tokenizer.eos_token_id]
+        if len(prompt_ids) >= engine.model.n_positions:
+            raise ValueError(f"The prompt is {len(prompt_ids)} tokens, over the {engine.model.n_positions} token context window")
+        if n > engine.max_batch_size:
+            raise ValueError(f"n is {n}, over the {engine.max_batch_size} sequences a batch can hold")
+        return _Request(prompt_ids, params, n, stream)
+
+    def _events(self, request: _Request) -> Iterator[str]:
+        while True:
+            try:
+                remaining = remaining_time()
+                event = request.events.get(timeout=max(0.0, remaining) if remaining is not None else None)
+            except queue.Empty:
+                raise TimeoutError("Local generation timed out")
+            if event is None:
+                break
+            yield event
+        if request.error is not None:
+            raise request.error
+
+    def _usage(self, request: _Request) -> Dict[str, int]:
+        prompt_tokens = len(request.prompt_ids)
+        completion_tokens = sum(len(seq.tokens) for seq in request.sequences)
+        return {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+        }
+
+    def _convert_response(self, engine: _Engine, request: _Request, prompt: str, echo: Optional[bool]) -> Dict[str, Any]:
+        samples = [self._convert_sequence(engine, seq, prompt, echo) for seq in request.sequences]
+        result = {**samples[0], 'usage': self._usage(request)}
+        if len(samples) > 1:
+            result['samples'] = samples
+        return result
+
+    def _convert_sequence(self, engine: _Engine, seq: _Sequence, prompt: str, echo: Optional[bool]) -> Dict[str, Any]:
+        sample = {
+            'text': prompt + seq.text if echo else seq.text,
+            'finish_reason': seq.finish_reason,
+        }
+        if seq.tokens:
+            sample['score'] = seq.logprob_sum / len(seq.tokens)
+        if seq.request.logprobs is not None:
+            tokens = [engine.tokenizer.decode([token]) for token in seq.tokens]
+            # Offsets are into the returned text, which only starts with the prompt when it is echoed
+            offsets = [len(prompt) if echo else 0]
+            for token in tokens[:-1]:
+                offsets.append(offsets[-1] + len(token))
+            sample['logprobs'] = {
+                'tokens': tokens,
+                'token_logprobs': seq.token_logprobs,
+                'top_logprobs': seq.top_logprobs,
+                'text_offset': offsets[:len(tokens)],
+            }
+        return sample
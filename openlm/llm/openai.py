@@ -1,10 +1,10 @@
 import json
 import os
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, AsyncIterator, Dict, Iterator, List, Mapping, Optional, Union
 
-import requests
-
-from openlm.llm.base import BaseModel
+from openlm.llm.base import BaseChatModel, BaseModel, ProviderError, split_usage
+from openlm.llm.http import (DEFAULT_CONNECT_TIMEOUT, DEFAULT_POOL_SIZE, DEFAULT_READ_TIMEOUT, async_available, async_session,
+                             client_timeout, default_session, raise_for_status, request_timeout, sse_data)
 
 openai_models = [
             'text-davinci-003', 
@@ -20,13 +20,33 @@ openai_models = [
             'davinci',
         ]
 
-class OpenAI(BaseModel):
+openai_chat_models = [
+            'gpt-3.5-turbo',
+            'gpt-3.5-turbo-16k',
+            'gpt-4',
+            'gpt-4-32k',
+        ]
+
+class OpenAI(BaseModel, BaseChatModel):
+    max_samples = 128
+    max_chat_samples = 128
+    supports_best_of = True
+
     def __init__(self,
-                 api_key = os.environ.get("OPENAI_API_KEY"), 
+                 api_key = None,
                  model_list = openai_models, 
                  namespace = 'openai.com', 
-                 base_url = 'https://api.openai.com/v1/completions'):
-        
+                 base_url = 'https://api.openai.com/v1/completions',
+                 session = None,
+                 pool_size = DEFAULT_POOL_SIZE,
+                 max_batch_size = 20,
+                 connect_timeout = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout = DEFAULT_READ_TIMEOUT,
+                 chat_model_list = openai_chat_models,
+                 chat_url = None):
+        # Read at instantiation rather than import, so keys set after `import openlm` are picked up
+        if api_key is None:
+            api_key = os.environ.get("OPENAI_API_KEY")
         if api_key is None:
             raise ValueError("OPENAI_API_KEY is not set or passed as an argument")
         
@@ -34,6 +54,13 @@ class OpenAI(BaseModel):
         self.model_list = model_list
         self._namespace = namespace
         self.base_url = base_url
+        self.chat_model_list = chat_model_list
+        self.chat_url = chat_url if chat_url is not None else base_url.replace('/completions', '/chat/completions')
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_batch_size = max_batch_size
+        self.session = session if session is not None else default_session(pool_size=pool_size)
 
     def create_completion(self, model: Union[str, List[str]], prompt: Union[str, List[str]],
                                 suffix: Optional[str] = None,
@@ -50,44 +77,268 @@ class OpenAI(BaseModel):
                                 best_of: Optional[int] = None,
                                 logit_bias: Optional[Dict[str, float]] = None,
                                 user: Optional[str] = None) -> Dict[str, Any]:
+        url, headers, data = self._build_request(model, prompt,
+            suffix=suffix,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            n=n,
+            stream=stream,
+            logprobs=logprobs,
+            echo=echo,
+            stop=stop,
+            presence_penalty=presence_penalty,
+            frequency_penalty=frequency_penalty,
+            best_of=best_of,
+            logit_bias=logit_bias,
+            user=user)
+        resp = self.session.post(url, headers=headers, data=data, timeout=request_timeout(self.connect_timeout, self.read_timeout))
+        return self._handle_response(resp.status_code, resp.text, resp.headers)
+
+    async def acreate_completion(self, model: Union[str, List[str]], prompt: Union[str, List[str]],
+                                suffix: Optional[str] = None,
+                                max_tokens: Optional[int] = None,
+                                temperature: Optional[float] = None,
+                                top_p: Optional[float] = None,
+                                n: Optional[int] = None,
+                                stream: Optional[bool] = None,
+                                logprobs: Optional[int] = None,
+                                echo: Optional[bool] = None,
+                                stop: Optional[Union[str, List[str]]] = None,
+                                presence_penalty: Optional[float] = None,
+                                frequency_penalty: Optional[float] = None,
+                                best_of: Optional[int] = None,
+                                logit_bias: Optional[Dict[str, float]] = None,
+                                user: Optional[str] = None) -> Dict[str, Any]:
+        params = dict(
+            suffix=suffix,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            n=n,
+            stream=stream,
+            logprobs=logprobs,
+            echo=echo,
+            stop=stop,
+            presence_penalty=presence_penalty,
+            frequency_penalty=frequency_penalty,
+            best_of=best_of,
+            logit_bias=logit_bias,
+            user=user)
+        if not async_available():
+            return await super().acreate_completion(model, prompt, **params)
+        url, headers, data = self._build_request(model, prompt, **params)
+        async with async_session(self.pool_size).post(url, headers=headers, data=data, timeout=client_timeout(self.connect_timeout, self.read_timeout)) as resp:
+            return self._handle_response(resp.status, await resp.text(), resp.headers)
+
+    def create_completions_batch(self, model: str, prompts: List[str], **kwargs) -> List[Dict[str, Any]]:
+        url, headers, data = self._build_request(model, prompts, **kwargs)
+        resp = self.session.post(url, headers=headers, data=data, timeout=request_timeout(self.connect_timeout, self.read_timeout))
+        return self._handle_batch_response(resp.status_code, resp.text, resp.headers, prompts, kwargs.get('n'))
+
+    async def acreate_completions_batch(self, model: str, prompts: List[str], **kwargs) -> List[Dict[str, Any]]:
+        if not async_available():
+            return await super().acreate_completions_batch(model, prompts, **kwargs)
+        url, headers, data = self._build_request(model, prompts, **kwargs)
+        async with async_session(self.pool_size).post(url, headers=headers, data=data, timeout=client_timeout(self.connect_timeout, self.read_timeout)) as resp:
+            return self._handle_batch_response(resp.status, await resp.text(), resp.headers, prompts, kwargs.get('n'))
+
+    def stream_completion(self, model: str, prompt: str, **kwargs) -> Iterator[Dict[str, Any]]:
+        kwargs['stream'] = True
+        url, headers, data = self._build_request(model, prompt, **kwargs)
+        with self.session.post(url, headers=headers, data=data, stream=True, timeout=request_timeout(self.connect_timeout, self.read_timeout)) as resp:
+            if resp.status_code != 200:
+                self._handle_response(resp.status_code, resp.text, resp.headers)
+            for line in resp.iter_lines():
+                chunk = self._parse_stream_line(line)
+                if chunk is not None:
+                    yield chunk
+
+    async def astream_completion(self, model: str, prompt: str, **kwargs) -> AsyncIterator[Dict[str, Any]]:
+        if not async_available():
+            async for chunk in super().astream_completion(model, prompt, **kwargs):
+                yield chunk
+            return
+        kwargs['stream'] = True
+        url, headers, data = self._build_request(model, prompt, **kwargs)
+        async with async_session(self.pool_size).post(url, headers=headers, data=data, timeout=client_timeout(self.connect_timeout, self.read_timeout)) as resp:
+            if resp.status != 200:
+                self._handle_response(resp.status, await resp.text(), resp.headers)
+            async for line in resp.content:
+                chunk = self._parse_stream_line(line.rstrip(b'\r\n'))
+                if chunk is not None:
+                    yield chunk
+
+    def create_chat_completion(self, model: str, messages: List[Dict[str, str]], **kwargs) -> Dict[str, Any]:
+        url, headers, data = self._build_chat_request(model, messages, **kwargs)
+        resp = self.session.post(url, headers=headers, data=data, timeout=request_timeout(self.connect_timeout, self.read_timeout))
+        return self._handle_chat_response(resp.status_code, resp.text, resp.headers)
+
+    async def acreate_chat_completion(self, model: str, messages: List[Dict[str, str]], **kwargs) -> Dict[str, Any]:
+        if not async_available():
+            return await super().acreate_chat_completion(model, messages, **kwargs)
+        url, headers, data = self._build_chat_request(model, messages, **kwargs)
+        async with async_session(self.pool_size).post(url, headers=headers, data=data, timeout=client_timeout(self.connect_timeout, self.read_timeout)) as resp:
+            return self._handle_chat_response(resp.status, await resp.text(), resp.headers)
+
+    def stream_chat_completion(self, model: str, messages: List[Dict[str, str]], **kwargs) -> Iterator[Dict[str, Any]]:
+        url, headers, data = self._build_chat_request(model, messages, stream=True, **kwargs)
+        with self.session.post(url, headers=headers, data=data, stream=True, timeout=request_timeout(self.connect_timeout, self.read_timeout)) as resp:
+            if resp.status_code != 200:
+                self._handle_chat_response(resp.status_code, resp.text, resp.headers)
+            for line in resp.iter_lines():
+                chunk = self._parse_chat_stream_line(line)
+                if chunk is not None:
+                    yield chunk
+
+    async def astream_chat_completion(self, model: str, messages: List[Dict[str, str]], **kwargs) -> AsyncIterator[Dict[str, Any]]:
+        if not async_available():
+            async for chunk in super().astream_chat_completion(model, messages, **kwargs):
+                yield chunk
+            return
+        url, headers, data = self._build_chat_request(model, messages, stream=True, **kwargs)
+        async with async_session(self.pool_size).post(url, headers=headers, data=data, timeout=client_timeout(self.connect_timeout, self.read_timeout)) as resp:
+            if resp.status != 200:
+                self._handle_chat_response(resp.status, await resp.text(), resp.headers)
+            async for line in resp.content:
+                chunk = self._parse_chat_stream_line(line.rstrip(b'\r\n'))
+                if chunk is not None:
+                    yield chunk
+
+    def _build_request(self, model: str, prompt: Union[str, List[str]], **params):
         headers = {'Content-Type': 'application/json',
                 'Authorization': f'Bearer {self.api_key}'}
         payload = {
             'model': model,
             'prompt': prompt,
-            'suffix': suffix,
-            'max_tokens': max_tokens,
-            'temperature': temperature,
-            'top_p': top_p,
-            'n': n,
-            'stream': stream,
-            'logprobs': logprobs,
-            'echo': echo,
-            'stop': stop,
-            'presence_penalty': presence_penalty,
-            'frequency_penalty': frequency_penalty,
-            'best_of': best_of,
-            'logit_bias': logit_bias,
-            'user': user
+            **params,
+        }
+        return self.base_url, headers, json.dumps({k: v for k, v in payload.items() if v is not None})
+
+    def _build_chat_request(self, model: str, messages: List[Dict[str, str]], **params):
+        headers = {'Content-Type': 'application/json',
+                'Authorization': f'Bearer {self.api_key}'}
+        payload = {
+            'model': model,
+            # The chat endpoint takes the messages as they are, without any fields of ours
+            'messages': [{'role': message['role'], 'content': message['content']} for message in messages],
+            **params,
+        }
+        return self.chat_url, headers, json.dumps({k: v for k, v in payload.items() if v is not None})
+
+    def _handle_chat_response(self, status_code: int, text: str, headers: Optional[Mapping[str, str]] = None) -> Dict[str, Any]:
+        raise_for_status(status_code, text, headers)
+        resp = json.loads(text)
+        if 'error' in resp:
+            raise ProviderError(resp['error'], status_code=status_code)
+        choices = sorted(resp['choices'], key=lambda choice: choice['index'])
+        result = {
+            'text': choices[0]['message'].get('content') or '',
+            'finish_reason': choices[0].get('finish_reason'),
+            'extra': {
+                'id': resp['id'],
+            },
+            'usage': resp['usage'],
+        }
+        if len(choices) > 1:
+            result['samples'] = [{
+                'text': choice['message'].get('content') or '',
+                'finish_reason': choice.get('finish_reason'),
+            } for choice in choices]
+        return result
+
+    def _parse_chat_stream_line(self, line: bytes) -> Optional[Dict[str, Any]]:
+        data = sse_data(line)
+        if data is None or data == '[DONE]':
+            return None
+        event = json.loads(data)
+        if 'error' in event:
+            raise ProviderError(event['error'])
+        choice = event['choices'][0]
+        return {
+            'text': choice.get('delta', {}).get('content') or '',
+            'finish_reason': choice.get('finish_reason'),
+            'extra': {
+                'id': event['id'],
+            },
         }
 
-        payload_str = json.dumps({k: v for k, v in payload.items() if v is not None})
-        resp = requests.post(self.base_url, headers=headers, data=payload_str).json()
+    def _handle_response(self, status_code: int, text: str, headers: Optional[Mapping[str, str]] = None) -> Dict[str, Any]:
+        raise_for_status(status_code, text, headers)
+        resp = json.loads(text)
         if 'error' in resp:
-            raise ValueError(resp['error'])
+            raise ProviderError(resp['error'], status_code=status_code)
         return self._convert_response(resp)
 
-    def _convert_response(self, response: Dict[str, Any]) -> Dict[str, Any]:
+    def _handle_batch_response(self, status_code: int, text: str, headers: Optional[Mapping[str, str]], prompts: List[str], n: Optional[int]) -> List[Dict[str, Any]]:
+        raise_for_status(status_code, text, headers)
+        resp = json.loads(text)
+        if 'error' in resp:
+            raise ProviderError(resp['error'], status_code=status_code)
+        # Choices for prompt i are at indices i*n to (i+1)*n - 1
+        n = n or 1
+        choices = sorted(resp['choices'], key=lambda choice: choice['index'])
+        usages = split_usage(resp['usage'], len(prompts))
+        results = []
+        for i in range(len(prompts)):
+            result = {
+                'text': choices[i * n]['text'],
+                'extra': {
+                    'id': resp['id'],
+                },
+                'usage': usages[i],
+            }
+            if n > 1:
+                result['samples'] = [self._convert_choice(choice) for choice in choices[i * n:(i + 1) * n]]
+            results.append(result)
+        return results
+
+    def _parse_stream_line(self, line: bytes) -> Optional[Dict[str, Any]]:
+        data = sse_data(line)
+        if data is None or data == '[DONE]':
+            return None
+        event = json.loads(data)
+        if 'error' in event:
+            raise ProviderError(event['error'])
+        choice = event['choices'][0]
         return {
-            'text': response['choices'][0]['text'],
+            'text': choice['text'],
+            'finish_reason': choice.get('finish_reason'),
+            'extra': {
+                'id': event['id'],
+            },
+        }
+
+    def _convert_response(self, response: Dict[str, Any]) -> Dict[str, Any]:
+        choices = sorted(response['choices'], key=lambda choice: choice['index'])
+        result = {
+            'text': choices[0]['text'],
             'extra': {
                 'id': response['id'],
             },
             'usage': response['usage'],
         }
+        if len(choices) > 1:
+            result['samples'] = [self._convert_choice(choice) for choice in choices]
+        return result
+
+    def _convert_choice(self, choice: Dict[str, Any]) -> Dict[str, Any]:
+        sample = {
+            'text': choice['text'],
+            'finish_reason': choice.get('finish_reason'),
+        }
+        if choice.get('logprobs') is not None:
+            sample['logprobs'] = choice['logprobs']
+            token_logprobs = [p for p in choice['logprobs'].get('token_logprobs') or [] if p is not None]
+            if token_logprobs:
+                sample['score'] = sum(token_logprobs) / len(token_logprobs)
+        return sample
 
     def list_models(self):
         return self.model_list
+
+    def list_chat_models(self):
+        return self.chat_model_list
     
     def namespace(self):
         return self._namespace
\ No newline at end of file
@@ -1,17 +1,101 @@
 
-from typing import Any, Dict, List, Optional, Union
+import asyncio
+import atexit
+import contextlib
+import itertools
+import math
+import queue
+import threading
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 import uuid
-from openlm.llm import BaseModel, OpenAI, Huggingface, Cohere
+from openlm.adaptive import AdaptiveLimit
+from openlm.cache import BaseCache, cache_key, is_deterministic
+from openlm.concurrency import Limiter
+from openlm.fair import BATCH, INTERACTIVE, FairScheduler, check_rejected, current_slot, scheduled
+from openlm.instrumentation import CallRecord, Metrics, emit
+from openlm.llm import BaseModel
+from openlm.llm.base import BaseChatModel
+from openlm.llm.base import split_usage
+from openlm.llm.http import DEFAULT_POOL_SIZE, remaining_time, reset_deadline, reset_observer, set_deadline, set_observer
+from openlm.ratelimit import RateLimit, estimate_tokens
+from openlm.retry import RetryPolicy
+from openlm.semantic_cache import SemanticCache
+from openlm.routing import FAILOVER, FASTEST, ROUTING_MODES, LatencyStats, rank_by_latency
+from openlm.singleflight import SingleFlight
+from openlm.tokenizers import OVERLENGTH_POLICIES, TRUNCATE, context_window, count_usage, fill_usage, get_tokenizer
 import time
 import openlm
+import concurrent.futures
 from concurrent.futures import ThreadPoolExecutor
 
 class Completion():
     """
     OpenAI-compatible completion API
     """
-    models = {}
-    aliases = {}
+    # Registered providers by fully qualified model name, and fully qualified names by alias.
+    # Both are replaced rather than mutated on register, so lookups never see a half-updated registry.
+    models: Dict[str, BaseModel] = {}
+    aliases: Dict[str, str] = {}
+    # The same for the native chat models of providers implementing BaseChatModel, used by ChatCompletion
+    chat_models: Dict[str, BaseChatModel] = {}
+    chat_aliases: Dict[str, str] = {}
+    # Number of worker threads shared by all create calls. Provider connection pools are sized to match.
+    max_workers = DEFAULT_POOL_SIZE
+    # Process-wide cap on upstream requests, shared by create and acreate. Defaults to max_workers.
+    max_in_flight: Optional[int] = None
+    # Per-namespace caps on upstream requests, e.g. {'huggingface.co': 4}
+    provider_concurrency: Dict[str, int] = {}
+    # Opt-in response cache. Only greedy (temperature=0) requests are cached unless cache_nondeterministic is set.
+    cache: Optional[BaseCache] = None
+    cache_nondeterministic = False
+    # Optional cache that also answers prompts similar to a cached one, consulted after cache misses
+    semantic_cache: Optional[SemanticCache] = None
+    # Share one upstream call between concurrent identical deterministic requests
+    coalesce = True
+    coalesce_nondeterministic = False
+    _flights = SingleFlight()
+    # Retries for transient provider errors (429s, 5xx, connection failures)
+    retry = RetryPolicy()
+    # Client-side rate limits per provider namespace, e.g. {'openai.com': RateLimit(requests_per_minute=3000)}
+    rate_limits: Dict[str, RateLimit] = {}
+    # Concurrency limits per provider namespace that adapt to the provider's latency and errors, e.g. {'huggingface.co': AdaptiveLimit()}
+    adaptive_concurrency: Dict[str, AdaptiveLimit] = {}
+    # Latency of upstream calls per fully qualified model name, used for routing
+    latency: Dict[str, LatencyStats] = {}
+    # Seconds to wait before hedging to a model without latency stats
+    default_hedge_delay = 2.0
+    # Per-model histograms and counters of upstream calls, e.g. Completion.metrics.prometheus()
+    metrics: Optional[Metrics] = Metrics()
+    # Called with a CallRecord after every upstream call, including calls whose error is folded into a choice
+    hooks: List[Callable[[CallRecord], None]] = []
+    # Count prompt and completion tokens locally for providers that don't report usage
+    local_usage = True
+    # What to do with prompts that don't fit in the model's context window with max_tokens: None sends them anyway,
+    # 'reject' returns an error choice without calling the provider and 'truncate' drops the start of the prompt
+    overlength: Optional[str] = None
+    # Number of worker processes create and create_iter shard prompts across, each with its own providers, connection pools
+    # and executor of max_workers threads. None completes every prompt on threads in this process.
+    processes: Optional[int] = None
+    # The maximum number of prompts sent to a worker process at a time
+    process_shard_size = 32
+    # Orders waiting upstream requests by priority and tenant (the request's user) instead of by arrival,
+    # e.g. FairScheduler(slo={'interactive': 5}). Inspect it with scheduler.stats().
+    scheduler: Optional[FairScheduler] = None
+
+    _executor: Optional[ThreadPoolExecutor] = None
+    _process_pool: Optional["concurrent.futures.ProcessPoolExecutor"] = None
+    # The registry the process pool was started with, so workers are replaced when providers are registered
+    _process_pool_models: Optional[Dict[str, BaseModel]] = None
+    _in_flight: Optional[Limiter] = None
+    _provider_limiters: Dict[str, Limiter] = {}
+    _executor_lock = threading.Lock()
+    # Aliases claimed by more than one model, and the aliases of each model
+    _ambiguous: Dict[str, List[str]] = {}
+    _reverse_aliases: Dict[str, List[str]] = {}
+    _chat_ambiguous: Dict[str, List[str]] = {}
+    _registry_lock = threading.RLock()
+    # The API keys the default providers were registered with, or None if they weren't registered yet
+    _default_keys: Optional[Tuple] = None
 
     @classmethod
     def create(cls, model: Union[str, List[str]], prompt: Union[str, List[str]],
@@ -30,7 +114,10 @@ class Completion():
                                 logit_bias: Optional[Dict[str, float]] = None,
                                 user: Optional[str] = None,
                                 api_keys: Optional[Dict[str, str]] = None,
-                                request_timeout=0) -> Dict[str, Any]:
+                                request_timeout=0,
+                                routing: Optional[str] = None,
+                                hedge_delay: Optional[float] = None,
+                                hedge_percentile: float = 0.95) -> Dict[str, Any]:
         """
         Creates a completion request for the OpenAI API.
 
@@ -40,84 +127,1615 @@ class Completion():
         :param max_tokens: The maximum number of tokens to generate in the completion(s).
         :param temperature: The sampling temperature to use.
         :param top_p: The nucleus sampling probability to use.
-        :param n: The number of completions to generate.
         :param stream: Whether to stream back partial progress updates.
         :param logprobs: The number of log probabilities to generate per token.
         :param echo: Whether to include the prompt(s) in the completion(s).
         :param stop: The stop sequence(s) to use.
         :param presence_penalty: The presence penalty to use.
         :param frequency_penalty: The frequency penalty to use.
-        :param best_of: The number of completions to generate and return the best of.
+        :param n: The number of completions to generate per prompt, each returned as its own choice at index prompt_index * n + sample.
+                  Providers that can't sample several completions in one call get one call per sample, in parallel.
+        :param best_of: The number of completions to generate per prompt, returning the n with the highest mean token log probability.
         :param logit_bias: A dictionary of token IDs and bias values to use.
         :param user: The ID of the user making the request.
-        :return: A dictionary containing the completion response.
+        :param api_keys: API keys per provider namespace.
+        :param request_timeout: The overall deadline in seconds for the whole request. Choices that aren't done
+                                by then are returned as timed-out errors. 0 or None waits for every choice.
+        :param routing: Instead of completing every prompt on every model, return one completion per prompt from the models in order:
+                        'failover' tries the next model when one fails, 'hedge' also sends the prompt to the next model when
+                        the current one hasn't answered after hedge_delay, and 'fastest' hedges with models ordered by observed latency.
+        :param hedge_delay: The number of seconds to wait before hedging. Defaults to the model's hedge_percentile latency.
+        :param hedge_percentile: The latency percentile (0-1) of the current model after which to hedge.
+        :return: A dictionary containing the completion response, or a generator of chunks when stream is set.
         """
-        cls.register_default()
+        cls._register_defaults(api_keys)
         if isinstance(model, str):
             model = [model]
 
         if isinstance(prompt, str):
             prompt = [prompt]
 
-        # Create a list of tuples, each containing all the parameters for a call to _generate_completion
-        args = [(m, p, suffix, max_tokens, temperature, top_p, n, stream, logprobs, echo, stop, presence_penalty, frequency_penalty, best_of, logit_bias, user) 
-                for m in model for p in prompt]
+        params = dict(suffix=suffix, max_tokens=max_tokens, temperature=temperature, top_p=top_p, n=n, stream=stream, logprobs=logprobs, echo=echo, stop=stop,
+                      presence_penalty=presence_penalty, frequency_penalty=frequency_penalty, best_of=best_of, logit_bias=logit_bias, user=user)
+
+        # Fail fast on unknown models before any request is started
+        for m in model:
+            cls._resolve(m)
+        cls._check_sampling(params)
+
+        # An overall deadline for the whole request, shared by every model and prompt
+        deadline = time.monotonic() + request_timeout if request_timeout else None
+
+        if routing is not None:
+            cls._check_routing(routing, params)
+            return cls._build_response(cls._route(model, prompt, params, routing, hedge_delay, hedge_percentile, deadline))
+
+        if stream:
+            return cls._stream(model, prompt, params, deadline)
+
+        if cls.processes:
+            return cls._build_response(cls._generate_in_processes(model, prompt, params, deadline))
+        return cls._build_response(cls._generate_choices(model, prompt, params, deadline))
+
+    @classmethod
+    def _generate_choices(cls, model: List[str], prompt: List[str], params: Dict[str, Any], deadline: Optional[float],
+                          priority: str = INTERACTIVE) -> List[Dict[str, Any]]:
+        """
+        Completes every prompt on every model and returns the tagged choices in (model, prompt, sample) order.
+        """
+        # Group each model's prompts into as few upstream calls as its provider allows
+        # and run them in parallel on the shared executor
+        executor = cls._get_executor()
+        futures = []
+        with scheduled(params['user'], priority):
+            for model_idx, m in enumerate(model):
+                for batch, sample, call in cls._calls(m, prompt, params):
+                    if len(batch) == 1:
+                        future = executor.submit(cls._generate_completion, m, batch[0], **call, deadline=deadline, sample=sample)
+                    else:
+                        future = executor.submit(cls._generate_batch, m, batch, call, deadline)
+                    futures.append((future, model_idx, m, len(batch) * (call['n'] or 1)))
+
+        concurrent.futures.wait([future for future, _, _, _ in futures], timeout=cls._remaining(deadline))
+
+        # Calls cover consecutive prompts and samples, so flattening keeps choices in (model, prompt, sample) order.
+        # Requests still running at the deadline are cancelled if possible and reported as timed out.
+        choices = [[] for _ in model]
+        for future, model_idx, m, count in futures:
+            if future.done():
+                result = future.result()
+                choices[model_idx].extend(result if isinstance(result, list) else [result])
+            else:
+                future.cancel()
+                choices[model_idx].extend(cls._timeout_choice(m) for _ in range(count))
+
+        return cls._tag_choices(cls._keep_best_of(model, choices, params), len(prompt), params['n'] or 1)
+
+    @classmethod
+    def _generate_in_processes(cls, model: List[str], prompt: List[str], params: Dict[str, Any], deadline: Optional[float]) -> List[Dict[str, Any]]:
+        """
+        Shards the prompts across the worker processes, which complete them like create does in this process,
+        and merges their choices back in (model, prompt, sample) order.
+        """
+        pool = cls._get_process_pool()
+        n = params['n'] or 1
+        size = max(1, min(cls.process_shard_size, math.ceil(len(prompt) / cls.processes)))
+        # Monotonic clocks aren't comparable between processes, so workers get the deadline as wall-clock time
+        expires = time.time() + cls._remaining(deadline) if deadline is not None else None
+        shards = []
+        for start in range(0, len(prompt), size):
+            shard = prompt[start:start + size]
+            shards.append((pool.submit(_complete_shard, model, shard, params, expires, INTERACTIVE), start, len(shard)))
+
+        concurrent.futures.wait([future for future, _, _ in shards], timeout=cls._remaining(deadline))
+
+        choices = []
+        for future, start, count in shards:
+            choices.extend(cls._shard_choices(future, model, start, count, n))
+        # Shards are in prompt order, so a stable sort by model restores (model, prompt, sample) order
+        choices.sort(key=lambda choice: choice['model_idx'])
+        return choices
+
+    @classmethod
+    def _shard_choices(cls, future: concurrent.futures.Future, model: List[str], start: int, count: int, n: int) -> List[Dict[str, Any]]:
+        """
+        Returns the choices of a shard of count prompts starting at prompt index start, reindexed from the shard's prompts
+        to the request's. A shard that is still running is cancelled and its choices are timed out, and a shard whose worker
+        failed has an error choice for each of its prompts and samples.
+        """
+        indices = [(model_idx, m, start * n + k) for model_idx, m in enumerate(model) for k in range(count * n)]
+        if not future.done():
+            future.cancel()
+            return [cls._tag_choice(cls._timeout_choice(m), model_idx, index) for model_idx, m, index in indices]
+        error = future.exception() if not future.cancelled() else TimeoutError("Request timed out")
+        if error is not None:
+            return [cls._tag_choice(cls._build_choice(cls._resolve(m), {'error': f"Error: {error}"}), model_idx, index)
+                    for model_idx, m, index in indices]
+        choices = future.result()
+        for choice in choices:
+            choice['index'] += start * n
+        return choices
+
+    @classmethod
+    async def acreate(cls, model: Union[str, List[str]], prompt: Union[str, List[str]],
+                                suffix: Optional[str] = None,
+                                max_tokens: Optional[int] = None,
+                                temperature: Optional[float] = None,
+                                top_p: Optional[float] = None,
+                                n: Optional[int] = None,
+                                stream: Optional[bool] = None,
+                                logprobs: Optional[int] = None,
+                                echo: Optional[bool] = None,
+                                stop: Optional[Union[str, List[str]]] = None,
+                                presence_penalty: Optional[float] = None,
+                                frequency_penalty: Optional[float] = None,
+                                best_of: Optional[int] = None,
+                                logit_bias: Optional[Dict[str, float]] = None,
+                                user: Optional[str] = None,
+                                api_keys: Optional[Dict[str, str]] = None,
+                                request_timeout=0,
+                                routing: Optional[str] = None,
+                                hedge_delay: Optional[float] = None,
+                                hedge_percentile: float = 0.95) -> Dict[str, Any]:
+        """
+        Async version of create. Takes the same parameters and returns the same response,
+        or an async generator of chunks when stream is set.
+        Providers with a native async client are awaited directly, others run in a worker thread.
+        """
+        cls._register_defaults(api_keys)
+        if isinstance(model, str):
+            model = [model]
+
+        if isinstance(prompt, str):
+            prompt = [prompt]
+
+        params = dict(suffix=suffix, max_tokens=max_tokens, temperature=temperature, top_p=top_p, n=n, stream=stream, logprobs=logprobs, echo=echo, stop=stop,
+                      presence_penalty=presence_penalty, frequency_penalty=frequency_penalty, best_of=best_of, logit_bias=logit_bias, user=user)
+
+        for m in model:
+            cls._resolve(m)
+        cls._check_sampling(params)
+
+        deadline = time.monotonic() + request_timeout if request_timeout else None
+
+        if routing is not None:
+            cls._check_routing(routing, params)
+            return cls._build_response(await cls._aroute(model, prompt, params, routing, hedge_delay, hedge_percentile, deadline))
+
+        if stream:
+            return cls._astream(model, prompt, params, deadline)
+
+        tasks = []
+        # Tasks copy the context they are created in, so the scheduler sees their tenant and priority
+        with scheduled(params['user'], INTERACTIVE):
+            for model_idx, m in enumerate(model):
+                for batch, sample, call in cls._calls(m, prompt, params):
+                    if len(batch) == 1:
+                        task = asyncio.ensure_future(cls._agenerate_completion(m, batch[0], **call, deadline=deadline, sample=sample))
+                    else:
+                        task = asyncio.ensure_future(cls._agenerate_batch(m, batch, call, deadline))
+                    tasks.append((task, model_idx, m, len(batch) * (call['n'] or 1)))
+
+        try:
+            await asyncio.wait([task for task, _, _, _ in tasks], timeout=cls._remaining(deadline))
+        finally:
+            for task, _, _, _ in tasks:
+                task.cancel()
+
+        choices = [[] for _ in model]
+        for task, model_idx, m, count in tasks:
+            if task.done() and not task.cancelled():
+                result = task.result()
+                choices[model_idx].extend(result if isinstance(result, list) else [result])
+            else:
+                choices[model_idx].extend(cls._timeout_choice(m) for _ in range(count))
+        return cls._build_response(cls._tag_choices(cls._keep_best_of(model, choices, params), len(prompt), params['n'] or 1))
+
+    @classmethod
+    def create_iter(cls, model: Union[str, List[str]], prompt: Union[str, Iterable[str]],
+                                suffix: Optional[str] = None,
+                                max_tokens: Optional[int] = None,
+                                temperature: Optional[float] = None,
+                                top_p: Optional[float] = None,
+                                n: Optional[int] = None,
+                                logprobs: Optional[int] = None,
+                                echo: Optional[bool] = None,
+                                stop: Optional[Union[str, List[str]]] = None,
+                                presence_penalty: Optional[float] = None,
+                                frequency_penalty: Optional[float] = None,
+                                best_of: Optional[int] = None,
+                                logit_bias: Optional[Dict[str, float]] = None,
+                                user: Optional[str] = None,
+                                api_keys: Optional[Dict[str, str]] = None,
+                                max_pending: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Like create, but yields each choice as soon as it completes instead of returning one response.
+        Choices come in completion order and are tagged with model_idx and index to tell them apart.
+
+        Prompts are read lazily and only max_pending upstream calls are outstanding at a time,
+        so large jobs can be written out as they go with constant memory.
+        With processes configured, prompts are sent to the worker processes in shards of process_shard_size,
+        and the choices of a shard are yielded together once it is done.
+
+        :param prompt: The prompt(s) to generate completions for. Can be any iterable, e.g. a generator reading a file.
+        :param max_pending: The maximum number of upstream calls started but not yet yielded. Defaults to twice max_workers.
+                            With processes, the maximum number of prompts sent to workers but not yet yielded,
+                            defaulting to two shards per process.
+        :return: A generator of choices.
+        """
+        cls._register_defaults(api_keys)
+        if isinstance(model, str):
+            model = [model]
+
+        if isinstance(prompt, str):
+            prompt = [prompt]
+
+        params = dict(suffix=suffix, max_tokens=max_tokens, temperature=temperature, top_p=top_p, n=n, stream=None, logprobs=logprobs, echo=echo, stop=stop,
+                      presence_penalty=presence_penalty, frequency_penalty=frequency_penalty, best_of=best_of, logit_bias=logit_bias, user=user)
+
+        for m in model:
+            cls._resolve(m)
+        cls._check_sampling(params)
+
+        if cls.processes:
+            yield from cls._iter_in_processes(model, prompt, params, max_pending)
+            return
+
+        max_pending = max_pending or 2 * cls.max_workers
+        executor = cls._get_executor()
+        pending: Dict[concurrent.futures.Future, Tuple[int, List[int], int, int]] = {}
+        samples = _Samples(cls, model, params)
+
+        def submit(model_idx, batch):
+            m = model[model_idx]
+            for sample, call in samples.calls[model_idx]:
+                with scheduled(params['user'], BATCH):
+                    if len(batch) == 1:
+                        future = executor.submit(cls._generate_completion, m, batch[0][1], **call, sample=sample)
+                    else:
+                        future = executor.submit(cls._generate_batch, m, [p for _, p in batch], call)
+                pending[future] = (model_idx, [i for i, _ in batch], sample, call['n'] or 1)
+
+        try:
+            for model_idx, batch in cls._iter_batches(model, prompt, samples.batch_sizes):
+                submit(model_idx, batch)
+                while len(pending) >= max_pending:
+                    yield from cls._completed(pending, samples)
+            while pending:
+                yield from cls._completed(pending, samples)
+        finally:
+            # Don't start queued calls if the caller stops iterating early
+            for future in pending:
+                future.cancel()
+
+    @classmethod
+    async def acreate_iter(cls, model: Union[str, List[str]], prompt: Union[str, Iterable[str]],
+                                suffix: Optional[str] = None,
+                                max_tokens: Optional[int] = None,
+                                temperature: Optional[float] = None,
+                                top_p: Optional[float] = None,
+                                n: Optional[int] = None,
+                                logprobs: Optional[int] = None,
+                                echo: Optional[bool] = None,
+                                stop: Optional[Union[str, List[str]]] = None,
+                                presence_penalty: Optional[float] = None,
+                                frequency_penalty: Optional[float] = None,
+                                best_of: Optional[int] = None,
+                                logit_bias: Optional[Dict[str, float]] = None,
+                                user: Optional[str] = None,
+                                api_keys: Optional[Dict[str, str]] = None,
+                                max_pending: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Async version of create_iter.
+        """
+        cls._register_defaults(api_keys)
+        if isinstance(model, str):
+            model = [model]
+
+        if isinstance(prompt, str):
+            prompt = [prompt]
+
+        params = dict(suffix=suffix, max_tokens=max_tokens, temperature=temperature, top_p=top_p, n=n, stream=None, logprobs=logprobs, echo=echo, stop=stop,
+                      presence_penalty=presence_penalty, frequency_penalty=frequency_penalty, best_of=best_of, logit_bias=logit_bias, user=user)
+
+        for m in model:
+            cls._resolve(m)
+        cls._check_sampling(params)
+
+        max_pending = max_pending or 2 * cls.max_workers
+        pending: Dict[asyncio.Task, Tuple[int, List[int], int, int]] = {}
+        samples = _Samples(cls, model, params)
+
+        def submit(model_idx, batch):
+            m = model[model_idx]
+            for sample, call in samples.calls[model_idx]:
+                with scheduled(params['user'], BATCH):
+                    if len(batch) == 1:
+                        task = asyncio.ensure_future(cls._agenerate_completion(m, batch[0][1], **call, sample=sample))
+                    else:
+                        task = asyncio.ensure_future(cls._agenerate_batch(m, [p for _, p in batch], call))
+                pending[task] = (model_idx, [i for i, _ in batch], sample, call['n'] or 1)
+
+        try:
+            for model_idx, batch in cls._iter_batches(model, prompt, samples.batch_sizes):
+                submit(model_idx, batch)
+                while len(pending) >= max_pending:
+                    for choice in await cls._acompleted(pending, samples):
+                        yield choice
+            while pending:
+                for choice in await cls._acompleted(pending, samples):
+                    yield choice
+        finally:
+            for task in pending:
+                task.cancel()
+
+    @classmethod
+    def _iter_in_processes(cls, model: List[str], prompt: Iterable[str], params: Dict[str, Any], max_pending: Optional[int]) -> Iterator[Dict[str, Any]]:
+        """
+        Reads prompts lazily in shards, completes them in the worker processes and yields the choices of each shard as it is done.
+        """
+        pool = cls._get_process_pool()
+        n = params['n'] or 1
+        max_shards = max(1, max_pending // cls.process_shard_size) if max_pending else 2 * cls.processes
+        pending: Dict[concurrent.futures.Future, Tuple[int, int]] = {}
+        prompts = iter(prompt)
+        start = 0
+        try:
+            while True:
+                shard = list(itertools.islice(prompts, cls.process_shard_size))
+                if not shard:
+                    break
+                pending[pool.submit(_complete_shard, model, shard, params, None, BATCH)] = (start, len(shard))
+                start += len(shard)
+                while len(pending) >= max_shards:
+                    yield from cls._shards_completed(pending, model, n)
+            while pending:
+                yield from cls._shards_completed(pending, model, n)
+        finally:
+            for future in pending:
+                future.cancel()
+
+    @classmethod
+    def _shards_completed(cls, pending: Dict[concurrent.futures.Future, Tuple[int, int]], model: List[str], n: int) -> Iterator[Dict[str, Any]]:
+        done, _ = concurrent.futures.wait(list(pending), return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            yield from cls._shard_choices(future, model, *pending.pop(future), n)
+
+    @classmethod
+    def _iter_batches(cls, model: List[str], prompts: Iterable[str], sizes: List[int]) -> Iterator[Tuple[int, List[Tuple[int, str]]]]:
+        """
+        Reads prompts lazily and yields (model_idx, [(prompt_idx, prompt), ...]) batches as soon as they are full.
+        """
+        buffers: List[List[Tuple[int, str]]] = [[] for _ in model]
+        for prompt_idx, p in enumerate(prompts):
+            for model_idx, buffer in enumerate(buffers):
+                buffer.append((prompt_idx, p))
+                if len(buffer) >= sizes[model_idx]:
+                    yield model_idx, buffer
+                    buffers[model_idx] = buffer = []
+        for model_idx, buffer in enumerate(buffers):
+            if buffer:
+                yield model_idx, buffer
+
+    @classmethod
+    def _completed(cls, pending: Dict[concurrent.futures.Future, Tuple[int, List[int], int, int]], samples: "_Samples") -> Iterator[Dict[str, Any]]:
+        """
+        Waits for at least one pending call and yields its tagged choices.
+        """
+        done, _ = concurrent.futures.wait(list(pending), return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            yield from samples.collect(future.result(), *pending.pop(future))
+
+    @classmethod
+    async def _acompleted(cls, pending: Dict[asyncio.Task, Tuple[int, List[int], int, int]], samples: "_Samples") -> List[Dict[str, Any]]:
+        done, _ = await asyncio.wait(list(pending), return_when=asyncio.FIRST_COMPLETED)
+        choices = []
+        for task in done:
+            choices.extend(samples.collect(task.result(), *pending.pop(task)))
+        return choices
+
+    @classmethod
+    def _tag_choices(cls, choices: List[Dict[str, Any]], prompts: int, n: int = 1) -> List[Dict[str, Any]]:
+        """
+        Tags choices that are in (model, prompt, sample) order with their model index and their index, prompt_index * n + sample.
+        """
+        return [cls._tag_choice(choice, k // (prompts * n), k % (prompts * n)) for k, choice in enumerate(choices)]
+
+    @classmethod
+    def _check_sampling(cls, params: Dict[str, Any]):
+        n, best_of = params['n'], params['best_of']
+        if n is not None and n < 1:
+            raise ValueError("n must be at least 1")
+        if best_of is not None and best_of < (n or 1):
+            raise ValueError("best_of must be greater than or equal to n")
+        if params['stream'] and best_of is not None and best_of > 1:
+            raise ValueError("best_of is not supported with stream=True")
+
+    @classmethod
+    def _draws(cls, model: str, params: Dict[str, Any]) -> int:
+        """
+        Returns the number of samples per prompt to draw from a model to return n of them.
+        Providers that don't pick the best of best_of themselves draw best_of, and the best n are kept.
+        """
+        n = params['n'] or 1
+        if cls.models[cls._resolve(model)].supports_best_of:
+            return n
+        return max(n, params['best_of'] or 1)
+
+    @classmethod
+    def _sample_calls(cls, model: str, params: Dict[str, Any]) -> List[Tuple[int, Dict[str, Any]]]:
+        """
+        Splits the samples of a prompt into upstream calls the provider can make, as (first sample, params) pairs.
+        """
+        provider = cls.models[cls._resolve(model)]
+        if provider.supports_best_of:
+            return [(0, params)]
+        draws = cls._draws(model, params)
+        if draws == 1:
+            return [(0, {**params, 'best_of': None})]
+        size = max(1, provider.max_samples)
+        return [(start, {**params, 'n': min(size, draws - start), 'best_of': None}) for start in range(0, draws, size)]
+
+    @classmethod
+    def _calls(cls, model: str, prompts: List[str], params: Dict[str, Any]) -> Iterator[Tuple[List[str], int, Dict[str, Any]]]:
+        """
+        Yields the upstream calls for a model's prompts as (prompts, first sample, params), in (prompt, sample) order.
+        Prompts are batched when the provider can draw all of their samples in one call.
+        """
+        calls = cls._sample_calls(model, params)
+        batches = cls._batches(model, prompts) if len(calls) == 1 else [[p] for p in prompts]
+        for batch in batches:
+            for sample, call in calls:
+                yield batch, sample, call
+
+    @classmethod
+    def _keep_best_of(cls, model: List[str], choices: List[List[Dict[str, Any]]], params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Flattens each model's choices, keeping the best n samples of each prompt when more were drawn for best_of.
+        """
+        n = params['n'] or 1
+        kept = []
+        for m, model_choices in zip(model, choices):
+            draws = cls._draws(m, params)
+            for i in range(0, len(model_choices), draws):
+                kept.extend(cls._best(model_choices[i:i + draws], n))
+        return kept
+
+    @classmethod
+    def _best(cls, samples: List[Dict[str, Any]], n: int) -> List[Dict[str, Any]]:
+        """
+        Returns the n samples with the highest score, successful ones first. The usage of the samples
+        left out was paid for too, so it is spread over the ones kept.
+        """
+        if len(samples) <= n:
+            return samples
+        def score(choice):
+            value = (choice.get('extra') or {}).get('score')
+            return ('error' not in choice, value is not None, value or 0.0)
+        best = sorted(samples, key=score, reverse=True)[:n]
+        if any('usage' in choice for choice in samples):
+            for choice, usage in zip(best, split_usage(cls._sum_usage(samples), n)):
+                choice['usage'] = usage
+        return best
+
+    @classmethod
+    def _tag_choice(cls, choice: Dict[str, Any], model_idx: int, index: int) -> Dict[str, Any]:
+        tagged = {'id': choice['id'], 'model_idx': model_idx, 'model_name': choice['model_name'], 'index': index}
+        tagged.update(choice)
+        return tagged
+
+    @classmethod
+    def _check_routing(cls, routing: str, params: Dict[str, Any]):
+        if routing not in ROUTING_MODES:
+            raise ValueError(f"Unknown routing mode {routing}, expected one of {', '.join(ROUTING_MODES)}")
+        if params['stream']:
+            raise ValueError("Routing is not supported with stream=True")
+        if (params['n'] or 1) > 1 or (params['best_of'] or 1) > 1:
+            raise ValueError("Routing is not supported with n or best_of")
+
+    @classmethod
+    def _route(cls, model: List[str], prompt: List[str], params: Dict[str, Any], routing: str,
+               hedge_delay: Optional[float], hedge_percentile: float, deadline: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Completes each prompt on one model at a time, moving to the next model on errors and, when hedging,
+        after the hedge delay. The first successful choice wins. Losing requests that already started can't be
+        interrupted on the threaded path, so their results are discarded. Prompts without a result at the
+        deadline time out.
+        """
+        candidates = cls._route_order(model, routing)
+        executor = cls._get_executor()
+        routes = [_Route() for _ in prompt]
+        active: Dict[concurrent.futures.Future, int] = {}
+
+        def launch(i):
+            fqn = routes[i].launch(candidates, cls._hedge_after(candidates, routes[i], routing, hedge_delay, hedge_percentile))
+            with scheduled(params['user'], INTERACTIVE):
+                active[executor.submit(cls._generate_completion, fqn, prompt[i], **params, deadline=deadline)] = i
+
+        for i in range(len(prompt)):
+            launch(i)
+        while any(route.result is None for route in routes) and not cls._past(deadline):
+            for i, route in enumerate(routes):
+                if route.should_hedge(candidates):
+                    launch(i)
+            done, _ = concurrent.futures.wait(list(active), timeout=cls._next_wait(routes, candidates, deadline),
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                i = active.pop(future, None)
+                if i is None or routes[i].result is not None:
+                    continue
+                try_next = routes[i].finish(future.result(), any(j == i for j in active.values()), candidates)
+                if routes[i].result is not None:
+                    for other in [f for f, j in active.items() if j == i]:
+                        other.cancel()
+                        del active[other]
+                elif try_next:
+                    launch(i)
+        for future in active:
+            future.cancel()
+        return cls._route_results(model, routes)
+
+    @classmethod
+    async def _aroute(cls, model: List[str], prompt: List[str], params: Dict[str, Any], routing: str,
+                      hedge_delay: Optional[float], hedge_percentile: float, deadline: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Async version of _route. Losing requests are cancelled.
+        """
+        candidates = cls._route_order(model, routing)
+        routes = [_Route() for _ in prompt]
+        active: Dict[asyncio.Task, int] = {}
+
+        def launch(i):
+            fqn = routes[i].launch(candidates, cls._hedge_after(candidates, routes[i], routing, hedge_delay, hedge_percentile))
+            with scheduled(params['user'], INTERACTIVE):
+                active[asyncio.ensure_future(cls._agenerate_completion(fqn, prompt[i], **params, deadline=deadline))] = i
+
+        for i in range(len(prompt)):
+            launch(i)
+        try:
+            while any(route.result is None for route in routes) and not cls._past(deadline):
+                for i, route in enumerate(routes):
+                    if route.should_hedge(candidates):
+                        launch(i)
+                done, _ = await asyncio.wait(list(active), timeout=cls._next_wait(routes, candidates, deadline),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    i = active.pop(task, None)
+                    if i is None or routes[i].result is not None:
+                        continue
+                    try_next = routes[i].finish(task.result(), any(j == i for j in active.values()), candidates)
+                    if routes[i].result is not None:
+                        for other in [t for t, j in active.items() if j == i]:
+                            other.cancel()
+                            del active[other]
+                    elif try_next:
+                        launch(i)
+        finally:
+            for task in active:
+                task.cancel()
+        return cls._route_results(model, routes)
+
+    @classmethod
+    def _route_order(cls, model: List[str], routing: str) -> List[str]:
+        fqns = list(dict.fromkeys(cls._resolve(m) for m in model))
+        if routing == FASTEST:
+            return rank_by_latency(fqns, cls.latency)
+        return fqns
+
+    @classmethod
+    def _hedge_after(cls, candidates: List[str], route: "_Route", routing: str,
+                     hedge_delay: Optional[float], hedge_percentile: float) -> Optional[float]:
+        if routing == FAILOVER:
+            return None
+        if hedge_delay is not None:
+            return hedge_delay
+        stats = cls.latency.get(candidates[route.next])
+        observed = stats.percentile(hedge_percentile) if stats is not None else None
+        return observed if observed is not None else cls.default_hedge_delay
+
+    @classmethod
+    def _next_hedge(cls, routes: List["_Route"], candidates: List[str]) -> Optional[float]:
+        now = time.monotonic()
+        hedges = [route.hedge_at for route in routes
+                  if route.result is None and route.hedge_at is not None and route.next < len(candidates)]
+        return max(0.0, min(hedges) - now) if hedges else None
+
+    @classmethod
+    def _next_wait(cls, routes: List["_Route"], candidates: List[str], deadline: Optional[float]) -> Optional[float]:
+        waits = [w for w in (cls._next_hedge(routes, candidates), cls._remaining(deadline)) if w is not None]
+        return min(waits) if waits else None
+
+    @classmethod
+    def _route_results(cls, model: List[str], routes: List["_Route"]) -> List[Dict[str, Any]]:
+        fqns = [cls._resolve(m) for m in model]
+        choices = [route.result if route.result is not None else cls._timeout_choice(route.fqn) for route in routes]
+        return [cls._tag_choice(choice, fqns.index(choice['model_name']), i) for i, choice in enumerate(choices)]
+
+    @classmethod
+    def _past(cls, deadline: Optional[float]) -> bool:
+        return deadline is not None and time.monotonic() >= deadline
+
+    @classmethod
+    def _record_latency(cls, fqn: str, seconds: float, ok: bool):
+        stats = cls.latency.get(fqn)
+        if stats is None:
+            stats = cls.latency.setdefault(fqn, LatencyStats())
+        stats.record(seconds, ok)
+
+    @classmethod
+    def _adapt(cls, namespace: str, seconds: float, error: Optional[BaseException] = None, usage: Optional[Dict[str, int]] = None, prompts: int = 1):
+        adaptive = cls.adaptive_concurrency.get(namespace)
+        # A call cut short by the request's own deadline says nothing about the provider
+        if adaptive is not None and not (error is not None and cls._expired()):
+            # Prompts of a batch are completed side by side, so a call takes about as long as its mean completion
+            adaptive.record(seconds, error, usage['completion_tokens'] / prompts if usage is not None else None)
+
+    @classmethod
+    def adaptive_stats(cls) -> Dict[str, Dict[str, Any]]:
+        """
+        Returns the current adaptive concurrency limit of each provider namespace and its recent decisions.
+        """
+        return {namespace: adaptive.summary() for namespace, adaptive in cls.adaptive_concurrency.items()}
+
+    @classmethod
+    def latency_stats(cls) -> Dict[str, Dict[str, Any]]:
+        """
+        Returns the observed latency percentiles and error rate of every model that was called.
+        """
+        return {fqn: stats.summary() for fqn, stats in cls.latency.items()}
+
+    @classmethod
+    def _stream(cls, model: List[str], prompt: List[str], params: Dict[str, Any],
+                deadline: Optional[float] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Streams every (model, prompt, sample) in parallel and yields their chunks in the order they arrive.
+        Streams still running at the deadline end with a timeout error chunk.
+        """
+        response_id, created = str(uuid.uuid4()), int(time.time())
+        chunks = queue.Queue()
+        closed = threading.Event()
+
+        def run(model_idx, index, m, p):
+            token = set_deadline(deadline)
+            try:
+                for fqn, chunk in cls._generate_stream(m, p, params):
+                    if closed.is_set():
+                        return
+                    chunks.put(cls._build_chunk(response_id, created, fqn, model_idx, index, chunk))
+            finally:
+                reset_deadline(token)
+                # The (model, index) pair marks its stream as done
+                chunks.put((model_idx, index))
+
+        # Each of the n samples of a prompt is its own stream, at index prompt_idx * n + sample
+        n = params['n'] or 1
+        params = {**params, 'n': None}
+        executor = cls._get_executor()
+        pending = {}
+        with scheduled(params['user'], INTERACTIVE):
+            for model_idx, m in enumerate(model):
+                for prompt_idx, p in enumerate(prompt):
+                    for index in range(prompt_idx * n, (prompt_idx + 1) * n):
+                        executor.submit(run, model_idx, index, m, p)
+                        pending[model_idx, index] = m
+        try:
+            while pending:
+                try:
+                    chunk = chunks.get(timeout=cls._remaining(deadline))
+                except queue.Empty:
+                    for (model_idx, index), m in pending.items():
+                        yield cls._timeout_chunk(response_id, created, m, model_idx, index)
+                    return
+                if isinstance(chunk, tuple):
+                    del pending[chunk]
+                else:
+                    yield chunk
+        finally:
+            # Stop the remaining streams if the caller stops iterating early or the deadline passed
+            closed.set()
+
+    @classmethod
+    async def _astream(cls, model: List[str], prompt: List[str], params: Dict[str, Any],
+                       deadline: Optional[float] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Async version of _stream.
+        """
+        response_id, created = str(uuid.uuid4()), int(time.time())
+        chunks = asyncio.Queue()
+
+        async def run(model_idx, index, m, p):
+            # Each task runs in its own copy of the context, so there is nothing to reset
+            set_deadline(deadline)
+            try:
+                async for fqn, chunk in cls._agenerate_stream(m, p, params):
+                    await chunks.put(cls._build_chunk(response_id, created, fqn, model_idx, index, chunk))
+            finally:
+                chunks.put_nowait((model_idx, index))
+
+        n = params['n'] or 1
+        params = {**params, 'n': None}
+        tasks = []
+        pending = {}
+        with scheduled(params['user'], INTERACTIVE):
+            for model_idx, m in enumerate(model):
+                for prompt_idx, p in enumerate(prompt):
+                    for index in range(prompt_idx * n, (prompt_idx + 1) * n):
+                        tasks.append(asyncio.ensure_future(run(model_idx, index, m, p)))
+                        pending[model_idx, index] = m
+        try:
+            while pending:
+                try:
+                    chunk = await asyncio.wait_for(chunks.get(), timeout=cls._remaining(deadline))
+                except asyncio.TimeoutError:
+                    for (model_idx, index), m in pending.items():
+                        yield cls._timeout_chunk(response_id, created, m, model_idx, index)
+                    return
+                if isinstance(chunk, tuple):
+                    del pending[chunk]
+                else:
+                    yield chunk
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @classmethod
+    def _generate_stream(cls, model: str, prompt: str, params: Dict[str, Any]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        fqn = cls._resolve(model)
+        provider = cls.models[fqn]
+        namespace = provider.namespace()
+        prompt, error = cls._fit_prompt(fqn, prompt, params)
+        if error is not None:
+            yield fqn, {'error': error, 'finish_reason': 'error'}
+            return
+        for chunk in cls._stream_call(fqn, namespace, prompt, params,
+                lambda: provider.stream_completion(model=fqn[len(namespace)+1:], prompt=prompt, **params)):
+            yield chunk
+
+    @classmethod
+    def _stream_call(cls, fqn: str, namespace: str, prompt: str, params: Dict[str, Any],
+                     open_stream: Callable[[], Iterator[Dict[str, Any]]]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """
+        Streams one upstream call once its rate limit and concurrency slots allow, retrying transient errors
+        until the first chunk arrives. Usage is counted against prompt for providers that don't report it.
+        """
+        rate_limit = cls.rate_limits.get(namespace)
+        tokens = estimate_tokens(prompt, params, get_tokenizer(fqn).count)
+        record = CallRecord(fqn, stream=True)
+        attempt = 0
+        while True:
+            waiting = time.monotonic()
+            if rate_limit is not None:
+                cls._sleep(rate_limit.reserve(tokens))
+            started, sent = False, None
+            try:
+                with cls._slot(namespace):
+                    sent = time.monotonic()
+                    record.queue_wait += sent - waiting
+                    text = []
+                    # Time spent waiting on the provider, leaving out the time the caller takes with each chunk
+                    upstream, resumed = 0.0, sent
+                    for chunk in open_stream():
+                        upstream += time.monotonic() - resumed
+                        if not started:
+                            record.ttfb = time.monotonic() - sent
+                        started = True
+                        text.append(chunk.get('text', ''))
+                        if 'usage' not in chunk and chunk.get('finish_reason') is not None and cls.local_usage:
+                            chunk = {**chunk, 'usage': count_usage(fqn, prompt, [''.join(text)])}
+                        if 'usage' in chunk:
+                            record.usage = chunk['usage']
+                        yield fqn, chunk
+                        resumed = time.monotonic()
+                    upstream += time.monotonic() - resumed
+                if record.usage is None and cls.local_usage:
+                    record.usage = count_usage(fqn, prompt, [''.join(text)])
+                cls._adapt(namespace, upstream, usage=record.usage)
+                if rate_limit is not None:
+                    rate_limit.record_usage(tokens, record.usage)
+                record.finish(record.usage)
+                emit(record, cls.metrics, cls.hooks)
+                return
+            except Exception as e:
+                if not started and sent is not None:
+                    cls._adapt(namespace, time.monotonic() - sent, e)
+                # Once chunks were sent, a retry would repeat them
+                if started or not cls.retry.should_retry(e, attempt) or cls._expired():
+                    record.finish(record.usage, error=e)
+                    emit(record, cls.metrics, cls.hooks)
+                    yield fqn, {'error': f"Error: {e}", 'finish_reason': 'error'}
+                    return
+                backoff = time.monotonic()
+                cls._sleep(cls.retry.delay(e, attempt))
+                record.backoff += time.monotonic() - backoff
+                attempt += 1
+                record.retries = attempt
+
+    @classmethod
+    async def _agenerate_stream(cls, model: str, prompt: str, params: Dict[str, Any]) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+        fqn = cls._resolve(model)
+        provider = cls.models[fqn]
+        namespace = provider.namespace()
+        prompt, error = cls._fit_prompt(fqn, prompt, params)
+        if error is not None:
+            yield fqn, {'error': error, 'finish_reason': 'error'}
+            return
+        async for chunk in cls._astream_call(fqn, namespace, prompt, params,
+                lambda: provider.astream_completion(model=fqn[len(namespace)+1:], prompt=prompt, **params)):
+            yield chunk
+
+    @classmethod
+    async def _astream_call(cls, fqn: str, namespace: str, prompt: str, params: Dict[str, Any],
+                      open_stream: Callable[[], AsyncIterator[Dict[str, Any]]]) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+        """
+        Async version of _stream_call.
+        """
+        rate_limit = cls.rate_limits.get(namespace)
+        tokens = estimate_tokens(prompt, params, get_tokenizer(fqn).count)
+        record = CallRecord(fqn, stream=True)
+        attempt = 0
+        while True:
+            waiting = time.monotonic()
+            if rate_limit is not None:
+                await cls._asleep(rate_limit.reserve(tokens))
+            started, sent = False, None
+            try:
+                async with cls._aslot(namespace):
+                    sent = time.monotonic()
+                    record.queue_wait += sent - waiting
+                    text = []
+                    # Time spent waiting on the provider, leaving out the time the caller takes with each chunk
+                    upstream, resumed = 0.0, sent
+                    async for chunk in open_stream():
+                        upstream += time.monotonic() - resumed
+                        if not started:
+                            record.ttfb = time.monotonic() - sent
+                        started = True
+                        text.append(chunk.get('text', ''))
+                        if 'usage' not in chunk and chunk.get('finish_reason') is not None and cls.local_usage:
+                            chunk = {**chunk, 'usage': count_usage(fqn, prompt, [''.join(text)])}
+                        if 'usage' in chunk:
+                            record.usage = chunk['usage']
+                        yield fqn, chunk
+                        resumed = time.monotonic()
+                    upstream += time.monotonic() - resumed
+                if record.usage is None and cls.local_usage:
+                    record.usage = count_usage(fqn, prompt, [''.join(text)])
+                cls._adapt(namespace, upstream, usage=record.usage)
+                if rate_limit is not None:
+                    rate_limit.record_usage(tokens, record.usage)
+                record.finish(record.usage)
+                emit(record, cls.metrics, cls.hooks)
+                return
+            except Exception as e:
+                if not started and sent is not None:
+                    cls._adapt(namespace, time.monotonic() - sent, e)
+                if started or not cls.retry.should_retry(e, attempt) or cls._expired():
+                    record.finish(record.usage, error=e)
+                    emit(record, cls.metrics, cls.hooks)
+                    yield fqn, {'error': f"Error: {e}", 'finish_reason': 'error'}
+                    return
+                backoff = time.monotonic()
+                await cls._asleep(cls.retry.delay(e, attempt))
+                record.backoff += time.monotonic() - backoff
+                attempt += 1
+                record.retries = attempt
 
+    @classmethod
+    def _build_chunk(cls, response_id: str, created: int, fqn: str, model_idx: int, index: int, chunk: Dict[str, Any]) -> Dict[str, Any]:
+        choice = {
+            'text': chunk.get('text', ''),
+            'index': index,
+            'model_idx': model_idx,
+            'model_name': fqn,
+            'logprobs': chunk.get('logprobs'),
+            'finish_reason': chunk.get('finish_reason'),
+        }
+        if 'error' in chunk:
+            choice['error'] = chunk['error']
+        if 'usage' in chunk:
+            choice['usage'] = chunk['usage']
+        if 'extra' in chunk:
+            choice['extra'] = chunk['extra']
+        return {
+            "id": response_id,
+            "object": "text_completion",
+            "created": created,
+            "model": fqn,
+            "choices": [choice],
+        }
+
+    @classmethod
+    def _timeout_chunk(cls, response_id: str, created: int, model: str, model_idx: int, index: int) -> Dict[str, Any]:
+        return cls._build_chunk(response_id, created, cls._resolve(model), model_idx, index,
+                                {'error': "Error: Request timed out", 'finish_reason': 'error'})
+
+    @classmethod
+    def _build_response(cls, choices: List[Dict[str, Any]]) -> Dict[str, Any]:
+        return {
+            "id": str(uuid.uuid4()),
+            "object": "text_completion",
+            "created": int(time.time()),
+            "choices": choices,
+            "usage": cls._sum_usage(choices),
+        }
+
+    @classmethod
+    def _sum_usage(cls, choices: List[Dict[str, Any]]) -> Dict[str, int]:
         total_usage = {
             'prompt_tokens': 0,
             'completion_tokens': 0,
             'total_tokens': 0
         }
 
-        # Use a ThreadPoolExecutor to run _generate_completion in parallel for each set of parameters
-        with ThreadPoolExecutor() as executor:
-            choices = list(executor.map(lambda params: cls._generate_completion(*params), args))
-
         # Sum up the usage from all choices
         for choice in choices:
             if 'usage' in choice:
                 total_usage['prompt_tokens'] += choice['usage']['prompt_tokens']
                 total_usage['completion_tokens'] += choice['usage']['completion_tokens']
                 total_usage['total_tokens'] += choice['usage']['total_tokens']
-
-        return {
-            "id": str(uuid.uuid4()),
-            "object": "text_completion",
-            "created": int(time.time()),
-            "choices": choices,
-            "usage": total_usage,
-        }
+        return total_usage
     
     @classmethod
-    def _generate_completion(cls, model, prompt, suffix, max_tokens, temperature, top_p, n, stream, logprobs, echo, stop, presence_penalty, frequency_penalty, best_of, logit_bias, user):
+    def _generate_completion(cls, model, prompt, suffix, max_tokens, temperature, top_p, n, stream, logprobs, echo, stop, presence_penalty, frequency_penalty, best_of, logit_bias, user, deadline=None, sample=0):
         """
         Function to generate a single completion. This will be used in parallel execution.
+        Returns a list of choices when n asks for several samples.
+        """
+        fqn = cls._resolve(model)
+        params = dict(suffix=suffix, max_tokens=max_tokens, temperature=temperature, top_p=top_p, n=n, stream=stream, logprobs=logprobs, echo=echo, stop=stop,
+                      presence_penalty=presence_penalty, frequency_penalty=frequency_penalty, best_of=best_of, logit_bias=logit_bias, user=user)
+        prompt, error = cls._fit_prompt(fqn, prompt, params)
+        if error is not None:
+            return cls._build_choices(fqn, {'error': error}, n)
+        key = cls._sample_key(fqn, prompt, params, sample)
+        ret = cls._cache_get(key, params) or cls._semantic_get(fqn, prompt, params, sample)
+        if ret is not None:
+            return cls._build_choices(fqn, ret, n)
+        provider = cls.models[fqn]
+
+        def generate():
+            try:
+                ret = cls._call(fqn, estimate_tokens(prompt, params, get_tokenizer(fqn).count),
+                    lambda: cls._with_usage(fqn, prompt, provider.create_completion(model=fqn[len(provider.namespace())+1:], prompt=prompt, **params)))
+            except Exception as e:
+                ret = {
+                    'error': f"Error: {e}"
+                }
+            cls._cache_set(key, params, ret)
+            cls._semantic_set(fqn, prompt, params, sample, ret)
+            return ret
+
+        # Worker threads are reused, so the deadline is reset once this request is done
+        token = set_deadline(deadline)
+        try:
+            if cls._should_coalesce(params):
+                ret = cls._flights.do(key, generate)
+            else:
+                ret = generate()
+        finally:
+            reset_deadline(token)
+        return cls._build_choices(fqn, ret, n)
+
+    @classmethod
+    async def _agenerate_completion(cls, model, prompt, suffix, max_tokens, temperature, top_p, n, stream, logprobs, echo, stop, presence_penalty, frequency_penalty, best_of, logit_bias, user, deadline=None, sample=0):
         """
-        if model not in cls.aliases:
-            raise ValueError(f"Model {model} not found. OpenLM currently supports the following models:\n{cls._pretty_list_models()}")
-        fqn = cls.aliases[model]
+        Async version of _generate_completion.
+        """
+        fqn = cls._resolve(model)
+        params = dict(suffix=suffix, max_tokens=max_tokens, temperature=temperature, top_p=top_p, n=n, stream=stream, logprobs=logprobs, echo=echo, stop=stop,
+                      presence_penalty=presence_penalty, frequency_penalty=frequency_penalty, best_of=best_of, logit_bias=logit_bias, user=user)
+        prompt, error = cls._fit_prompt(fqn, prompt, params)
+        if error is not None:
+            return cls._build_choices(fqn, {'error': error}, n)
+        key = cls._sample_key(fqn, prompt, params, sample)
+        ret = cls._cache_get(key, params) or cls._semantic_get(fqn, prompt, params, sample)
+        if ret is not None:
+            return cls._build_choices(fqn, ret, n)
+        provider = cls.models[fqn]
+
+        async def call():
+            return cls._with_usage(fqn, prompt, await provider.acreate_completion(model=fqn[len(provider.namespace())+1:], prompt=prompt, **params))
+
+        async def generate():
+            try:
+                ret = await cls._acall(fqn, estimate_tokens(prompt, params, get_tokenizer(fqn).count), call)
+            except Exception as e:
+                ret = {
+                    'error': f"Error: {e}"
+                }
+            cls._cache_set(key, params, ret)
+            cls._semantic_set(fqn, prompt, params, sample, ret)
+            return ret
+
+        token = set_deadline(deadline)
         try:
-            ret = cls.models[fqn].create_completion(
-                model=fqn[len(cls.models[fqn].namespace())+1:],
-                prompt=prompt, 
-                suffix=suffix, 
-                max_tokens=max_tokens, 
-                temperature=temperature, 
-                top_p=top_p, 
-                n=n, 
-                stream=stream, 
-                logprobs=logprobs, 
-                echo=echo, 
-                stop=stop, 
-                presence_penalty=presence_penalty, 
-                frequency_penalty=frequency_penalty, 
-                best_of=best_of, 
-                logit_bias=logit_bias, 
-                user=user)
+            if cls._should_coalesce(params):
+                ret = await cls._flights.ado(key, generate)
+            else:
+                ret = await generate()
+        finally:
+            reset_deadline(token)
+        return cls._build_choices(fqn, ret, n)
+
+    @classmethod
+    def _generate_batch(cls, model: str, prompts: List[str], params: Dict[str, Any], deadline: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Generates completions for several prompts in one upstream call. Cached prompts are left out of the call,
+        and concurrent identical calls are coalesced like single prompts are.
+        """
+        fqn = cls._resolve(model)
+        provider = cls.models[fqn]
+        fitted = [cls._fit_prompt(fqn, prompt, params) for prompt in prompts]
+        prompts = [prompt for prompt, _ in fitted]
+        keys = [cache_key(fqn, prompt, params) for prompt in prompts]
+        rets = [{'error': error} if error is not None else cls._cache_get(key, params) or cls._semantic_get(fqn, prompt, params)
+                for prompt, key, (_, error) in zip(prompts, keys, fitted)]
+        missing = [i for i, ret in enumerate(rets) if ret is None]
+        if missing:
+            batch = [prompts[i] for i in missing]
+
+            def generate():
+                try:
+                    results = cls._call(fqn, estimate_tokens(batch, params, get_tokenizer(fqn).count),
+                        lambda: cls._with_usage(fqn, batch, provider.create_completions_batch(model=fqn[len(provider.namespace())+1:], prompts=batch, **params)),
+                        len(batch))
+                except Exception as e:
+                    results = [{'error': f"Error: {e}"}] * len(missing)
+                for i, ret in zip(missing, results):
+                    cls._cache_set(keys[i], params, ret)
+                    cls._semantic_set(fqn, prompts[i], params, 0, ret)
+                return results
+
+            token = set_deadline(deadline)
+            try:
+                if cls._should_coalesce(params):
+                    results = cls._flights.do(cache_key(fqn, batch, params), generate)
+                else:
+                    results = generate()
+            finally:
+                reset_deadline(token)
+            for i, ret in zip(missing, results):
+                rets[i] = ret
+        return [choice for ret in rets for choice in cls._as_list(cls._build_choices(fqn, ret, params['n']))]
+
+    @classmethod
+    async def _agenerate_batch(cls, model: str, prompts: List[str], params: Dict[str, Any], deadline: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Async version of _generate_batch.
+        """
+        fqn = cls._resolve(model)
+        provider = cls.models[fqn]
+        fitted = [cls._fit_prompt(fqn, prompt, params) for prompt in prompts]
+        prompts = [prompt for prompt, _ in fitted]
+        keys = [cache_key(fqn, prompt, params) for prompt in prompts]
+        rets = [{'error': error} if error is not None else cls._cache_get(key, params) or cls._semantic_get(fqn, prompt, params)
+                for prompt, key, (_, error) in zip(prompts, keys, fitted)]
+        missing = [i for i, ret in enumerate(rets) if ret is None]
+        if missing:
+            batch = [prompts[i] for i in missing]
+
+            async def call():
+                return cls._with_usage(fqn, batch,
+                    await provider.acreate_completions_batch(model=fqn[len(provider.namespace())+1:], prompts=batch, **params))
+
+            async def generate():
+                try:
+                    results = await cls._acall(fqn, estimate_tokens(batch, params, get_tokenizer(fqn).count), call, len(batch))
+                except Exception as e:
+                    results = [{'error': f"Error: {e}"}] * len(missing)
+                for i, ret in zip(missing, results):
+                    cls._cache_set(keys[i], params, ret)
+                    cls._semantic_set(fqn, prompts[i], params, 0, ret)
+                return results
+
+            token = set_deadline(deadline)
+            try:
+                if cls._should_coalesce(params):
+                    results = await cls._flights.ado(cache_key(fqn, batch, params), generate)
+                else:
+                    results = await generate()
+            finally:
+                reset_deadline(token)
+            for i, ret in zip(missing, results):
+                rets[i] = ret
+        return [choice for ret in rets for choice in cls._as_list(cls._build_choices(fqn, ret, params['n']))]
+
+    @classmethod
+    def _sample_key(cls, fqn: str, prompt: str, params: Dict[str, Any], sample: int) -> str:
+        """
+        Calls drawing different samples of the same prompt must not share a cache entry or an upstream call,
+        unless the request is deterministic and they would be identical anyway.
+        """
+        if sample and not is_deterministic(params):
+            return cache_key(fqn, prompt, {**params, 'sample': sample})
+        return cache_key(fqn, prompt, params)
+
+    @classmethod
+    def _fit_prompt(cls, fqn: str, prompt: str, params: Dict[str, Any]) -> Tuple[str, Optional[str]]:
+        """
+        Applies the overlength policy to a prompt that doesn't fit in the model's context window with max_tokens.
+        Returns the prompt to send and an error if it shouldn't be sent.
+        """
+        window = context_window(fqn)
+        if cls.overlength is None or window is None:
+            return prompt, None
+        tokenizer = get_tokenizer(fqn)
+        # 16 is OpenAI's default max_tokens
+        available = window - (params.get('max_tokens') or 16)
+        tokens = tokenizer.count(prompt)
+        if tokens <= available:
+            return prompt, None
+        if cls.overlength == TRUNCATE and available > 0:
+            return tokenizer.truncate(prompt, available), None
+        return prompt, f"Error: The prompt is {tokens} tokens, which with max_tokens is over the {window} token context window of {fqn}"
+
+    @classmethod
+    def _with_usage(cls, fqn: str, prompt: Union[str, List[str]], result: Any) -> Any:
+        """
+        Adds locally counted usage to provider results that don't report it, one result per prompt for batches.
+        """
+        if not cls.local_usage:
+            return result
+        if isinstance(result, list):
+            return [fill_usage(fqn, p, ret) for p, ret in zip(prompt, result)]
+        return fill_usage(fqn, prompt, result)
+
+    @classmethod
+    def _batches(cls, model: str, prompts: List[str]) -> List[List[str]]:
+        size = max(1, cls.models[cls._resolve(model)].max_batch_size)
+        return [prompts[i:i + size] for i in range(0, len(prompts), size)]
+
+    @classmethod
+    def _call(cls, fqn: str, tokens: int, fn: Callable[[], Any], prompts: int = 1, namespace: Optional[str] = None) -> Any:
+        """
+        Calls a provider once its rate limit and concurrency slots allow, retrying transient errors.
+        The concurrency slot is released while backing off.
+        """
+        namespace = namespace or cls.models[fqn].namespace()
+        rate_limit = cls.rate_limits.get(namespace)
+        attempt = 0
+        with cls._observe(fqn, prompts) as record:
+            while True:
+                waiting = time.monotonic()
+                if rate_limit is not None:
+                    cls._sleep(rate_limit.reserve(tokens))
+                try:
+                    with cls._slot(namespace):
+                        started = time.monotonic()
+                        record.queue_wait += started - waiting
+                        try:
+                            result = fn()
+                        except Exception as e:
+                            cls._record_latency(fqn, time.monotonic() - started, ok=False)
+                            cls._adapt(namespace, time.monotonic() - started, e)
+                            raise
+                        elapsed = time.monotonic() - started
+                        cls._record_latency(fqn, elapsed, ok=True)
+                        choices = result if isinstance(result, list) else [result]
+                        cls._adapt(namespace, elapsed, usage=cls._sum_usage(choices) if any('usage' in c for c in choices) else None, prompts=prompts)
+                except Exception as e:
+                    if not cls.retry.should_retry(e, attempt) or cls._expired():
+                        raise
+                    backoff = time.monotonic()
+                    cls._sleep(cls.retry.delay(e, attempt))
+                    record.backoff += time.monotonic() - backoff
+                    attempt += 1
+                    record.retries = attempt
+                    continue
+                record.usage = cls._sum_usage(result if isinstance(result, list) else [result])
+                if rate_limit is not None:
+                    rate_limit.record_usage(tokens, record.usage)
+                return result
+
+    @classmethod
+    async def _acall(cls, fqn: str, tokens: int, fn: Callable[[], Awaitable[Any]], prompts: int = 1, namespace: Optional[str] = None) -> Any:
+        """
+        Async version of _call.
+        """
+        namespace = namespace or cls.models[fqn].namespace()
+        rate_limit = cls.rate_limits.get(namespace)
+        attempt = 0
+        with cls._observe(fqn, prompts) as record:
+            while True:
+                waiting = time.monotonic()
+                if rate_limit is not None:
+                    await cls._asleep(rate_limit.reserve(tokens))
+                try:
+                    async with cls._aslot(namespace):
+                        started = time.monotonic()
+                        record.queue_wait += started - waiting
+                        try:
+                            result = await fn()
+                        except Exception as e:
+                            cls._record_latency(fqn, time.monotonic() - started, ok=False)
+                            cls._adapt(namespace, time.monotonic() - started, e)
+                            raise
+                        elapsed = time.monotonic() - started
+                        cls._record_latency(fqn, elapsed, ok=True)
+                        choices = result if isinstance(result, list) else [result]
+                        cls._adapt(namespace, elapsed, usage=cls._sum_usage(choices) if any('usage' in c for c in choices) else None, prompts=prompts)
+                except Exception as e:
+                    if not cls.retry.should_retry(e, attempt) or cls._expired():
+                        raise
+                    backoff = time.monotonic()
+                    await cls._asleep(cls.retry.delay(e, attempt))
+                    record.backoff += time.monotonic() - backoff
+                    attempt += 1
+                    record.retries = attempt
+                    continue
+                record.usage = cls._sum_usage(result if isinstance(result, list) else [result])
+                if rate_limit is not None:
+                    rate_limit.record_usage(tokens, record.usage)
+                return result
+
+    @classmethod
+    @contextlib.contextmanager
+    def _observe(cls, fqn: str, prompts: int = 1):
+        """
+        Records an upstream call, with the HTTP layer reporting connect time and response details,
+        and hands the record to the metrics and hooks once the call is done. Cancelled calls aren't reported.
+        """
+        record = CallRecord(fqn, prompts)
+        token = set_observer(record)
+        try:
+            yield record
         except Exception as e:
-            ret = {
-                'error': f"Error: {e}"
-            }
+            record.finish(record.usage, error=e)
+            emit(record, cls.metrics, cls.hooks)
+            raise
+        finally:
+            reset_observer(token)
+        record.finish(record.usage)
+        emit(record, cls.metrics, cls.hooks)
+
+    @classmethod
+    def _sleep(cls, seconds: float):
+        """
+        Waits before the next attempt, failing right away if the wait would run past the request deadline.
+        """
+        if seconds <= 0:
+            return
+        remaining = remaining_time()
+        if remaining is not None and remaining <= seconds:
+            raise TimeoutError("Request timed out")
+        time.sleep(seconds)
+
+    @classmethod
+    async def _asleep(cls, seconds: float):
+        if seconds <= 0:
+            return
+        remaining = remaining_time()
+        if remaining is not None and remaining <= seconds:
+            raise TimeoutError("Request timed out")
+        await asyncio.sleep(seconds)
+
+    @classmethod
+    def _expired(cls) -> bool:
+        remaining = remaining_time()
+        return remaining is not None and remaining <= 0
+
+    @classmethod
+    def _remaining(cls, deadline: Optional[float]) -> Optional[float]:
+        """
+        Returns the seconds left before a time.monotonic() deadline, never negative.
+        """
+        if deadline is None:
+            return None
+        return max(0.0, deadline - time.monotonic())
+
+    @classmethod
+    def _cache_get(cls, key: str, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        if cls.cache is None or not (cls.cache_nondeterministic or is_deterministic(params)):
+            return None
+        return cls.cache.get(key)
+
+    @classmethod
+    def _cache_set(cls, key: str, params: Dict[str, Any], ret: Dict[str, Any]):
+        if cls.cache is None or not (cls.cache_nondeterministic or is_deterministic(params)):
+            return
+        if 'error' not in ret:
+            cls.cache.set(key, ret)
+
+    @classmethod
+    def _semantic_get(cls, fqn: str, prompt: str, params: Dict[str, Any], sample: int = 0) -> Optional[Dict[str, Any]]:
+        if cls.semantic_cache is None or not (cls.cache_nondeterministic or is_deterministic(params)):
+            return None
+        return cls.semantic_cache.get(fqn, prompt, cls._semantic_params(params, sample))
+
+    @classmethod
+    def _semantic_set(cls, fqn: str, prompt: str, params: Dict[str, Any], sample: int, ret: Dict[str, Any]):
+        if cls.semantic_cache is None or not (cls.cache_nondeterministic or is_deterministic(params)):
+            return
+        if 'error' not in ret:
+            cls.semantic_cache.set(fqn, prompt, cls._semantic_params(params, sample), ret)
+
+    @classmethod
+    def _semantic_params(cls, params: Dict[str, Any], sample: int) -> Dict[str, Any]:
+        # Like _sample_key, samples of a sampled request are cached apart
+        if sample and not is_deterministic(params):
+            return {**params, 'sample': sample}
+        return params
+
+    @classmethod
+    def _should_coalesce(cls, params: Dict[str, Any]) -> bool:
+        """
+        Identical sampled requests are expected to give different completions, so only deterministic ones are shared by default.
+        """
+        return cls.coalesce and (cls.coalesce_nondeterministic or is_deterministic(params))
+
+    @classmethod
+    def configure(cls, max_workers: Optional[int] = None,
+                       max_in_flight: Optional[int] = None,
+                       provider_concurrency: Optional[Dict[str, int]] = None,
+                       cache: Optional[BaseCache] = None,
+                       cache_nondeterministic: Optional[bool] = None,
+                       semantic_cache: Optional[SemanticCache] = None,
+                       coalesce: Optional[bool] = None,
+                       coalesce_nondeterministic: Optional[bool] = None,
+                       retry: Optional[RetryPolicy] = None,
+                       rate_limits: Optional[Dict[str, RateLimit]] = None,
+                       adaptive_concurrency: Optional[Dict[str, AdaptiveLimit]] = None,
+                       metrics: Optional[Metrics] = None,
+                       hooks: Optional[List[Callable[[CallRecord], None]]] = None,
+                       local_usage: Optional[bool] = None,
+                       overlength: Optional[str] = None,
+                       processes: Optional[int] = None,
+                       process_shard_size: Optional[int] = None,
+                       scheduler: Optional[FairScheduler] = None):
+        """
+        Configures the shared executor, concurrency limits, response cache, request coalescing, retries, rate limits,
+        instrumentation, token accounting, worker processes and scheduling.
+        Takes effect for the next request.
+
+        :param max_workers: The number of worker threads shared by all create calls.
+        :param max_in_flight: The maximum number of upstream requests in flight across the process.
+        :param provider_concurrency: The maximum number of upstream requests in flight per provider namespace.
+        :param cache: A cache for provider responses, e.g. MemoryCache() or SQLiteCache(path).
+        :param cache_nondeterministic: Whether to also cache requests that don't use temperature=0.
+        :param semantic_cache: A SemanticCache answering prompts similar to a cached one, consulted after cache misses.
+        :param coalesce: Whether concurrent identical requests share one upstream call.
+        :param coalesce_nondeterministic: Whether to also coalesce requests that don't use temperature=0.
+        :param retry: The retry policy for transient provider errors. Use RetryPolicy(max_retries=0) to disable retries.
+        :param rate_limits: Client-side rate limits per provider namespace.
+        :param adaptive_concurrency: Concurrency limits per provider namespace that grow while latency stays flat and back off on
+            latency spikes, 429s and 5xx responses. Inspect them with adaptive_stats().
+        :param metrics: Where to aggregate per-model metrics of upstream calls.
+        :param hooks: Functions called with a CallRecord after every upstream call, e.g. to export traces.
+        :param local_usage: Whether to count usage with the model's tokenizer for providers that don't report it.
+        :param overlength: What to do with prompts over the model's context window: 'reject', 'truncate', or '' to send them anyway.
+        :param processes: The number of worker processes create and create_iter shard prompts across, or 0 to complete them on threads
+            in this process. Workers get a copy of the registered providers and of these settings when they start, with max_in_flight,
+            provider_concurrency and rate_limits divided between them. Streaming, routing and the async API stay in this process,
+            and metrics and hooks of calls made in workers are recorded in the workers.
+        :param process_shard_size: The maximum number of prompts sent to a worker process at a time.
+        :param scheduler: A FairScheduler ordering waiting upstream requests by priority and tenant, with per-tenant quotas
+            and queue-time SLOs.
+        """
+        if overlength and overlength not in OVERLENGTH_POLICIES:
+            raise ValueError(f"Unknown overlength policy {overlength}, expected one of {', '.join(OVERLENGTH_POLICIES)}")
+        if cache is not None:
+            cls.cache = cache
+        if cache_nondeterministic is not None:
+            cls.cache_nondeterministic = cache_nondeterministic
+        if semantic_cache is not None:
+            cls.semantic_cache = semantic_cache
+        if coalesce is not None:
+            cls.coalesce = coalesce
+        if coalesce_nondeterministic is not None:
+            cls.coalesce_nondeterministic = coalesce_nondeterministic
+        if retry is not None:
+            cls.retry = retry
+        if rate_limits is not None:
+            cls.rate_limits = dict(rate_limits)
+        if adaptive_concurrency is not None:
+            cls.adaptive_concurrency = dict(adaptive_concurrency)
+        if metrics is not None:
+            cls.metrics = metrics
+        if hooks is not None:
+            cls.hooks = list(hooks)
+        if local_usage is not None:
+            cls.local_usage = local_usage
+        if overlength is not None:
+            cls.overlength = overlength or None
+        if processes is not None:
+            cls.processes = processes or None
+        if process_shard_size is not None:
+            cls.process_shard_size = process_shard_size
+        if scheduler is not None:
+            cls.scheduler = scheduler
+        # Workers copy the settings when they start, so they are replaced to pick up the new ones
+        cls._shutdown_processes(wait=False)
+        if max_workers is None and max_in_flight is None and provider_concurrency is None:
+            return
+        with cls._executor_lock:
+            if max_workers is not None:
+                cls.max_workers = max_workers
+                if cls._executor is not None:
+                    cls._executor.shutdown(wait=False)
+                    cls._executor = None
+            if max_in_flight is not None:
+                cls.max_in_flight = max_in_flight
+            if provider_concurrency is not None:
+                cls.provider_concurrency = dict(provider_concurrency)
+            cls._in_flight = None
+            cls._provider_limiters = {}
+
+    @classmethod
+    def shutdown(cls, wait: bool = True):
+        """
+        Shuts down the shared executor and the worker processes. They are recreated on the next create call.
+        """
+        with cls._executor_lock:
+            executor, cls._executor = cls._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+        cls._shutdown_processes(wait)
+
+    @classmethod
+    def _shutdown_processes(cls, wait: bool):
+        with cls._executor_lock:
+            pool, cls._process_pool = cls._process_pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait)
+
+    @classmethod
+    def _get_executor(cls) -> concurrent.futures.Executor:
+        """
+        Returns the shared executor, or with a scheduler, an executor that submits to it in the scheduler's order.
+        """
+        executor = cls._get_thread_pool()
+        scheduler = cls._get_scheduler()
+        return _ScheduledExecutor(scheduler, executor) if scheduler is not None else executor
+
+    @classmethod
+    def _get_thread_pool(cls) -> ThreadPoolExecutor:
+        """
+        Returns the shared executor itself, for work that already has its scheduler slot.
+        """
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(max_workers=cls.max_workers, thread_name_prefix='openlm')
+            return cls._executor
+
+    @classmethod
+    def _get_scheduler(cls) -> Optional[FairScheduler]:
+        """
+        Returns the scheduler, giving it max_in_flight or max_workers slots if it was set without a limit.
+        """
+        scheduler = cls.scheduler
+        if scheduler is not None and scheduler.limit is None:
+            scheduler.limit = cls.max_in_flight or cls.max_workers
+        return scheduler
+
+    @classmethod
+    def _get_process_pool(cls) -> "concurrent.futures.ProcessPoolExecutor":
+        # Imported here since multiprocessing is slow to import and most programs never start a process pool
+        import multiprocessing
+        import pickle
+        from concurrent.futures import ProcessPoolExecutor
+        with cls._executor_lock:
+            if cls._process_pool is not None and cls._process_pool_models is cls.models:
+                return cls._process_pool
+            previous = cls._process_pool
+            # Pickled once here, so unpicklable providers or settings fail in the caller rather than in every worker
+            state = pickle.dumps((list({id(p): p for p in [*cls.models.values(), *cls.chat_models.values()]}.values()),
+                                  cls._worker_settings(), openlm.api_key, cls._default_keys))
+            # Forking a process with running threads can deadlock, so workers always start fresh
+            cls._process_pool = ProcessPoolExecutor(max_workers=cls.processes, mp_context=multiprocessing.get_context('spawn'),
+                                                    initializer=_init_worker, initargs=(state,))
+            cls._process_pool_models = cls.models
+        if previous is not None:
+            previous.shutdown(wait=False)
+        return cls._process_pool
+
+    @classmethod
+    def _worker_settings(cls) -> Dict[str, Any]:
+        """
+        The settings of a worker process. Limits that apply across the process are divided between the workers.
+        """
+        return {
+            'max_workers': cls.max_workers,
+            'max_in_flight': math.ceil(cls.max_in_flight / cls.processes) if cls.max_in_flight else None,
+            'provider_concurrency': {namespace: math.ceil(limit / cls.processes) for namespace, limit in cls.provider_concurrency.items()},
+            'cache': cls.cache,
+            'cache_nondeterministic': cls.cache_nondeterministic,
+            'semantic_cache': cls.semantic_cache,
+            'coalesce': cls.coalesce,
+            'coalesce_nondeterministic': cls.coalesce_nondeterministic,
+            'retry': cls.retry,
+            'rate_limits': {namespace: limit.split(cls.processes) for namespace, limit in cls.rate_limits.items()},
+            'adaptive_concurrency': dict(cls.adaptive_concurrency),
+            'metrics': cls.metrics,
+            'hooks': list(cls.hooks),
+            'local_usage': cls.local_usage,
+            'overlength': cls.overlength,
+            'scheduler': cls.scheduler.split(cls.processes) if cls.scheduler is not None else None,
+        }
+
+    @classmethod
+    def _limiters(cls, namespace: str) -> List[Limiter]:
+        with cls._executor_lock:
+            if cls._in_flight is None:
+                cls._in_flight = Limiter(cls.max_in_flight or cls.max_workers)
+            limiters = []
+            # Take the provider slot first so a request waiting on a busy provider doesn't hold a global slot
+            if namespace in cls.provider_concurrency:
+                if namespace not in cls._provider_limiters:
+                    cls._provider_limiters[namespace] = Limiter(cls.provider_concurrency[namespace])
+                limiters.append(cls._provider_limiters[namespace])
+            if namespace in cls.adaptive_concurrency:
+                limiters.append(cls.adaptive_concurrency[namespace].limiter)
+            limiters.append(cls._in_flight)
+            return limiters
+
+    @classmethod
+    @contextlib.contextmanager
+    def _slot(cls, namespace: str):
+        # Threaded calls got their scheduler slot when their task was submitted
+        check_rejected()
+        slot = current_slot()
+        with contextlib.ExitStack() as stack:
+            for limiter in cls._limiters(namespace):
+                timeout, slo = cls._slot_timeout(slot)
+                if not limiter.acquire(timeout=timeout, key=slot[1].key if slot is not None else ()):
+                    if slo:
+                        raise slot[0].expire(slot[1])
+                    raise TimeoutError("Request timed out waiting for a free slot")
+                stack.callback(limiter.release)
+            if slot is not None:
+                slot[0].start(slot[1])
+            yield
+
+    @classmethod
+    @contextlib.asynccontextmanager
+    async def _aslot(cls, namespace: str):
+        async with contextlib.AsyncExitStack() as stack:
+            remaining = remaining_time()
+            scheduler = cls._get_scheduler()
+            slot = None
+            if scheduler is not None:
+                try:
+                    waiter = await asyncio.wait_for(scheduler.aacquire(), timeout=max(0.0, remaining) if remaining is not None else None)
+                except asyncio.TimeoutError:
+                    raise TimeoutError("Request timed out waiting for a free slot") from None
+                stack.callback(scheduler.release, waiter)
+                slot = (scheduler, waiter)
+            for limiter in cls._limiters(namespace):
+                timeout, slo = cls._slot_timeout(slot)
+                try:
+                    await asyncio.wait_for(limiter.aacquire(key=waiter.key if slot is not None else ()), timeout=timeout)
+                except asyncio.TimeoutError:
+                    if slo:
+                        raise scheduler.expire(waiter) from None
+                    raise TimeoutError("Request timed out waiting for a free slot") from None
+                stack.callback(limiter.release)
+            if slot is not None:
+                scheduler.start(waiter)
+            yield
+
+    @classmethod
+    def _slot_timeout(cls, slot: Optional[Tuple[FairScheduler, Any]]) -> Tuple[Optional[float], bool]:
+        """
+        Returns how long to wait for the next limiter, and whether running out of that time misses the scheduler's SLO
+        rather than the request's deadline.
+        """
+        remaining = remaining_time()
+        slo = slot[0].slo_remaining(slot[1]) if slot is not None else None
+        if slo is not None and (remaining is None or slo < remaining):
+            return max(0.0, slo), True
+        return (max(0.0, remaining) if remaining is not None else None), False
+
+    @classmethod
+    def _resolve(cls, model: str) -> str:
+        fqn = cls.aliases.get(model)
+        if fqn is not None:
+            return fqn
+        if model in cls._ambiguous:
+            raise ValueError(f"Model {model} is ambiguous, it could be any of {', '.join(cls._ambiguous[model])}. Use the fully qualified name instead.")
+        raise ValueError(f"Model {model} not found. OpenLM currently supports the following models:\n{cls._pretty_list_models()}")
+
+    @classmethod
+    def _build_choice(cls, fqn: str, ret: Dict[str, Any]) -> Dict[str, Any]:
         choice = {
             "id": str(uuid.uuid4()),
             "model_name": fqn,
@@ -127,54 +1745,176 @@ class Completion():
             choice['error'] = ret['error']
         if 'text' in ret:
             choice['text'] = ret['text']
+        for key in ('logprobs', 'finish_reason'):
+            if ret.get(key) is not None:
+                choice[key] = ret[key]
         if 'usage' in ret:
             choice['usage'] = ret['usage']
         if 'extra' in ret:
             choice['extra'] = ret['extra']
+        if ret.get('score') is not None:
+            choice['extra'] = {**choice.get('extra', {}), 'score': ret['score']}
         return choice
+
+    @classmethod
+    def _build_choices(cls, fqn: str, ret: Dict[str, Any], n: Optional[int]) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
+        """
+        Builds the choices of a provider result, a list with one choice per sample when n asks for several.
+        The usage of the call is split between its samples, and errors are repeated for each of them.
+        """
+        if not n or n <= 1:
+            return cls._build_choice(fqn, ret)
+        if 'samples' not in ret:
+            return [cls._build_choice(fqn, ret) for _ in range(n)]
+        samples = ret['samples']
+        usages = split_usage(ret['usage'], len(samples)) if 'usage' in ret else [None] * len(samples)
+        choices = []
+        for sample, usage in zip(samples, usages):
+            sample_ret = {k: v for k, v in sample.items() if k != 'extra'}
+            if usage is not None:
+                sample_ret['usage'] = usage
+            if 'extra' in ret or 'extra' in sample:
+                sample_ret['extra'] = {**ret.get('extra', {}), **sample.get('extra', {})}
+            choices.append(cls._build_choice(fqn, sample_ret))
+        return choices
+
+    @classmethod
+    def _as_list(cls, choices: Union[Dict[str, Any], List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        return choices if isinstance(choices, list) else [choices]
+
+    @classmethod
+    def _timeout_choice(cls, model: str) -> Dict[str, Any]:
+        return cls._build_choice(cls._resolve(model), {'error': "Error: Request timed out"})
     
     @classmethod
-    def register(cls, providers: BaseModel | List[BaseModel]):
+    def register(cls, providers: BaseModel | List[BaseModel], session=None, pool_size: Optional[int] = None):
+        """
+        Registers one or more providers.
+
+        :param providers: The provider(s) to register.
+        :param session: A requests.Session to use for the providers' HTTP calls instead of their own pool.
+        :param pool_size: The number of keep-alive connections per host for the providers' pool.
+        """
         if not isinstance(providers, list):
             providers = [providers]
         for provider in providers:
-            for model in provider.list_models():
-                fqn = provider.namespace() + '/' + model
-                cls.models[fqn] = provider
-                cls.aliases[model] = fqn
-                cls.aliases[fqn] = fqn
-                if '/' in model:
-                    cls.aliases[model.split('/')[1]] = fqn
-
-    @classmethod
-    def register_default(cls, api_keys: Optional[Dict[str, str]] = None):
-        if openlm.api_key:
-            cls.register(OpenAI(api_key=openlm.api_key))
-        else:
-            if api_keys and api_keys['openai.com'] is not None:
-                cls.register(OpenAI(api_key=api_keys['openai.com']))
+            if session is not None or pool_size is not None:
+                provider.configure_pool(session=session, pool_size=pool_size)
+        cls._register(providers, replace=True)
+
+    @classmethod
+    def _register(cls, providers: List[BaseModel], replace: bool):
+        """
+        Adds providers to the registry. Without replace, models that are already registered keep their provider.
+        """
+        with cls._registry_lock:
+            models = dict(cls.models)
+            aliases = dict(cls.aliases)
+            ambiguous = {alias: list(fqns) for alias, fqns in cls._ambiguous.items()}
+            chat_models = dict(cls.chat_models)
+            chat_aliases = dict(cls.chat_aliases)
+            chat_ambiguous = {alias: list(fqns) for alias, fqns in cls._chat_ambiguous.items()}
+            for provider in providers:
+                cls._add_models(provider, provider.list_models(), models, aliases, ambiguous, replace)
+                if isinstance(provider, BaseChatModel):
+                    cls._add_models(provider, provider.list_chat_models(), chat_models, chat_aliases, chat_ambiguous, replace)
+            reverse_aliases: Dict[str, List[str]] = {}
+            for alias, fqn in aliases.items():
+                reverse_aliases.setdefault(fqn, []).append(alias)
+            # Publish the models first, so every alias a lookup can see has its provider
+            cls.models = models
+            cls.chat_models = chat_models
+            cls._reverse_aliases = reverse_aliases
+            cls._ambiguous = ambiguous
+            cls._chat_ambiguous = chat_ambiguous
+            cls.aliases = aliases
+            cls.chat_aliases = chat_aliases
+
+    @classmethod
+    def _add_models(cls, provider: BaseModel, names: List[str], models: Dict[str, Any], aliases: Dict[str, str],
+                    ambiguous: Dict[str, List[str]], replace: bool):
+        for model in names:
+            fqn = provider.namespace() + '/' + model
+            if fqn in models and not replace:
+                continue
+            models[fqn] = provider
+            aliases[fqn] = fqn
+            cls._add_alias(aliases, ambiguous, model, fqn)
+            if '/' in model:
+                cls._add_alias(aliases, ambiguous, model.split('/')[1], fqn)
+
+    @classmethod
+    def _add_alias(cls, aliases: Dict[str, str], ambiguous: Dict[str, List[str]], alias: str, fqn: str):
+        """
+        Points a short alias at a model. An alias claimed by two different models resolves to neither.
+        """
+        if alias in ambiguous:
+            if fqn not in ambiguous[alias]:
+                ambiguous[alias].append(fqn)
+        elif aliases.get(alias, fqn) != fqn and aliases[alias] != alias:
+            ambiguous[alias] = [aliases.pop(alias), fqn]
+        elif alias not in aliases:
+            aliases[alias] = fqn
+
+    @classmethod
+    def register_default(cls, api_keys: Optional[Dict[str, str]] = None, session=None):
+        """
+        Registers the OpenAI, HuggingFace and Cohere providers. This happens automatically on first use.
+
+        :param api_keys: API keys per provider namespace. Providers without a key read it from the environment.
+        :param session: A requests.Session to use for the providers' HTTP calls instead of the shared pool.
+        """
+        cls._register_default(api_keys, session, replace=True)
+
+    @classmethod
+    def _register_default(cls, api_keys: Optional[Dict[str, str]], session, replace: bool):
+        from openlm.llm import Cohere, Huggingface, OpenAI
+
+        api_keys = api_keys or {}
+        with cls._registry_lock:
+            pool = {'session': session, 'pool_size': cls.max_workers}
+            providers = []
+            if openlm.api_key:
+                providers.append(OpenAI(api_key=openlm.api_key, **pool))
             else:
-                cls.register(OpenAI())
-        if api_keys and api_keys['huggingface.co'] is not None:
-            cls.register(Huggingface(api_key=api_keys['huggingface.co']))
-        else:
-            cls.register(Huggingface())
-        if api_keys and api_keys['cohere.ai'] is not None:
-            cls.register(Cohere(api_key=api_keys['cohere.ai']))
-        else:
-            cls.register(Cohere())
-
-    @classmethod
-    def list_models(cls) -> List[str]:
-        reverse_alias = {}
-        for key, value in cls.aliases.items():
-            # If the value is not in the reverse dictionary, create an empty array for it
-            if value not in reverse_alias:
-                reverse_alias[value] = []
-            # Append the key to the array for the value in the reverse dictionary
-            reverse_alias[value].append(key)
-
-        return reverse_alias
+                if api_keys.get('openai.com') is not None:
+                    providers.append(OpenAI(api_key=api_keys['openai.com'], **pool))
+                else:
+                    providers.append(OpenAI(**pool))
+            if api_keys.get('huggingface.co') is not None:
+                providers.append(Huggingface(api_key=api_keys['huggingface.co'], **pool))
+            else:
+                providers.append(Huggingface(**pool))
+            if api_keys.get('cohere.ai') is not None:
+                providers.append(Cohere(api_key=api_keys['cohere.ai'], **pool))
+            else:
+                providers.append(Cohere(**pool))
+            cls._register(providers, replace)
+            cls._default_keys = cls._keys(api_keys)
+
+    @classmethod
+    def _register_defaults(cls, api_keys: Optional[Dict[str, str]] = None):
+        """
+        Registers the default providers on first use, without replacing providers registered explicitly.
+        They are registered again, replacing the previous ones, only when different API keys are passed.
+        """
+        keys = cls._keys(api_keys or {})
+        if cls._default_keys == keys:
+            return
+        with cls._registry_lock:
+            if cls._default_keys != keys:
+                cls._register_default(api_keys, None, replace=cls._default_keys is not None)
+
+    @classmethod
+    def _keys(cls, api_keys: Dict[str, str]) -> Tuple:
+        return (openlm.api_key, tuple(sorted(api_keys.items())))
+
+    @classmethod
+    def list_models(cls) -> Dict[str, List[str]]:
+        """
+        Returns the aliases of every registered model, by fully qualified name.
+        """
+        return {fqn: list(aliases) for fqn, aliases in cls._reverse_aliases.items()}
     
     @classmethod
     def _pretty_list_models(cls):
@@ -184,3 +1924,113 @@ class Completion():
         return ret
 
 
+atexit.register(Completion.shutdown)
+
+
+def _init_worker(state: bytes):
+    """
+    Sets up a worker process with the parent's providers and settings.
+    """
+    import pickle
+    providers, settings, api_key, default_keys = pickle.loads(state)
+    openlm.api_key = api_key
+    Completion._register(providers, replace=True)
+    # The default providers came with the parent's, so they aren't registered again
+    Completion._default_keys = default_keys
+    for name, value in settings.items():
+        setattr(Completion, name, value)
+
+
+def _complete_shard(model: List[str], prompts: List[str], params: Dict[str, Any], expires: Optional[float], priority: str) -> List[Dict[str, Any]]:
+    """
+    Completes a shard of prompts in a worker process, returning choices indexed within the shard.
+    """
+    deadline = time.monotonic() + max(0.0, expires - time.time()) if expires is not None else None
+    return Completion._generate_choices(model, prompts, params, deadline, priority)
+
+
+class _Route():
+    """
+    The state of routing one prompt across models.
+    """
+    def __init__(self):
+        self.next = 0
+        # The model last launched, which a timed-out prompt is reported against
+        self.fqn: Optional[str] = None
+        self.hedge_at: Optional[float] = None
+        self.result: Optional[Dict[str, Any]] = None
+
+    def launch(self, candidates: List[str], hedge_after: Optional[float]) -> str:
+        fqn = candidates[self.next]
+        self.fqn = fqn
+        self.next += 1
+        self.hedge_at = time.monotonic() + hedge_after if hedge_after is not None else None
+        return fqn
+
+    def should_hedge(self, candidates: List[str]) -> bool:
+        return (self.result is None and self.hedge_at is not None
+                and self.next < len(candidates) and self.hedge_at <= time.monotonic())
+
+    def finish(self, choice: Dict[str, Any], others_running: bool, candidates: List[str]) -> bool:
+        """
+        Records a finished request. Returns True if the next model should be tried right away.
+        """
+        if 'error' not in choice:
+            self.result = choice
+            return False
+        if others_running:
+            return False
+        if self.next < len(candidates):
+            return True
+        # Every model failed, report the last error
+        self.result = choice
+        return False
+
+
+class _ScheduledExecutor(concurrent.futures.Executor):
+    """
+    Submits tasks to an executor once the scheduler gives them a slot, so tasks don't wait in the executor's own queue.
+    """
+    def __init__(self, scheduler: FairScheduler, executor: concurrent.futures.Executor):
+        self.scheduler = scheduler
+        self.executor = executor
+
+    def submit(self, fn, *args, **kwargs) -> concurrent.futures.Future:
+        return self.scheduler.submit(self.executor, fn, *args, **kwargs)
+
+    def shutdown(self, wait: bool = True, **kwargs):
+        self.executor.shutdown(wait=wait, **kwargs)
+
+
+class _Samples():
+    """
+    How the samples of each model are drawn for create_iter, and the samples held back for best_of
+    until every sample of their prompt is in.
+    """
+    def __init__(self, completion, model: List[str], params: Dict[str, Any]):
+        self.completion = completion
+        self.n = params['n'] or 1
+        self.draws = [completion._draws(m, params) for m in model]
+        self.calls = [completion._sample_calls(m, params) for m in model]
+        # Prompts are only batched when the provider can draw all of their samples in one call
+        self.batch_sizes = [max(1, completion.models[completion._resolve(m)].max_batch_size) if len(calls) == 1 else 1
+                            for m, calls in zip(model, self.calls)]
+        self._held: Dict[Tuple[int, int], List[Dict[str, Any]]] = {}
+
+    def collect(self, result, model_idx: int, indices: List[int], first_sample: int, per_prompt: int) -> List[Dict[str, Any]]:
+        """
+        Tags the choices of a finished call, which has per_prompt samples for each prompt index.
+        """
+        choices = []
+        for k, choice in enumerate(result if isinstance(result, list) else [result]):
+            prompt_idx = indices[k // per_prompt]
+            if self.draws[model_idx] == self.n:
+                choices.append(self.completion._tag_choice(choice, model_idx, prompt_idx * self.n + first_sample + k % per_prompt))
+                continue
+            held = self._held.setdefault((model_idx, prompt_idx), [])
+            held.append(choice)
+            if len(held) == self.draws[model_idx]:
+                del self._held[model_idx, prompt_idx]
+                for sample, best in enumerate(self.completion._best(held, self.n)):
+                    choices.append(self.completion._tag_choice(best, model_idx, prompt_idx * self.n + sample))
+        return choices
@@ -0,0 +1,93 @@
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Union
+
+
+class TokenBucket():
+    """
+    A token bucket that refills continuously at `rate` per second up to `capacity`.
+    Reservations may overdraw the bucket, and the caller waits until the debt is paid back.
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._level = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """
+        Takes `amount` from the bucket and returns how many seconds to wait before using it.
+        """
+        with self._lock:
+            self._refill()
+            self._level -= amount
+            return max(0.0, -self._level / self.rate)
+
+    def refund(self, amount: float):
+        """
+        Gives back part of a reservation, e.g. when fewer tokens were used than estimated. Negative amounts charge more.
+        """
+        with self._lock:
+            self._refill()
+            self._level = min(self.capacity, self._level + amount)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class RateLimit():
+    """
+    Client-side rate limits for a provider namespace, so bulk jobs stay under quota instead of hitting 429s.
+
+    :param requests_per_minute: The maximum number of requests per minute.
+    :param tokens_per_minute: The maximum number of prompt and completion tokens per minute.
+    """
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = TokenBucket(requests_per_minute / 60, requests_per_minute) if requests_per_minute else None
+        self._tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute) if tokens_per_minute else None
+
+    def reserve(self, tokens: int = 0) -> float:
+        """
+        Reserves one request and `tokens` tokens, and returns how many seconds to wait before sending it.
+        """
+        wait = 0.0
+        if self._requests is not None:
+            wait = max(wait, self._requests.reserve(1))
+        if self._tokens is not None and tokens:
+            wait = max(wait, self._tokens.reserve(tokens))
+        return wait
+
+    def record_usage(self, estimated_tokens: int, usage: Optional[Dict[str, int]]):
+        """
+        Corrects a reservation once the provider reports how many tokens were actually used.
+        """
+        if self._tokens is not None and usage and 'total_tokens' in usage:
+            self._tokens.refund(estimated_tokens - usage['total_tokens'])
+
+    def split(self, parts: int) -> "RateLimit":
+        """
+        Returns a limit with a `parts`-th of the quotas, for each of `parts` processes sharing them.
+        """
+        return RateLimit(self.requests_per_minute / parts if self.requests_per_minute else None,
+                         self.tokens_per_minute / parts if self.tokens_per_minute else None)
+
+    def __reduce__(self):
+        # A copy starts with full buckets
+        return (RateLimit, (self.requests_per_minute, self.tokens_per_minute))
+
+
+def estimate_tokens(prompt: Union[str, List[str]], params: Dict[str, Any], count: Optional[Callable[[str], int]] = None) -> int:
+    """
+    Estimates the prompt and completion tokens of a request, counting the prompt with count if given
+    and at about 4 characters per token otherwise.
+    """
+    prompts = [prompt] if isinstance(prompt, str) else prompt
+    prompt_tokens = sum(count(p) if count is not None else len(p) // 4 + 1 for p in prompts)
+    # 16 is OpenAI's default max_tokens
+    completion_tokens = (params.get('max_tokens') or 16) * (params.get('best_of') or params.get('n') or 1) * len(prompts)
+    return prompt_tokens + completion_tokens
@@ -0,0 +1,51 @@
+import asyncio
+import random
+import sys
+from typing import Optional, Tuple
+
+from openlm.llm.base import ProviderError
+
+
+class RetryPolicy():
+    """
+    Retries failed provider calls with exponential backoff and full jitter, honouring Retry-After.
+
+    :param max_retries: The maximum number of retries after the first attempt.
+    :param base_delay: The delay in seconds before the first retry, doubled on every retry.
+    :param max_delay: The maximum delay in seconds between two attempts.
+    :param jitter: Whether to pick a random delay between 0 and the backoff, so clients don't retry in lockstep.
+    :param retry_on: The HTTP status codes to retry.
+    """
+    def __init__(self, max_retries: int = 3,
+                       base_delay: float = 0.5,
+                       max_delay: float = 30.0,
+                       jitter: bool = True,
+                       retry_on: Tuple[int, ...] = (408, 409, 429, 500, 502, 503, 504)):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.retry_on = retry_on
+
+    def should_retry(self, error: BaseException, attempt: int) -> bool:
+        if attempt >= self.max_retries:
+            return False
+        if isinstance(error, ProviderError):
+            return error.status_code in self.retry_on
+        # Connection failures and timeouts are usually transient. The HTTP clients are only checked if they were
+        # imported, since an error can't come from a client that was never loaded.
+        if isinstance(error, asyncio.TimeoutError):
+            return True
+        requests = sys.modules.get('requests')
+        if requests is not None and isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            return True
+        aiohttp = sys.modules.get('aiohttp')
+        return aiohttp is not None and isinstance(error, aiohttp.ClientConnectionError)
+
+    def delay(self, error: BaseException, attempt: int) -> float:
+        retry_after: Optional[float] = getattr(error, 'retry_after', None)
+        if retry_after is not None:
+            return retry_after
+        backoff = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return random.uniform(0, backoff) if self.jitter else backoff
+
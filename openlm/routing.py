@@ -0,0 +1,61 @@
+import collections
+import threading
+from typing import Any, Dict, List, Optional
+
+# Routing modes for Completion.create(routing=...)
+FAILOVER = 'failover'
+HEDGE = 'hedge'
+FASTEST = 'fastest'
+ROUTING_MODES = (FAILOVER, HEDGE, FASTEST)
+
+
+class LatencyStats():
+    """
+    Tracks the latency of recent successful requests and the error rate of a model.
+
+    :param window: The number of recent latencies to keep.
+    """
+    def __init__(self, window: int = 200):
+        self.successes = 0
+        self.errors = 0
+        self._latencies = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, ok: bool):
+        with self._lock:
+            if ok:
+                self.successes += 1
+                self._latencies.append(seconds)
+            else:
+                self.errors += 1
+
+    def percentile(self, q: float) -> Optional[float]:
+        """
+        Returns the q-th quantile (0 <= q <= 1) of recent latencies, or None if nothing was recorded yet.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def summary(self) -> Dict[str, Any]:
+        total = self.successes + self.errors
+        return {
+            'successes': self.successes,
+            'errors': self.errors,
+            'error_rate': self.errors / total if total else 0.0,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+        }
+
+
+def rank_by_latency(fqns: List[str], stats: Dict[str, LatencyStats]) -> List[str]:
+    """
+    Orders models by median latency. Models without stats go first so they get measured.
+    """
+    def key(fqn):
+        p50 = stats[fqn].percentile(0.5) if fqn in stats else None
+        return (p50 is not None, p50 or 0.0)
+    return sorted(fqns, key=key)
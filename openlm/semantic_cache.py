@@ -0,0 +1,367 @@
+import abc
+import collections
+import copy
+import json
+import re
+import threading
+import time
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from openlm.cache import cache_key
+
+# numpy takes longer to import than the rest of openlm, so it loads when the first cache or embedder is created
+np = None
+
+# Identifiers that templates put in otherwise identical prompts, masked by normalize_prompt
+_ID_PATTERNS = [
+    (re.compile(r'\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\b'), '<id>'),
+    (re.compile(r'\b(?=[0-9a-f]*\d)(?=[0-9a-f]*[a-f])[0-9a-f]{16,}\b'), '<id>'),
+    (re.compile(r'\b\d{6,}\b'), '<num>'),
+]
+
+# Upper bounds of the similarity buckets hits are counted in
+SIMILARITY_BUCKETS = (0.9, 0.95, 0.98, 0.99, 1.0)
+
+
+def _import_numpy():
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError("numpy is required for the semantic cache. Install it with `pip install openlm[semantic]`")
+        np = numpy
+    return np
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    Returns the prompt casefolded, with runs of whitespace collapsed and UUIDs, long hex IDs and numbers of 6 digits or more masked.
+    """
+    text = prompt.casefold()
+    for pattern, placeholder in _ID_PATTERNS:
+        text = pattern.sub(placeholder, text)
+    return ' '.join(text.split())
+
+
+class BaseEmbedder(metaclass=abc.ABCMeta):
+    # The number of dimensions of the vectors
+    dim: int
+
+    @abc.abstractmethod
+    def embed(self, texts: List[str]) -> "np.ndarray":
+        """
+        Returns one vector per text as a float32 array of shape (len(texts), dim). Vectors don't need to be normalised.
+        """
+        raise NotImplementedError
+
+
+class HashingEmbedder(BaseEmbedder):
+    """
+    Embeds text locally without a model by hashing its words and character n-grams into a fixed number of dimensions.
+    Prompts that share most of their words and spelling are close, which is what near-duplicates from the same template look like.
+    Hashes are stable across processes, so vectors stored on disk stay valid.
+
+    :param dim: The number of dimensions.
+    :param ngram: The length of the character n-grams.
+    """
+    def __init__(self, dim: int = 1024, ngram: int = 3):
+        _import_numpy()
+        self.dim = dim
+        self.ngram = ngram
+
+    def embed(self, texts: List[str]) -> "np.ndarray":
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            hashes = [self._ngram_hashes(f' {text} ')]
+            words = text.split()
+            if words:
+                hashes.append(np.array([zlib.crc32(word.encode('utf-8')) for word in words], dtype=np.uint64))
+            h = np.concatenate(hashes)
+            if not len(h):
+                continue
+            # The top bit picks the sign, so colliding features cancel out on average instead of adding up
+            signs = np.where(h & np.uint64(1 << 31), -1.0, 1.0).astype(np.float32)
+            np.add.at(vectors[i], (h % np.uint64(self.dim)).astype(np.intp), signs)
+        return vectors
+
+    def _ngram_hashes(self, text: str) -> "np.ndarray":
+        codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+        if len(codes) < self.ngram:
+            return np.zeros(0, dtype=np.uint64)
+        h = np.zeros(len(codes) - self.ngram + 1, dtype=np.uint64)
+        for k in range(self.ngram):
+            h = h * np.uint64(0x100000001b3) + codes[k:len(codes) - self.ngram + 1 + k]
+        # Mixes the high bits into the low ones used for the dimension and sign
+        h ^= h >> np.uint64(29)
+        h *= np.uint64(0xbf58476d1ce4e5b9)
+        h ^= h >> np.uint64(32)
+        return h & np.uint64(0xffffffff)
+
+
+class _Index():
+    """
+    Unit vectors of one (model, parameters) pair, searched with a single matrix-vector product.
+    """
+    def __init__(self, dim: int):
+        self.vectors = np.zeros((16, dim), dtype=np.float32)
+        self.ids: List[int] = []
+        self._rows: Dict[int, int] = {}
+
+    def add(self, entry_id: int, vector: "np.ndarray"):
+        if len(self.ids) == len(self.vectors):
+            self.vectors = np.concatenate([self.vectors, np.zeros_like(self.vectors)])
+        self._rows[entry_id] = len(self.ids)
+        self.vectors[len(self.ids)] = vector
+        self.ids.append(entry_id)
+
+    def remove(self, entry_id: int):
+        # The last row moves into the hole, so the rows stay contiguous
+        row = self._rows.pop(entry_id)
+        last = self.ids.pop()
+        if last != entry_id:
+            self.vectors[row] = self.vectors[len(self.ids)]
+            self.ids[row] = last
+            self._rows[last] = row
+
+    def search(self, vector: "np.ndarray") -> Tuple[Optional[int], float]:
+        if not self.ids:
+            return None, 0.0
+        similarities = self.vectors[:len(self.ids)] @ vector
+        row = int(np.argmax(similarities))
+        return self.ids[row], float(similarities[row])
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class _Entry():
+    def __init__(self, index_key: str, fqn: str, text: str, value: Dict[str, Any], created: float):
+        self.index_key = index_key
+        self.fqn = fqn
+        self.text = text
+        self.value = value
+        self.created = created
+
+
+class SemanticCache():
+    """
+    A cache of provider responses that also answers prompts similar to a cached one, e.g. the same question with different
+    whitespace, casing or IDs. Prompts are normalised and embedded, and looked up by cosine similarity among the prompts
+    cached for the same model and parameters. Needs numpy (`pip install openlm[semantic]`).
+
+    :param threshold: The minimum cosine similarity between the normalised prompts of a hit, from 0 to 1.
+    :param thresholds: Thresholds by fully qualified model name or provider namespace, overriding threshold.
+    :param maxsize: The maximum number of entries to keep, evicting the least recently used first.
+    :param ttl: The number of seconds an entry stays valid, or None to keep entries until evicted.
+    :param embedder: How to embed prompts. Defaults to a HashingEmbedder.
+    :param normalize: How to normalise prompts before embedding them. Prompts that normalise to the same text are exact hits.
+    :param path: A sqlite file to keep the entries in, so they survive restarts. Entries are loaded from it on creation.
+    """
+    def __init__(self, threshold: float = 0.95,
+                       thresholds: Optional[Dict[str, float]] = None,
+                       maxsize: int = 4096,
+                       ttl: Optional[float] = None,
+                       embedder: Optional[BaseEmbedder] = None,
+                       normalize: Callable[[str], str] = normalize_prompt,
+                       path: Optional[str] = None):
+        _import_numpy()
+        self.threshold = threshold
+        self.thresholds = dict(thresholds or {})
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.embedder = embedder if embedder is not None else HashingEmbedder()
+        self.normalize = normalize
+        self.path = path
+        self.hits = 0
+        self.exact_hits = 0
+        self.misses = 0
+        # Misses whose closest prompt was within 0.05 of the threshold, a sign the threshold may be too strict
+        self.near_misses = 0
+        self.evictions = 0
+        self.similarity_buckets = [0] * len(SIMILARITY_BUCKETS)
+        self._similarity_sum = 0.0
+        self._entries: "collections.OrderedDict[int, _Entry]" = collections.OrderedDict()
+        self._texts: Dict[Tuple[str, str], int] = {}
+        self._indexes: Dict[str, _Index] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        if path is not None:
+            self._open(path)
+
+    def get(self, fqn: str, prompt: str, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Returns the cached response of the most similar prompt for the model and parameters, or None if none is similar enough.
+        """
+        index_key = cache_key(fqn, '', params)
+        text = self.normalize(prompt)
+        threshold = self.threshold_for(fqn)
+        with self._lock:
+            entry_id, similarity = self._texts.get((index_key, text)), 1.0
+            index = self._indexes.get(index_key)
+        if entry_id is None and index is not None:
+            vector = self._embed(text)
+            with self._lock:
+                entry_id, similarity = index.search(vector)
+            if entry_id is not None and similarity < threshold:
+                with self._lock:
+                    self.misses += 1
+                    if similarity >= threshold - 0.05:
+                        self.near_misses += 1
+                return None
+        with self._lock:
+            entry = self._entries.get(entry_id) if entry_id is not None else None
+            if entry is not None and self.ttl is not None and entry.created + self.ttl < time.time():
+                self._remove(entry_id)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+            self.exact_hits += entry.text == text
+            self._similarity_sum += similarity
+            self.similarity_buckets[self._bucket(similarity)] += 1
+            return copy.deepcopy(entry.value)
+
+    def set(self, fqn: str, prompt: str, params: Dict[str, Any], value: Dict[str, Any]):
+        index_key = cache_key(fqn, '', params)
+        text = self.normalize(prompt)
+        vector = self._embed(text)
+        with self._lock:
+            previous = self._texts.get((index_key, text))
+            if previous is not None:
+                self._remove(previous)
+            entry_id = self._add(_Entry(index_key, fqn, text, copy.deepcopy(value), time.time()), vector)
+            if self._conn is not None:
+                self._conn.execute('INSERT INTO semantic_cache (id, index_key, fqn, text, vector, value, created) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   (entry_id, index_key, fqn, text, vector.tobytes(), json.dumps(value), self._entries[entry_id].created))
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def threshold_for(self, fqn: str) -> float:
+        return self.thresholds.get(fqn, self.thresholds.get(fqn.split('/', 1)[0], self.threshold))
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'exact_hits': self.exact_hits,
+            'misses': self.misses,
+            'near_misses': self.near_misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'mean_hit_similarity': self._similarity_sum / self.hits if self.hits else None,
+            'hit_similarity': dict(zip(SIMILARITY_BUCKETS, self.similarity_buckets)),
+            'evictions': self.evictions,
+            'size': len(self),
+        }
+
+    def prometheus(self, prefix: str = 'openlm') -> str:
+        lines = [
+            f"# TYPE {prefix}_semantic_cache_lookups_total counter",
+            f'{prefix}_semantic_cache_lookups_total{{result="hit"}} {self.hits}',
+            f'{prefix}_semantic_cache_lookups_total{{result="miss"}} {self.misses}',
+            f"# TYPE {prefix}_semantic_cache_near_misses_total counter",
+            f"{prefix}_semantic_cache_near_misses_total {self.near_misses}",
+            f"# TYPE {prefix}_semantic_cache_evictions_total counter",
+            f"{prefix}_semantic_cache_evictions_total {self.evictions}",
+            f"# TYPE {prefix}_semantic_cache_entries gauge",
+            f"{prefix}_semantic_cache_entries {len(self)}",
+            f"# TYPE {prefix}_semantic_cache_hit_similarity histogram",
+        ]
+        cumulative = 0
+        for bound, count in zip(SIMILARITY_BUCKETS, self.similarity_buckets):
+            cumulative += count
+            lines.append(f'{prefix}_semantic_cache_hit_similarity_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{prefix}_semantic_cache_hit_similarity_bucket{{le="+Inf"}} {self.hits}')
+        lines.append(f"{prefix}_semantic_cache_hit_similarity_sum {self._similarity_sum}")
+        lines.append(f"{prefix}_semantic_cache_hit_similarity_count {self.hits}")
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._texts.clear()
+            self._indexes.clear()
+            if self._conn is not None:
+                self._conn.execute('DELETE FROM semantic_cache')
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getstate__(self):
+        # A copy in a worker process starts from the entries cached so far and keeps its own in memory,
+        # since the sqlite rows are keyed by ids each process would hand out independently
+        with self._lock:
+            state = self.__dict__.copy()
+            state['_entries'] = copy.deepcopy(self._entries)
+            state['_indexes'] = copy.deepcopy(self._indexes)
+            state['_texts'] = dict(self._texts)
+        del state['_lock']
+        state['_conn'] = None
+        return state
+
+    def __setstate__(self, state):
+        _import_numpy()
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _embed(self, text: str) -> "np.ndarray":
+        vector = np.asarray(self.embedder.embed([text])[0], dtype=np.float32)
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else vector
+
+    def _bucket(self, similarity: float) -> int:
+        for i, bound in enumerate(SIMILARITY_BUCKETS):
+            if similarity <= bound:
+                return i
+        return len(SIMILARITY_BUCKETS) - 1
+
+    def _add(self, entry: _Entry, vector: "np.ndarray", entry_id: Optional[int] = None) -> int:
+        if entry_id is None:
+            entry_id = self._next_id
+        self._next_id = max(self._next_id, entry_id + 1)
+        self._entries[entry_id] = entry
+        self._texts[entry.index_key, entry.text] = entry_id
+        index = self._indexes.get(entry.index_key)
+        if index is None:
+            index = self._indexes[entry.index_key] = _Index(len(vector))
+        index.add(entry_id, vector)
+        return entry_id
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        del self._texts[entry.index_key, entry.text]
+        index = self._indexes[entry.index_key]
+        index.remove(entry_id)
+        if not len(index):
+            del self._indexes[entry.index_key]
+        if self._conn is not None:
+            self._conn.execute('DELETE FROM semantic_cache WHERE id = ?', (entry_id,))
+
+    def _open(self, path: str):
+        import sqlite3
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS semantic_cache (id INTEGER PRIMARY KEY, index_key TEXT NOT NULL, fqn TEXT NOT NULL, '
+                           'text TEXT NOT NULL, vector BLOB NOT NULL, value TEXT NOT NULL, created REAL NOT NULL)')
+        now = time.time()
+        for entry_id, index_key, fqn, text, vector, value, created in self._conn.execute('SELECT * FROM semantic_cache ORDER BY id'):
+            vector = np.frombuffer(vector, dtype=np.float32)
+            # Entries of another embedder or past their ttl are dropped
+            if len(vector) != self.embedder.dim or (self.ttl is not None and created + self.ttl < now):
+                self._conn.execute('DELETE FROM semantic_cache WHERE id = ?', (entry_id,))
+                continue
+            self._add(_Entry(index_key, fqn, text, json.loads(value), created), vector.copy(), entry_id)
+        while len(self._entries) > self.maxsize:
+            self._remove(next(iter(self._entries)))
@@ -0,0 +1,259 @@
+import argparse
+import asyncio
+import functools
+import json
+import multiprocessing
+import socket
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional
+
+from openlm.adaptive import prometheus as adaptive_prometheus
+from openlm.cache import MemoryCache, SQLiteCache
+from openlm.chat import ChatCompletion
+from openlm.llm.http import async_available, close_async_sessions
+from openlm.openlm import Completion
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+# Body fields passed through to Completion.acreate
+COMPLETION_PARAMS = ('model', 'prompt', 'suffix', 'max_tokens', 'temperature', 'top_p', 'n', 'stream', 'logprobs', 'echo', 'stop',
+                     'presence_penalty', 'frequency_penalty', 'best_of', 'logit_bias', 'user', 'routing', 'hedge_delay')
+# Body fields passed through to ChatCompletion.acreate
+CHAT_PARAMS = ('model', 'messages', 'max_tokens', 'temperature', 'top_p', 'n', 'stream', 'stop',
+               'presence_penalty', 'frequency_penalty', 'logit_bias', 'user')
+
+
+class Backpressure():
+    """
+    Lets max_concurrency completions run at once and up to max_queue more wait for a slot.
+    Requests beyond that, or that wait longer than queue_timeout, are turned away so callers back off instead of piling up.
+    """
+    def __init__(self, max_concurrency: int = 64, max_queue: int = 256, queue_timeout: float = 30.0):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self.queued = 0
+        self.rejected = 0
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def acquire(self) -> bool:
+        """
+        Waits for a slot. Returns False if the request should be rejected.
+        """
+        if self._semaphore is None:
+            # Created here rather than in __init__ so it binds to the server's event loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if self.running + self.queued >= self.max_concurrency + self.max_queue:
+            self.rejected += 1
+            return False
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return False
+        finally:
+            self.queued -= 1
+        self.running += 1
+        return True
+
+    def release(self):
+        self.running -= 1
+        self._semaphore.release()
+
+    def prometheus(self, prefix: str = 'openlm') -> str:
+        return '\n'.join([
+            f"# TYPE {prefix}_gateway_running gauge",
+            f"{prefix}_gateway_running {self.running}",
+            f"# TYPE {prefix}_gateway_queued gauge",
+            f"{prefix}_gateway_queued {self.queued}",
+            f"# TYPE {prefix}_gateway_rejected_total counter",
+            f"{prefix}_gateway_rejected_total {self.rejected}",
+        ]) + '\n'
+
+
+def create_app(max_concurrency: int = 64,
+               max_queue: int = 256,
+               queue_timeout: float = 30.0,
+               request_timeout: float = 0,
+               retry_after: int = 1) -> "web.Application":
+    """
+    Creates an aiohttp application that serves the Completion registry with the OpenAI HTTP API:
+    POST /v1/completions and POST /v1/chat/completions, with server-sent events when stream is set, GET /v1/models and GET /metrics.
+
+    Upstream connection pools, the response cache, retries and rate limits are the process-wide ones of Completion,
+    so every client of the gateway shares them. Configure them with Completion.configure before serving.
+
+    :param max_concurrency: The maximum number of completions running at once.
+    :param max_queue: The maximum number of completions waiting for a slot. Requests beyond that get a 429.
+    :param queue_timeout: The number of seconds a completion can wait for a slot before it gets a 429.
+    :param request_timeout: The default request_timeout of every completion, 0 for none.
+    :param retry_after: The Retry-After value in seconds sent with 429s.
+    """
+    if not async_available():
+        raise ImportError("aiohttp is required for the server. Install it with `pip install openlm[async]`")
+    from aiohttp import web
+
+    backpressure = Backpressure(max_concurrency, max_queue, queue_timeout)
+
+    async def serve_create(request: web.Request, create, fields, required) -> web.StreamResponse:
+        try:
+            body = await request.json()
+        except ValueError:
+            return _error(400, 'The request body is not valid JSON')
+        if not isinstance(body, dict) or any(field not in body for field in required):
+            return _error(400, f"The request body needs {' and '.join(required)}")
+        params: Dict[str, Any] = {k: body[k] for k in fields if body.get(k) is not None}
+        params['request_timeout'] = body.get('request_timeout') or request_timeout
+
+        if not await backpressure.acquire():
+            return _error(429, 'The server is overloaded, retry later', 'server_overloaded', headers={'Retry-After': str(retry_after)})
+        try:
+            try:
+                result = await create(**params)
+            except (TypeError, ValueError) as e:
+                return _error(400, str(e))
+            if not params.get('stream'):
+                return web.json_response(result)
+            return await _stream(request, result)
+        finally:
+            backpressure.release()
+
+    async def completions(request: web.Request) -> web.StreamResponse:
+        return await serve_create(request, Completion.acreate, COMPLETION_PARAMS, ('model', 'prompt'))
+
+    async def chat_completions(request: web.Request) -> web.StreamResponse:
+        return await serve_create(request, ChatCompletion.acreate, CHAT_PARAMS, ('model', 'messages'))
+
+    async def models(request: web.Request) -> web.Response:
+        Completion._register_defaults()
+        created = int(time.time())
+        data = [{'id': fqn, 'object': 'model', 'created': created, 'owned_by': fqn.split('/', 1)[0], 'aliases': aliases}
+                for fqn, aliases in sorted(Completion.list_models().items())]
+        return web.json_response({'object': 'list', 'data': data})
+
+    async def metrics(request: web.Request) -> web.Response:
+        text = backpressure.prometheus()
+        if Completion.metrics is not None:
+            text += Completion.metrics.prometheus()
+        if Completion.semantic_cache is not None:
+            text += Completion.semantic_cache.prometheus()
+        text += adaptive_prometheus(Completion.adaptive_concurrency)
+        if Completion.scheduler is not None:
+            text += Completion.scheduler.prometheus()
+        return web.Response(text=text, content_type='text/plain', charset='utf-8')
+
+    async def on_cleanup(app: web.Application):
+        await close_async_sessions()
+
+    app = web.Application()
+    app['backpressure'] = backpressure
+    app.router.add_post('/v1/completions', completions)
+    app.router.add_post('/v1/chat/completions', chat_completions)
+    app.router.add_get('/v1/models', models)
+    app.router.add_get('/metrics', metrics)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+async def _stream(request: "web.Request", chunks) -> "web.StreamResponse":
+    from aiohttp import web
+
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+    await response.prepare(request)
+    try:
+        async for chunk in chunks:
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+        await response.write(b"data: [DONE]\n\n")
+    except ConnectionResetError:
+        # The client went away, closing the generator below cancels the upstream calls
+        pass
+    finally:
+        await chunks.aclose()
+    return response
+
+
+def _error(status: int, message: str, type: str = 'invalid_request_error', headers: Optional[Dict[str, str]] = None) -> "web.Response":
+    from aiohttp import web
+
+    return web.json_response({'error': {'message': message, 'type': type, 'param': None, 'code': None}},
+                             status=status, headers=headers)
+
+
+def serve(host: str = '0.0.0.0', port: int = 8000, workers: int = 1, setup: Optional[Callable[[], None]] = None, **kwargs):
+    """
+    Runs the gateway until interrupted.
+
+    With more than one worker, each worker is a separate process listening on the same port with SO_REUSEPORT,
+    and the kernel spreads connections between them. Each worker has its own upstream pools, cache and limits.
+
+    :param host: The interface to listen on.
+    :param port: The port to listen on.
+    :param workers: The number of worker processes.
+    :param setup: Called in each worker before it starts serving, e.g. to configure Completion.
+    :param kwargs: Passed to create_app.
+    """
+    if workers <= 1:
+        _run(host, port, False, setup, kwargs)
+        return
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise ValueError("Multiple workers need SO_REUSEPORT, which this platform doesn't support")
+    processes = [multiprocessing.Process(target=_run, args=(host, port, True, setup, kwargs), name=f'openlm-server-{i}')
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+
+def _run(host: str, port: int, reuse_port: bool, setup: Optional[Callable[[], None]], kwargs: Dict[str, Any]):
+    from aiohttp import web
+
+    if setup is not None:
+        setup()
+    web.run_app(create_app(**kwargs), host=host, port=port, reuse_port=reuse_port or None, print=None)
+
+
+def _configure(cache: str, cache_path: Optional[str], max_workers: Optional[int]):
+    # Runs in each worker, so no cache connection is shared across processes
+    if cache == 'memory':
+        Completion.configure(cache=MemoryCache())
+    elif cache == 'sqlite':
+        Completion.configure(cache=SQLiteCache(cache_path) if cache_path else SQLiteCache())
+    if max_workers is not None:
+        Completion.configure(max_workers=max_workers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='openlm-server', description='Serve the OpenLM models with the OpenAI completions and chat completions APIs.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes sharing the port.')
+    parser.add_argument('--max-concurrency', type=int, default=64, help='Completions running at once per worker.')
+    parser.add_argument('--max-queue', type=int, default=256, help='Completions waiting for a slot per worker before new ones get a 429.')
+    parser.add_argument('--queue-timeout', type=float, default=30.0, help='Seconds a completion can wait for a slot.')
+    parser.add_argument('--request-timeout', type=float, default=0, help='Default deadline of a completion in seconds, 0 for none.')
+    parser.add_argument('--cache', choices=['none', 'memory', 'sqlite'], default='none', help='Cache deterministic responses.')
+    parser.add_argument('--cache-path', help='SQLite file for --cache sqlite.')
+    parser.add_argument('--max-workers', type=int, help='Threads for providers without a native async client.')
+    args = parser.parse_args(argv)
+
+    print(f"Serving OpenLM on http://{args.host}:{args.port} with {args.workers} worker(s)")
+    serve(args.host, args.port, args.workers,
+          setup=functools.partial(_configure, args.cache, args.cache_path, args.max_workers),
+          max_concurrency=args.max_concurrency,
+          max_queue=args.max_queue,
+          queue_timeout=args.queue_timeout,
+          request_timeout=args.request_timeout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import asyncio
+import concurrent.futures
+import copy
+import threading
+from typing import Any, Awaitable, Callable, Dict
+
+
+class _Abandoned(Exception):
+    """
+    Raised to waiters when the request they were sharing was cancelled.
+    """
+
+
+class SingleFlight():
+    """
+    Coalesces concurrent calls with the same key into one call whose result is shared by every caller.
+    Threads and asyncio tasks share the same in-flight calls.
+    """
+    def __init__(self):
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._calls: Dict[str, concurrent.futures.Future] = {}
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        future, leader = self._join(key)
+        if not leader:
+            try:
+                return copy.deepcopy(future.result())
+            except _Abandoned:
+                return fn()
+        try:
+            result = fn()
+        except BaseException as e:
+            self._finish(key, future, exception=e)
+            raise
+        self._finish(key, future, result=result)
+        return result
+
+    async def ado(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        future, leader = self._join(key)
+        if not leader:
+            try:
+                return copy.deepcopy(await asyncio.wrap_future(future))
+            except _Abandoned:
+                return await fn()
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            # Let the waiters make their own request rather than failing them with our cancellation
+            self._finish(key, future, exception=_Abandoned())
+            raise
+        except BaseException as e:
+            self._finish(key, future, exception=e)
+            raise
+        self._finish(key, future, result=result)
+        return result
+
+    def _join(self, key: str):
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = concurrent.futures.Future()
+            self._calls[key] = future
+            return future, True
+
+    def _finish(self, key: str, future: concurrent.futures.Future, result: Any = None, exception: BaseException = None):
+        with self._lock:
+            del self._calls[key]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
@@ -0,0 +1,226 @@
+import abc
+import importlib.util
+import math
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+# What to do with a prompt that doesn't fit in the context window with max_tokens
+REJECT = 'reject'
+TRUNCATE = 'truncate'
+OVERLENGTH_POLICIES = (REJECT, TRUNCATE)
+
+# Context windows in tokens by fully qualified model name, shared by the prompt and the completion
+CONTEXT_WINDOWS: Dict[str, int] = {
+    'openai.com/text-davinci-003': 4097,
+    'openai.com/text-davinci-002': 4097,
+    'openai.com/text-curie-001': 2049,
+    'openai.com/text-babbage-001': 2049,
+    'openai.com/text-ada-001': 2049,
+    'openai.com/ada': 2049,
+    'openai.com/babbage': 2049,
+    'openai.com/curie': 2049,
+    'openai.com/davinci': 2049,
+    'huggingface.co/gpt2': 1024,
+    'huggingface.co/distilgpt2': 1024,
+    'huggingface.co/gpt2-large': 1024,
+    'huggingface.co/gpt2-medium': 1024,
+    'huggingface.co/gpt2-xl': 1024,
+    'huggingface.co/bigscience/bloom-560m': 2048,
+    'huggingface.co/bigscience/bloom-1b': 2048,
+    'huggingface.co/bigscience/bloom-3b': 2048,
+    'huggingface.co/bigscience/bloom-7b1': 2048,
+    'huggingface.co/decapoda-research/llama-7b-hf': 2048,
+    'huggingface.co/decapoda-research/llama-13b-hf': 2048,
+    'huggingface.co/decapoda-research/llama-30b-hf': 2048,
+    'huggingface.co/decapoda-research/llama-65b-hf': 2048,
+    'huggingface.co/EleutherAI/gpt-j-6B': 2048,
+    'huggingface.co/EleutherAI/gpt-neo-125M': 2048,
+    'cohere.ai/command': 4096,
+    'cohere.ai/command-nightly': 4096,
+    'cohere.ai/command-light': 4096,
+    'cohere.ai/command-light-nightly': 4096,
+}
+
+
+class BaseTokenizer(metaclass=abc.ABCMeta):
+    @abc.abstractmethod
+    def count(self, text: str) -> int:
+        """
+        Returns the number of tokens in text.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """
+        Returns the last max_tokens tokens of text. The end of a prompt is what the completion follows, so it is kept.
+        """
+        raise NotImplementedError
+
+
+class ByteTokenizer(BaseTokenizer):
+    """
+    Estimates tokens from the UTF-8 length of the text, without a vocabulary. English text averages about 4 bytes per token
+    with GPT-style BPE vocabularies.
+
+    :param bytes_per_token: The average number of bytes per token.
+    """
+    def __init__(self, bytes_per_token: float = 4.0):
+        self.bytes_per_token = bytes_per_token
+
+    def count(self, text: str) -> int:
+        return math.ceil(len(text.encode('utf-8')) / self.bytes_per_token)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        data = text.encode('utf-8')
+        keep = int(max_tokens * self.bytes_per_token)
+        if len(data) <= keep:
+            return text
+        # A multi-byte character cut in half is dropped
+        return data[len(data) - keep:].decode('utf-8', errors='ignore') if keep > 0 else ''
+
+
+class TiktokenTokenizer(BaseTokenizer):
+    """
+    Counts tokens with a tiktoken encoding, exact for OpenAI models. Needs `pip install tiktoken`.
+    """
+    def __init__(self, encoding):
+        self.encoding = encoding
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        tokens = self.encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return self.encoding.decode(tokens[len(tokens) - max_tokens:]) if max_tokens > 0 else ''
+
+
+class HuggingfaceTokenizer(BaseTokenizer):
+    """
+    Counts tokens with a model's tokenizer from the `tokenizers` library. Needs `pip install tokenizers`.
+    """
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    def count(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        ids = self.tokenizer.encode(text, add_special_tokens=False).ids
+        if len(ids) <= max_tokens:
+            return text
+        return self.tokenizer.decode(ids[len(ids) - max_tokens:]) if max_tokens > 0 else ''
+
+
+def tiktoken_tokenizer(model: str) -> BaseTokenizer:
+    import tiktoken
+
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Aliases like ada aren't known to tiktoken
+        encoding = tiktoken.get_encoding('r50k_base')
+    return TiktokenTokenizer(encoding)
+
+
+def huggingface_tokenizer(model: str) -> BaseTokenizer:
+    """
+    Loads a model's tokenizer from the local Hugging Face Hub cache only, so counting tokens never waits on a download.
+    Models whose tokenizer isn't cached get the byte-level estimate. Cache one ahead of time with
+    `huggingface-cli download <model> tokenizer.json`.
+    """
+    from huggingface_hub import hf_hub_download
+    from tokenizers import Tokenizer
+
+    return HuggingfaceTokenizer(Tokenizer.from_file(hf_hub_download(model, 'tokenizer.json', local_files_only=True)))
+
+
+# Tokenizer factories by namespace or fully qualified model name, called with the model name without its namespace.
+# tiktoken downloads an encoding once on first use and caches it on disk. Hugging Face tokenizers are only read from the local cache.
+_factories: Dict[str, Callable[[str], BaseTokenizer]] = {}
+if importlib.util.find_spec('tiktoken') is not None:
+    _factories['openai.com'] = tiktoken_tokenizer
+if importlib.util.find_spec('tokenizers') is not None and importlib.util.find_spec('huggingface_hub') is not None:
+    _factories['huggingface.co'] = huggingface_tokenizer
+
+_tokenizers: Dict[str, BaseTokenizer] = {}
+_lock = threading.Lock()
+# Held while a model's tokenizer loads, so loading one model doesn't hold up the others
+_loading: Dict[str, threading.Lock] = {}
+_fallback = ByteTokenizer()
+
+
+def register_tokenizer(name: str, factory: Callable[[str], BaseTokenizer]):
+    """
+    Sets how to load the tokenizer of a provider namespace, e.g. 'cohere.ai', or of a single fully qualified model name.
+
+    :param name: The namespace or fully qualified model name.
+    :param factory: Called with the model name without its namespace, returns a BaseTokenizer.
+    """
+    with _lock:
+        _factories[name] = factory
+        for fqn in [fqn for fqn in _tokenizers if fqn == name or fqn.split('/', 1)[0] == name]:
+            del _tokenizers[fqn]
+
+
+def get_tokenizer(fqn: str) -> BaseTokenizer:
+    """
+    Returns the tokenizer of a fully qualified model name, loading it on first use.
+    Models without a tokenizer, or whose tokenizer fails to load, get the byte-level estimate.
+    """
+    tokenizer = _tokenizers.get(fqn)
+    if tokenizer is not None:
+        return tokenizer
+    namespace, _, model = fqn.partition('/')
+    with _lock:
+        loading = _loading.setdefault(fqn, threading.Lock())
+    with loading:
+        tokenizer = _tokenizers.get(fqn)
+        if tokenizer is not None:
+            return tokenizer
+        with _lock:
+            factory = _factories.get(fqn) or _factories.get(namespace)
+        tokenizer = _fallback
+        if factory is not None:
+            try:
+                tokenizer = factory(model)
+            except Exception:
+                pass
+        with _lock:
+            # A factory registered while this one loaded wins
+            if (_factories.get(fqn) or _factories.get(namespace)) is factory:
+                _tokenizers[fqn] = tokenizer
+        return tokenizer
+
+
+def context_window(fqn: str) -> Optional[int]:
+    """
+    Returns the context window of a fully qualified model name in tokens, or None if it isn't known.
+    """
+    return CONTEXT_WINDOWS.get(fqn)
+
+
+def count_usage(fqn: str, prompt: str, completions: List[str]) -> Dict[str, int]:
+    """
+    Counts the usage of a call that completed prompt once per completion, the way providers report it.
+    """
+    tokenizer = get_tokenizer(fqn)
+    prompt_tokens = tokenizer.count(prompt)
+    completion_tokens = sum(tokenizer.count(text) for text in completions)
+    return {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': prompt_tokens + completion_tokens,
+    }
+
+
+def fill_usage(fqn: str, prompt: str, ret: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Adds the counted usage to a provider result that doesn't report it.
+    """
+    if 'usage' in ret or 'error' in ret:
+        return ret
+    texts = [sample.get('text', '') for sample in ret['samples']] if 'samples' in ret else [ret.get('text', '')]
+    return {**ret, 'usage': count_usage(fqn, prompt, texts)}
@@ -0,0 +1,93 @@
+import json
+import os
+import struct
+import sys
+
+import pytest
+
+import openlm
+from openlm.instrumentation import Metrics
+from openlm.openlm import Completion
+from openlm.singleflight import SingleFlight
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from mock_server import MockConfig, MockServer  # noqa: E402
+
+
+@pytest.fixture
+def completion():
+    """
+    Completion with its settings, registry and shared state restored after the test.
+    The default providers count as registered, so only the providers a test registers are used.
+    """
+    names = set(vars(Completion))
+    saved = {name: value for name, value in vars(Completion).items()
+             if not name.startswith('__') and not isinstance(value, (classmethod, staticmethod))}
+    api_key = openlm.api_key
+    openlm.api_key = 'mock'
+    Completion._default_keys = Completion._keys({})
+    Completion._executor = None
+    Completion._in_flight = None
+    Completion._provider_limiters = {}
+    Completion._flights = SingleFlight()
+    Completion.metrics = Metrics()
+    yield Completion
+    Completion.shutdown()
+    for name in [name for name in vars(Completion) if name not in names]:
+        delattr(Completion, name)
+    for name, value in saved.items():
+        setattr(Completion, name, value)
+    openlm.api_key = api_key
+
+
+@pytest.fixture
+def mock_server():
+    with MockServer(MockConfig(latency=0.0, tokens=4)) as server:
+        yield server
+
+
+@pytest.fixture(scope='session')
+def tiny_model(tmp_path_factory):
+    """
+    The path of a randomly initialised two-layer GPT-2 checkpoint with a byte-level vocabulary.
+    """
+    np = pytest.importorskip('numpy')
+    from openlm.llm.local import _bytes_to_unicode
+
+    path = tmp_path_factory.mktemp('tiny')
+    n_layer, n_embd, n_positions = 2, 32, 128
+    byte_encoder = _bytes_to_unicode()
+    vocab = {byte_encoder[b]: b for b in range(256)}
+    vocab['Ġt'] = 256
+    vocab['<|endoftext|>'] = 257
+    (path / 'vocab.json').write_text(json.dumps(vocab))
+    (path / 'merges.txt').write_text('#version: 0.2\nĠ t\n')
+    (path / 'config.json').write_text(json.dumps({'n_layer': n_layer, 'n_head': 4, 'n_embd': n_embd,
+                                                  'n_positions': n_positions, 'vocab_size': len(vocab)}))
+    rng = np.random.default_rng(0)
+    tensors = {
+        'wte.weight': rng.normal(0, 0.5, (len(vocab), n_embd)),
+        'wpe.weight': rng.normal(0, 0.1, (n_positions, n_embd)),
+        'ln_f.weight': np.ones(n_embd),
+        'ln_f.bias': np.zeros(n_embd),
+    }
+    for layer in range(n_layer):
+        prefix = f'h.{layer}.'
+        for norm in ('ln_1', 'ln_2'):
+            tensors[prefix + norm + '.weight'] = np.ones(n_embd)
+            tensors[prefix + norm + '.bias'] = np.zeros(n_embd)
+        for name, shape in (('attn.c_attn', (n_embd, 3 * n_embd)), ('attn.c_proj', (n_embd, n_embd)),
+                            ('mlp.c_fc', (n_embd, 4 * n_embd)), ('mlp.c_proj', (4 * n_embd, n_embd))):
+            tensors[prefix + name + '.weight'] = rng.normal(0, 0.2, shape)
+            tensors[prefix + name + '.bias'] = np.zeros(shape[1])
+    header, blobs, offset = {}, [], 0
+    for name, tensor in tensors.items():
+        blob = np.ascontiguousarray(tensor, dtype='<f4').tobytes()
+        header['transformer.' + name] = {'dtype': 'F32', 'shape': list(tensor.shape), 'data_offsets': [offset, offset + len(blob)]}
+        offset += len(blob)
+        blobs.append(blob)
+    encoded = json.dumps(header).encode()
+    encoded += b' ' * (-len(encoded) % 8)
+    (path / 'model.safetensors').write_bytes(struct.pack('<Q', len(encoded)) + encoded + b''.join(blobs))
+    return str(path)
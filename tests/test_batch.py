@@ -0,0 +1,83 @@
+import json
+
+from openlm.batch import _load_checkpoint, run_batch
+
+
+def _write(path, rows, tail=''):
+    path.write_text(''.join(json.dumps(row) + '\n' for row in rows) + tail)
+
+
+def _rows(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_torn_last_line_is_truncated(tmp_path):
+    path = tmp_path / 'out.jsonl'
+    _write(path, [{'id': 1, 'model_name': 'm', 'text': 'a'}], tail='{"id": 2, "mod')
+    assert _load_checkpoint(str(path), retry_errors=False) == {('1', 'm')}
+    assert _rows(path) == [{'id': 1, 'model_name': 'm', 'text': 'a'}]
+
+
+def test_ids_keep_their_type(tmp_path):
+    path = tmp_path / 'out.jsonl'
+    _write(path, [{'id': 1, 'model_name': 'm', 'text': 'a'}, {'id': '1', 'model_name': 'm', 'text': 'b'}])
+    assert _load_checkpoint(str(path), retry_errors=False) == {('1', 'm'), ('"1"', 'm')}
+
+
+def test_pairs_with_missing_samples_are_dropped(tmp_path):
+    path = tmp_path / 'out.jsonl'
+    complete = [{'id': 1, 'model_name': 'm', 'sample': s, 'text': 'a'} for s in range(2)]
+    partial = [{'id': 2, 'model_name': 'm', 'sample': 0, 'text': 'b'}]
+    _write(path, complete + partial, tail='{"id": 2, "model_name": "m", "sam')
+    assert _load_checkpoint(str(path), retry_errors=False, n=2) == {('1', 'm')}
+    assert _rows(path) == complete
+
+
+def test_errors_are_retried_only_when_asked(tmp_path):
+    path = tmp_path / 'out.jsonl'
+    _write(path, [{'id': 1, 'model_name': 'm', 'error': 'Error: timeout'}, {'id': 2, 'model_name': 'm', 'text': 'b'}])
+    assert _load_checkpoint(str(path), retry_errors=False) == {('1', 'm'), ('2', 'm')}
+    assert _load_checkpoint(str(path), retry_errors=True) == {('2', 'm')}
+    # A later success replaces the error
+    with open(path, 'a') as f:
+        f.write(json.dumps({'id': 1, 'model_name': 'm', 'text': 'a'}) + '\n')
+    assert _load_checkpoint(str(path), retry_errors=True) == {('1', 'm'), ('2', 'm')}
+
+
+def test_resume_skips_finished_rows(completion, mock_server, tmp_path):
+    completion.register(mock_server.providers())
+    input_path, output_path = tmp_path / 'in.jsonl', tmp_path / 'out.jsonl'
+    _write(input_path, [{'id': f'r{i}', 'prompt': f'p{i}'} for i in range(6)] + [{'prompt': 'no id'}])
+
+    summary = run_batch(str(input_path), str(output_path), ['ada', 'gpt2'], max_tokens=4)
+    assert summary['rows'] == 14 and summary['errors'] == 0
+    lines = output_path.read_text().splitlines()
+    output_path.write_text('\n'.join(lines[:9]) + '\n' + lines[9][:10])
+
+    requests = mock_server.requests
+    summary = run_batch(str(input_path), str(output_path), ['ada', 'gpt2'], max_tokens=4)
+    assert summary['skipped'] == 9 and summary['rows'] == 5
+    assert mock_server.requests > requests
+    rows = _rows(output_path)
+    assert len(rows) == 14
+    assert {(row['id'], row['model_name']) for row in rows} == {(i, m) for i in [f'r{i}' for i in range(6)] + [7]
+                                                                for m in ('openai.com/ada', 'huggingface.co/gpt2')}
+
+    requests = mock_server.requests
+    assert run_batch(str(input_path), str(output_path), ['ada', 'gpt2'])['rows'] == 0
+    assert mock_server.requests == requests
+
+
+def test_resume_with_samples(completion, mock_server, tmp_path):
+    completion.register(mock_server.providers())
+    input_path, output_path = tmp_path / 'in.jsonl', tmp_path / 'out.jsonl'
+    _write(input_path, [{'id': i, 'prompt': f'p{i}'} for i in range(3)])
+
+    run_batch(str(input_path), str(output_path), 'ada', n=2, max_tokens=4)
+    lines = output_path.read_text().splitlines()
+    assert sorted((row['id'], row['sample']) for row in map(json.loads, lines)) == [(i, s) for i in range(3) for s in range(2)]
+    output_path.write_text('\n'.join(lines[:5]) + '\n')
+
+    summary = run_batch(str(input_path), str(output_path), 'ada', n=2, max_tokens=4)
+    assert summary['skipped'] == 2 and summary['rows'] == 2
+    assert sorted((row['id'], row['sample']) for row in _rows(output_path)) == [(i, s) for i in range(3) for s in range(2)]
@@ -0,0 +1,86 @@
+import asyncio
+import threading
+import time
+
+from openlm.cache import MemoryCache
+from openlm.llm.base import BaseModel
+
+
+class Batching(BaseModel):
+    max_batch_size = 3
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def list_models(self):
+        return ['m']
+
+    def namespace(self):
+        return 'batching'
+
+    def create_completion(self, model, prompt, **kwargs):
+        return self.create_completions_batch(model, [prompt], **kwargs)[0]
+
+    def create_completions_batch(self, model, prompts, **kwargs):
+        with self._lock:
+            self.calls.append(list(prompts))
+        time.sleep(self.delay)
+        return [{'text': prompt.upper()} for prompt in prompts]
+
+
+def test_prompts_are_sent_in_batches(completion):
+    provider = Batching()
+    completion.register([provider])
+    prompts = [f'p{i}' for i in range(7)]
+    result = completion.create(model='m', prompt=prompts)
+    assert [choice['text'] for choice in result['choices']] == [p.upper() for p in prompts]
+    assert [choice['index'] for choice in result['choices']] == list(range(7))
+    assert provider.calls == [['p0', 'p1', 'p2'], ['p3', 'p4', 'p5'], ['p6']]
+
+
+def test_mock_server_batches(completion, mock_server):
+    completion.register(mock_server.providers())
+    prompts = [f'p{i}' for i in range(25)]
+    result = completion.create(model='ada', prompt=prompts, max_tokens=4)
+    assert len(result['choices']) == 25
+    assert all('error' not in choice for choice in result['choices'])
+    # OpenAI takes 20 prompts per request
+    assert mock_server.requests == 2
+
+
+def test_cached_prompts_are_left_out(completion):
+    provider = Batching()
+    completion.register([provider])
+    completion.cache = MemoryCache()
+    completion.create(model='m', prompt=['a', 'b'], temperature=0)
+    result = completion.create(model='m', prompt=['a', 'c', 'b'], temperature=0)
+    assert [choice['text'] for choice in result['choices']] == ['A', 'C', 'B']
+    assert provider.calls == [['a', 'b'], ['c']]
+
+
+def test_identical_batches_are_coalesced(completion):
+    provider = Batching(delay=0.1)
+    completion.register([provider])
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(completion.create(model='m', prompt=['a', 'b'], temperature=0)))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(2)
+    assert len(provider.calls) == 1
+    assert [[choice['text'] for choice in result['choices']] for result in results] == [['A', 'B']] * 4
+
+
+def test_async_batches(completion):
+    provider = Batching()
+    completion.register([provider])
+
+    async def run():
+        return await completion.acreate(model='m', prompt=['a', 'b', 'c', 'd'])
+
+    result = asyncio.run(run())
+    assert [choice['text'] for choice in result['choices']] == ['A', 'B', 'C', 'D']
+    assert provider.calls == [['a', 'b', 'c'], ['d']]
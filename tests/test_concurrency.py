@@ -0,0 +1,127 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from openlm.concurrency import Limiter
+from openlm.llm.base import BaseModel
+
+
+def test_limit_must_be_positive():
+    with pytest.raises(ValueError):
+        Limiter(0)
+
+
+def test_acquire_times_out_when_full():
+    limiter = Limiter(1)
+    assert limiter.acquire()
+    assert not limiter.acquire(timeout=0.01)
+    assert limiter.waiting == 0
+    limiter.release()
+    assert limiter.in_flight == 0
+
+
+def test_release_hands_slot_to_waiter():
+    limiter = Limiter(1)
+    limiter.acquire()
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: limiter.acquire() and acquired.set())
+    thread.start()
+    while not limiter.waiting:
+        time.sleep(0.001)
+    limiter.release()
+    thread.join(1)
+    assert acquired.is_set()
+    assert limiter.in_flight == 1
+
+
+def test_waiters_are_served_by_key_then_arrival():
+    limiter = Limiter(1)
+    limiter.acquire()
+    order = []
+
+    def wait(name, key):
+        limiter.acquire(key=key)
+        order.append(name)
+        limiter.release()
+
+    threads = []
+    for name, key in (('batch', (1,)), ('first', (0,)), ('second', (0,))):
+        threads.append(threading.Thread(target=wait, args=(name, key)))
+        threads[-1].start()
+        while limiter.waiting < len(threads):
+            time.sleep(0.001)
+    limiter.release()
+    for thread in threads:
+        thread.join(1)
+    assert order == ['first', 'second', 'batch']
+
+
+def test_raising_limit_wakes_waiters():
+    limiter = Limiter(1)
+    limiter.acquire()
+    thread = threading.Thread(target=limiter.acquire)
+    thread.start()
+    while not limiter.waiting:
+        time.sleep(0.001)
+    limiter.set_limit(2)
+    thread.join(1)
+    assert not thread.is_alive()
+    assert limiter.in_flight == 2
+
+
+def test_cancelled_async_waiter_leaves_the_queue():
+    limiter = Limiter(1)
+    limiter.acquire()
+
+    async def cancel():
+        task = asyncio.ensure_future(limiter.aacquire())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel())
+    assert limiter.waiting == 0
+    limiter.release()
+    assert limiter.in_flight == 0
+    assert limiter.acquire(timeout=0.1)
+
+
+def test_release_skips_waiter_whose_loop_closed():
+    limiter = Limiter(1)
+    limiter.acquire()
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(limiter.aacquire())
+    loop.run_until_complete(asyncio.sleep(0.01))
+    loop.close()
+    limiter.release()
+    assert limiter.in_flight == 0
+    assert limiter.acquire(timeout=0.1)
+    # Keeps the pending task from being reported as destroyed
+    task._log_destroy_pending = False
+
+
+def test_async_fallback_runs_on_shared_executor(completion):
+    threads = set()
+
+    class Blocking(BaseModel):
+        def list_models(self):
+            return ['m']
+
+        def namespace(self):
+            return 'blocking'
+
+        def create_completion(self, model, prompt, **kwargs):
+            threads.add(threading.current_thread().name)
+            return {'text': prompt}
+
+    completion.register([Blocking()])
+
+    async def run():
+        return await asyncio.gather(*[completion.acreate(model='m', prompt=f'p{i}') for i in range(4)])
+
+    results = asyncio.run(run())
+    assert [r['choices'][0]['text'] for r in results] == ['p0', 'p1', 'p2', 'p3']
+    assert all(name.startswith('openlm') for name in threads)
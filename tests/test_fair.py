@@ -0,0 +1,155 @@
+import asyncio
+import time
+
+import pytest
+
+from openlm.fair import BATCH, FairScheduler, Rejected, TenantPolicy, check_rejected, scheduled
+from openlm.llm.base import BaseModel
+
+
+class ManualExecutor():
+    """
+    Holds submitted calls until the test runs them, so the order slots are granted in is deterministic.
+    """
+    def __init__(self):
+        self.pending = []
+
+    def submit(self, fn, *args):
+        self.pending.append((fn, args))
+
+    def run_next(self):
+        fn, args = self.pending.pop(0)
+        fn(*args)
+
+
+def _submit(scheduler, executor, tenant, name, priority='interactive'):
+    with scheduled(tenant, priority):
+        return scheduler.submit(executor, lambda: check_rejected() or name)
+
+
+def _drain(executor, futures):
+    while executor.pending:
+        executor.run_next()
+    return [future.result() for future in futures]
+
+
+def test_interactive_requests_go_first():
+    scheduler, executor = FairScheduler(limit=1), ManualExecutor()
+    futures = [_submit(scheduler, executor, 'bulk', f'b{i}', BATCH) for i in range(3)]
+    futures.append(_submit(scheduler, executor, 'user', 'i0'))
+    order = []
+    for future in futures:
+        future.add_done_callback(lambda f: order.append(f.result()))
+    _drain(executor, futures)
+    assert order == ['b0', 'i0', 'b1', 'b2']
+
+
+def test_tenants_share_slots_by_weight():
+    scheduler = FairScheduler({'heavy': TenantPolicy(weight=3)}, limit=1)
+    executor = ManualExecutor()
+    blocker = _submit(scheduler, executor, 'other', 'x')
+    futures = [_submit(scheduler, executor, 'heavy', 'heavy') for _ in range(12)]
+    futures += [_submit(scheduler, executor, 'light', 'light') for _ in range(12)]
+    order = []
+    for future in futures:
+        future.add_done_callback(lambda f: order.append(f.result()))
+    _drain(executor, [blocker] + futures)
+    assert order[:8].count('heavy') == 6
+    assert scheduler.stats()['heavy']['started'] == 12
+
+
+def test_max_running_holds_back_a_tenant():
+    scheduler = FairScheduler({'a': TenantPolicy(max_running=1)}, limit=4)
+    executor = ManualExecutor()
+    for name in ('a0', 'a1'):
+        _submit(scheduler, executor, 'a', name)
+    _submit(scheduler, executor, 'b', 'b0')
+    assert scheduler.running == 2
+    assert scheduler.stats()['a']['queued'] == 1
+
+
+def test_requests_beyond_max_queued_are_rejected():
+    scheduler = FairScheduler({'a': TenantPolicy(max_queued=1)}, limit=1)
+    executor = ManualExecutor()
+    futures = [_submit(scheduler, executor, 'a', f'a{i}') for i in range(3)]
+    while executor.pending:
+        executor.run_next()
+    assert futures[0].result() == 'a0' and futures[1].result() == 'a1'
+    with pytest.raises(Rejected):
+        futures[2].result()
+    assert scheduler.stats()['a']['rejected_quota'] == 1
+
+
+def test_requests_past_their_slo_are_rejected():
+    scheduler, executor = FairScheduler(slo={'interactive': 0.01}, limit=1), ManualExecutor()
+    first = _submit(scheduler, executor, 'a', 'first')
+    late = _submit(scheduler, executor, 'a', 'late')
+    time.sleep(0.02)
+    executor.run_next()
+    assert first.result() == 'first'
+    executor.run_next()
+    with pytest.raises(Rejected):
+        late.result()
+    assert scheduler.stats()['a']['rejected_slo'] == 1
+    assert scheduler.running == 0
+
+
+def test_slot_of_a_closed_loop_is_given_back():
+    scheduler, executor = FairScheduler(limit=1), ManualExecutor()
+    first = _submit(scheduler, executor, 'a', 'first')
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(scheduler.aacquire())
+    loop.run_until_complete(asyncio.sleep(0.01))
+    loop.close()
+    task._log_destroy_pending = False
+    after = _submit(scheduler, executor, 'a', 'after')
+    assert _drain(executor, [first, after]) == ['first', 'after']
+    assert scheduler.running == 0
+
+
+def test_cancelled_async_request_leaves_the_queue():
+    scheduler, executor = FairScheduler(limit=1), ManualExecutor()
+    first = _submit(scheduler, executor, 'a', 'first')
+
+    async def cancel():
+        task = asyncio.ensure_future(scheduler.aacquire())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel())
+    assert scheduler.stats()['default']['queued'] == 0
+    _drain(executor, [first])
+    assert scheduler.running == 0
+
+
+def test_split_divides_limits():
+    scheduler = FairScheduler({'a': TenantPolicy(weight=2, max_running=5, max_queued=9)}, slo={'batch': 60}, limit=10)
+    part = scheduler.split(4)
+    assert part.limit == 3
+    assert (part.tenants['a'].weight, part.tenants['a'].max_running, part.tenants['a'].max_queued) == (2, 2, 3)
+    assert part.default.max_running is None
+    assert part.slo == {'batch': 60}
+
+
+def test_limiter_wait_counts_towards_the_wait(completion):
+    class Slow(BaseModel):
+        def list_models(self):
+            return ['m']
+
+        def namespace(self):
+            return 'slow'
+
+        def create_completion(self, model, prompt, **kwargs):
+            time.sleep(0.05)
+            return {'text': prompt}
+
+    completion.register([Slow()])
+    scheduler = FairScheduler(limit=4)
+    completion.configure(scheduler=scheduler, provider_concurrency={'slow': 1})
+    result = completion.create(model='m', prompt=['a', 'b', 'c', 'd'], user='t')
+    assert [choice['text'] for choice in result['choices']] == ['a', 'b', 'c', 'd']
+    stats = scheduler.stats()['t']
+    assert stats['started'] == 4 and stats['running'] == 0
+    assert stats['max_wait'] >= 0.1
@@ -0,0 +1,58 @@
+import threading
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from openlm.llm.local import Local  # noqa: E402
+
+PROMPT = 'the test of the tiny model, the best of the tests'
+
+
+def test_prefix_cache_matches_a_full_forward_pass(tiny_model):
+    cached = Local({'tiny': tiny_model}, seed=0, block_size=4)
+    uncached = Local({'tiny': tiny_model}, seed=0, prefix_cache_tokens=0)
+    expected = uncached.create_completion('tiny', PROMPT, max_tokens=8, temperature=0, logprobs=1)
+    cached.create_completion('tiny', PROMPT + ' again', max_tokens=1, temperature=0)
+    result = cached.create_completion('tiny', PROMPT, max_tokens=8, temperature=0, logprobs=1)
+    assert cached.stats()['tiny']['prefix_cache_hit_rate'] > 0
+    assert result['text'] == expected['text']
+    np.testing.assert_allclose(result['logprobs']['token_logprobs'], expected['logprobs']['token_logprobs'], atol=1e-4)
+
+
+def test_concurrent_calls_share_forward_passes(tiny_model):
+    provider = Local({'tiny': tiny_model}, seed=0, max_batch_size=4)
+    results = []
+    threads = [threading.Thread(target=lambda i=i: results.append(provider.create_completion('tiny', f'prompt {i}', max_tokens=16)))
+               for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    assert len(results) == 8
+    stats = provider.stats()['tiny']
+    assert 1 < stats['mean_batch_size'] <= 4
+
+
+def test_samples_must_fit_in_a_batch(tiny_model):
+    provider = Local({'tiny': tiny_model}, max_batch_size=2)
+    assert provider.max_samples == 2
+    assert len(provider.create_completion('tiny', 'a', max_tokens=2, n=2)['samples']) == 2
+    with pytest.raises(ValueError):
+        provider.create_completion('tiny', 'a', max_tokens=2, n=3)
+
+
+def test_completion_splits_samples_across_calls(completion, tiny_model):
+    completion.register([Local({'tiny': tiny_model}, seed=0, max_batch_size=2)])
+    result = completion.create(model='tiny', prompt=['a', 'b'], n=3, max_tokens=2)
+    assert [choice['index'] for choice in result['choices']] == list(range(6))
+    assert not any('error' in choice for choice in result['choices'])
+
+
+def test_text_offsets_index_the_returned_text(tiny_model):
+    provider = Local({'tiny': tiny_model}, seed=0)
+    for echo in (False, True):
+        result = provider.create_completion('tiny', 'the', max_tokens=6, logprobs=0, echo=echo)
+        logprobs = result['logprobs']
+        start = len('the') if echo else 0
+        assert logprobs['text_offset'] == [start + sum(map(len, logprobs['tokens'][:k])) for k in range(len(logprobs['tokens']))]
@@ -0,0 +1,47 @@
+import concurrent.futures
+
+
+def _choice(index, text):
+    return {'id': 'c', 'model_idx': 0, 'model_name': 'openai.com/ada', 'index': index, 'text': text}
+
+
+def test_shard_choices_are_reindexed(completion, mock_server):
+    completion.register(mock_server.providers())
+    future = concurrent.futures.Future()
+    future.set_result([_choice(k, str(k)) for k in range(4)])
+    choices = completion._shard_choices(future, ['ada'], start=3, count=2, n=2)
+    assert [choice['index'] for choice in choices] == [6, 7, 8, 9]
+    assert [choice['text'] for choice in choices] == ['0', '1', '2', '3']
+
+
+def test_failed_shard_has_an_error_per_sample(completion, mock_server):
+    completion.register(mock_server.providers())
+    future = concurrent.futures.Future()
+    future.set_exception(RuntimeError('worker died'))
+    choices = completion._shard_choices(future, ['ada', 'gpt2'], start=2, count=1, n=2)
+    assert [(choice['model_idx'], choice['index']) for choice in choices] == [(0, 4), (0, 5), (1, 4), (1, 5)]
+    assert [choice['model_name'] for choice in choices] == ['openai.com/ada'] * 2 + ['huggingface.co/gpt2'] * 2
+    assert all(choice['error'] == 'Error: worker died' for choice in choices)
+
+
+def test_running_shard_is_cancelled_and_timed_out(completion, mock_server):
+    completion.register(mock_server.providers())
+    future = concurrent.futures.Future()
+    choices = completion._shard_choices(future, ['ada'], start=0, count=2, n=1)
+    assert future.cancelled()
+    assert [choice['index'] for choice in choices] == [0, 1]
+    assert all(choice['error'] == 'Error: Request timed out' for choice in choices)
+
+
+def test_processes_match_threads(completion, mock_server):
+    completion.register(mock_server.providers())
+    prompts = [f'prompt {i}' for i in range(10)]
+
+    def run():
+        result = completion.create(model=['ada', 'gpt2'], prompt=prompts, n=2, temperature=0.5, max_tokens=4)
+        return [(c['model_idx'], c['index'], c['model_name'], 'error' in c) for c in result['choices']], result['usage']
+
+    threads = run()
+    completion.configure(processes=2, process_shard_size=3)
+    assert run() == threads
+    assert not any(error for *_, error in threads[0])
@@ -0,0 +1,75 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from openlm.singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_result():
+    flights = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls, results = [], []
+
+    def fn():
+        calls.append(1)
+        started.set()
+        release.wait(1)
+        return {'text': ['shared']}
+
+    leader = threading.Thread(target=lambda: results.append(flights.do('k', fn)))
+    leader.start()
+    started.wait(1)
+    followers = [threading.Thread(target=lambda: results.append(flights.do('k', fn))) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    while flights.coalesced < 3:
+        time.sleep(0.001)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(1)
+    assert len(calls) == 1
+    assert results == [{'text': ['shared']}] * 4
+    # Every caller gets its own copy
+    assert len({id(result) for result in results}) == 4
+
+
+def test_errors_propagate_to_waiters():
+    flights = SingleFlight()
+
+    async def run():
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError('upstream')
+
+        return await asyncio.gather(flights.ado('k', fail), flights.ado('k', fail), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert flights.coalesced == 1
+    assert all(isinstance(result, ValueError) for result in results)
+    # The failed call is not remembered
+    assert asyncio.run(flights.ado('k', _value)) == 'value'
+
+
+def test_waiters_retry_when_leader_is_cancelled():
+    flights = SingleFlight()
+
+    async def run():
+        async def slow():
+            await asyncio.sleep(1)
+
+        leader = asyncio.ensure_future(flights.ado('k', slow))
+        await asyncio.sleep(0.01)
+        follower = asyncio.ensure_future(flights.ado('k', _value))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(run()) == 'value'
+
+
+async def _value():
+    return 'value'